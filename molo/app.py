@@ -2,15 +2,25 @@
 App factory functions go here
 """
 
-from fastapi import FastAPI, UploadFile, File
+from typing import *
+
+from fastapi import FastAPI, UploadFile, File, Response
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
 load_dotenv()  # load the env vars before anything else
 
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, generate_latest
+
+from helpers.metrics import MetricsMiddleware
+
 
-def get_app():
+def get_app(
+        metrics_registry: Optional[CollectorRegistry] = None
+):
     """
     returns an instance of the FastAPI app
+    :param metrics_registry: when given, http requests are counted and timed,
+        and the registry is exposed in the Prometheus format on /metrics
     :return:
     """
 
@@ -23,4 +33,11 @@ def get_app():
         allow_headers=["*"]
     )
 
+    if metrics_registry is not None:
+        app.add_middleware(MetricsMiddleware, registry=metrics_registry)
+
+        @app.get("/metrics")
+        async def metrics_endpoint():
+            return Response(content=generate_latest(metrics_registry), media_type=CONTENT_TYPE_LATEST)
+
     return app
@@ -0,0 +1,224 @@
+"""
+Dynamic micro-batching of prediction requests
+"""
+import asyncio
+import time
+from collections import deque
+from concurrent.futures import Executor
+from typing import *
+
+import numpy as np
+
+
+class BatcherOverloadedError(Exception):
+    """
+    Raised when a request arrives while the queue of a batcher is full
+    """
+
+
+class MicroBatcher:
+    """
+    Collects concurrent prediction requests into a single batch, up to max_batch_size images or max_wait_ms
+    after the first request of the batch arrived, runs one batched inference and fans the results
+    back out to the waiting requests.
+    """
+    def __init__(
+            self,
+            predict_batch: Callable[[np.ndarray], Sequence[Any]],
+            max_batch_size: int = 32,
+            max_wait_ms: float = 5.0,
+            max_concurrent_batches: int = 1,
+            executor: Optional[Executor] = None,
+            name: str = "batcher",
+            metrics_window: int = 1000,
+            on_batch: Optional[Callable[[int, float, float], None]] = None,
+            max_queue_size: int = 1024
+    ):
+        """
+        :param predict_batch: function (sync or async) that takes a batch of inputs and returns one result per input
+        :param max_batch_size: maximum number of images in a batch
+        :param max_wait_ms: maximum time to wait for a batch to fill up, counted from the first request in the batch
+        :param max_concurrent_batches: how many batches can be running inference at the same time,
+            usually the number of interpreters or connections of the backend
+        :param executor: executor used to run a synchronous predict_batch, defaults to the loop's default executor
+        :param name: name of the batcher, used when reporting metrics
+        :param metrics_window: number of most recent batches to keep metrics for
+        :param on_batch: called with the size, queue wait time and inference time of every batch
+        :param max_queue_size: maximum number of requests waiting for a batch, requests beyond it are rejected
+            with a BatcherOverloadedError instead of waiting for ever longer
+        """
+        self.predict_batch = predict_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.
+        self.max_concurrent_batches = max_concurrent_batches
+        self.executor = executor
+        self.name = name
+        self.on_batch = on_batch
+        self.max_queue_size = max_queue_size
+        self.rejected_requests = 0
+
+        self.total_batches = 0
+        self.total_items = 0
+        self.batch_sizes = deque(maxlen=metrics_window)
+        self.batch_wait_times = deque(maxlen=metrics_window)
+        self.batch_inference_times = deque(maxlen=metrics_window)
+
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._carry_over = None
+
+    def _ensure_started(self):
+        # the queue and the worker are created lazily so that they are bound to the loop the app runs in
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue(maxsize=self.max_queue_size)
+            self._semaphore = asyncio.Semaphore(self.max_concurrent_batches)
+            self._worker = asyncio.ensure_future(self._run())
+
+    async def predict(
+            self,
+            inputs: np.ndarray
+    ) -> List[Any]:
+        """
+        Queues a batch of inputs (usually a batch of a single image) and waits for its results
+        :param inputs: array of shape (n, ...)
+        :return: list with n results
+        :raises BatcherOverloadedError: if max_queue_size requests are already waiting
+        """
+        self._ensure_started()
+        future = asyncio.get_event_loop().create_future()
+        try:
+            self._queue.put_nowait((inputs, future, time.perf_counter()))
+        except asyncio.QueueFull:
+            self.rejected_requests += 1
+            raise BatcherOverloadedError(f"More than {self.max_queue_size} requests are waiting for {self.name}")
+        return await future
+
+    async def _next_batch(self) -> List[Tuple[np.ndarray, asyncio.Future, float]]:
+        if self._carry_over is not None:
+            first, self._carry_over = self._carry_over, None
+        else:
+            first = await self._queue.get()
+
+        batch = [first]
+        batch_size = len(first[0])
+        deadline = first[2] + self.max_wait
+
+        while batch_size < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            try:
+                item = self._queue.get_nowait() if timeout <= 0 else \
+                    await asyncio.wait_for(self._queue.get(), timeout)
+            except (asyncio.QueueEmpty, asyncio.TimeoutError):
+                break
+
+            if batch_size + len(item[0]) > self.max_batch_size:
+                self._carry_over = item
+                break
+
+            batch.append(item)
+            batch_size += len(item[0])
+
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._next_batch()
+            await self._semaphore.acquire()
+            task = asyncio.ensure_future(self._process(batch))
+            task.add_done_callback(lambda _: self._semaphore.release())
+
+    async def _process(
+            self,
+            batch: List[Tuple[np.ndarray, asyncio.Future, float]]
+    ):
+        start = time.perf_counter()
+        batch_size = sum(len(item[0]) for item in batch)
+
+        try:
+            # inside the try, so that inputs of mismatched shapes or dtypes fail their batch instead of the batcher
+            inputs = np.concatenate([item[0] for item in batch], axis=0)
+            if asyncio.iscoroutinefunction(self.predict_batch):
+                results = await self.predict_batch(inputs)
+            else:
+                loop = asyncio.get_event_loop()
+                results = await loop.run_in_executor(self.executor, self.predict_batch, inputs)
+        except Exception as e:
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            self._record(batch_size, start - batch[0][2], time.perf_counter() - start)
+
+        offset = 0
+        for item_inputs, future, _ in batch:
+            n = len(item_inputs)
+            if not future.done():
+                future.set_result(list(results[offset:offset + n]))
+            offset += n
+
+    def _record(
+            self,
+            batch_size: int,
+            wait_time: float,
+            inference_time: float
+    ):
+        self.total_batches += 1
+        self.total_items += batch_size
+        self.batch_sizes.append(batch_size)
+        self.batch_wait_times.append(wait_time)
+        self.batch_inference_times.append(inference_time)
+        if self.on_batch is not None:
+            self.on_batch(batch_size, wait_time, inference_time)
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def get_metrics(self) -> Dict[str, Any]:
+        """
+        Returns a summary of the sizes, queue wait times and inference times of the most recent batches
+        :return:
+        """
+        def _summarize(values: Sequence[float]) -> Dict[str, float]:
+            if not values:
+                return {}
+            values = np.asarray(values)
+            return {
+                "mean": round(float(values.mean()), 6),
+                "p50": round(float(np.percentile(values, 50)), 6),
+                "p95": round(float(np.percentile(values, 95)), 6),
+                "max": round(float(values.max()), 6)
+            }
+
+        return {
+            "maxBatchSize": self.max_batch_size,
+            "maxWaitMs": self.max_wait * 1000.,
+            "totalBatches": self.total_batches,
+            "totalItems": self.total_items,
+            "queueDepth": self.queue_depth,
+            "maxConcurrentBatches": self.max_concurrent_batches,
+            "rejectedRequests": self.rejected_requests,
+            "batchSize": _summarize(self.batch_sizes),
+            "waitTime": _summarize(self.batch_wait_times),
+            "inferenceTime": _summarize(self.batch_inference_times)
+        }
+
+    async def close(self):
+        """
+        Stops the worker. Requests that are still queued are cancelled.
+        :return:
+        """
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+
+        if self._carry_over is not None:
+            self._carry_over[1].cancel()
+            self._carry_over = None
+
+        if self._queue is not None:
+            while not self._queue.empty():
+                _, future, _ = self._queue.get_nowait()
+                future.cancel()
@@ -0,0 +1,162 @@
+"""
+Grad-CAM overlays of uploaded images, generated off the prediction path
+"""
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import *
+
+import numpy as np
+
+from utils.cache_utils import LRUCache
+from helpers.batching import MicroBatcher
+
+logger = logging.getLogger("gradcam.py")
+
+
+class GradCamService:
+    """
+    Generates Grad-CAM overlays in batches on a dedicated thread and keeps them in an LRU cache,
+    keyed by the hash of the image. Predictions only register their images, so explanations never delay them:
+    with precompute the overlay is generated in the background right away, otherwise when it is first requested.
+    Identical images share one overlay, and concurrent requests for the same one share its generation.
+    Overlays can be saved to and loaded from shared storage, so that any worker of the server can return them,
+    not only the one that made the prediction.
+    """
+    def __init__(
+            self,
+            explain_batch: Callable[[Sequence[bytes]], List[bytes]],
+            max_batch_size: int = 16,
+            max_wait_ms: float = 20.0,
+            cache_size: int = 1024,
+            source_cache_size: int = 256,
+            precompute: bool = True,
+            max_pending: int = 256,
+            save_overlay: Optional[Callable[[str, bytes], Awaitable[Any]]] = None,
+            load_overlay: Optional[Callable[[str], Awaitable[Optional[bytes]]]] = None,
+            on_batch: Optional[Callable[[int, float, float], None]] = None
+    ):
+        """
+        :param explain_batch: returns the encoded overlays of a batch of encoded images, e.g. GradCam.explain_images
+        :param max_batch_size: see MicroBatcher
+        :param max_wait_ms: see MicroBatcher
+        :param cache_size: number of overlays kept
+        :param source_cache_size: number of registered images kept until their overlay is generated
+        :param precompute: generate overlays as soon as images are registered
+        :param max_pending: maximum number of overlays being generated. Beyond it, registered images are not
+            precomputed, their overlays are generated when requested.
+        :param save_overlay: called with the key and the overlay once it is generated, e.g. to upload it
+        :param load_overlay: returns a saved overlay, for keys this process does not know about
+        :param on_batch: see MicroBatcher
+        """
+        self.explain_batch = explain_batch
+        self.precompute = precompute
+        self.max_pending = max_pending
+        self.save_overlay = save_overlay
+        self.load_overlay = load_overlay
+        self.overlays = LRUCache(max_entries=cache_size)
+        self.sources = LRUCache(max_entries=source_cache_size)
+        self.failed = 0
+
+        # batches run one at a time, how many cores each takes is up to the explain_batch function
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="gradcam")
+        self.batcher = MicroBatcher(
+            self._explain, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms, executor=self.executor,
+            name="gradcam", on_batch=on_batch
+        )
+        self._pending: Dict[str, asyncio.Future] = {}
+
+    def _explain(
+            self,
+            images_bytes: np.ndarray
+    ) -> List[bytes]:
+        return self.explain_batch(list(images_bytes))
+
+    def register(
+            self,
+            key: str,
+            image_bytes: bytes
+    ):
+        """
+        Makes an image available for explanation under key
+        :param key: hash of the image, see cache_utils.hash_bytes
+        :param image_bytes:
+        :return:
+        """
+        if key in self._pending or self.overlays.get(key) is not None:
+            return
+
+        self.sources.set(key, image_bytes)
+        if self.precompute and len(self._pending) < self.max_pending:
+            self._schedule(key)
+
+    def _schedule(
+            self,
+            key: str
+    ) -> Optional[asyncio.Future]:
+        task = self._pending.get(key)
+        if task is None:
+            image_bytes = self.sources.get(key)
+            if image_bytes is None:
+                return None
+            task = self._pending[key] = asyncio.ensure_future(self._generate(key, image_bytes))
+        return task
+
+    async def _generate(
+            self,
+            key: str,
+            image_bytes: bytes
+    ) -> Optional[bytes]:
+        try:
+            # an object array, so that the batcher can concatenate the encoded images
+            overlay, = await self.batcher.predict(np.array([image_bytes], dtype=object))
+        except Exception as e:
+            self.failed += 1
+            logger.error(f"Failed to generate the Grad-CAM overlay of {key}: {e}")
+            return None
+        else:
+            self.overlays.set(key, overlay)
+            if self.save_overlay is not None:
+                try:
+                    await self.save_overlay(key, overlay)
+                except Exception as e:
+                    logger.error(f"Failed to save the Grad-CAM overlay of {key}: {e}")
+            return overlay
+        finally:
+            self._pending.pop(key, None)
+
+    async def get(
+            self,
+            key: str
+    ) -> Optional[bytes]:
+        """
+        Returns the overlay of a registered image, waiting for it to be generated if needed.
+        Images registered in other processes are looked up with load_overlay.
+        :param key:
+        :return: the encoded overlay, None if the image is unknown (or was evicted) or its overlay failed
+        """
+        overlay = self.overlays.get(key)
+        if overlay is not None:
+            return overlay
+
+        task = self._schedule(key)
+        if task is not None:
+            # a client going away must not cancel a generation other requests may be waiting for
+            return await asyncio.shield(task)
+
+        if self.load_overlay is None:
+            return None
+        try:
+            overlay = await self.load_overlay(key)
+        except Exception as e:
+            logger.error(f"Failed to load the Grad-CAM overlay of {key}: {e}")
+            return None
+        if overlay is not None:
+            self.overlays.set(key, overlay)
+        return overlay
+
+    async def close(self):
+        await self.batcher.close()
+        for task in list(self._pending.values()):
+            task.cancel()
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,129 @@
+"""
+Prometheus metrics of the inference server, built on prometheus_client.
+Metrics are kept per process, every worker of the server is scraped on its own.
+"""
+import functools
+import time
+from typing import *
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+# seconds, from sub-millisecond decodes to slow remote inference
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class FunctionCollector:
+    """
+    A metric read from the rest of the app when scraped, e.g. a queue depth or counters kept by another component
+    """
+    def __init__(
+            self,
+            name: str,
+            documentation: str,
+            function: Callable[[], Union[float, Dict[Tuple[str, ...], float]]],
+            kind: str = "gauge",
+            labelnames: Sequence[str] = ()
+    ):
+        """
+        :param name:
+        :param documentation:
+        :param function: returns the value, or a dict of label values -> value if there are labels
+        :param kind: gauge or counter. The name of a counter should not end in _total, it is added.
+        :param labelnames:
+        """
+        if kind not in ("gauge", "counter"):
+            raise ValueError(f"{kind} is not a valid kind. Must be one of ['gauge', 'counter']")
+
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+        self.kind = kind
+        self.labelnames = tuple(labelnames)
+
+    def collect(self):
+        family_class = CounterMetricFamily if self.kind == "counter" else GaugeMetricFamily
+        family = family_class(self.name, self.documentation, labels=self.labelnames)
+
+        values = self.function()
+        if not self.labelnames:
+            values = {(): values}
+        for key, value in values.items():
+            family.add_metric([str(label) for label in key], value)
+        yield family
+
+
+def register_function(
+        registry: CollectorRegistry,
+        name: str,
+        documentation: str,
+        function: Callable[[], Union[float, Dict[Tuple[str, ...], float]]],
+        kind: str = "gauge",
+        labelnames: Sequence[str] = ()
+) -> FunctionCollector:
+    """
+    Registers a metric computed when the registry is scraped, see FunctionCollector
+    :return:
+    """
+    collector = FunctionCollector(name, documentation, function, kind, labelnames)
+    registry.register(collector)
+    return collector
+
+
+@functools.lru_cache(maxsize=None)
+def get_http_metrics(
+        registry: CollectorRegistry
+) -> Tuple[Counter, Histogram, Gauge]:
+    """
+    Returns the http metrics of a registry, created on first use.
+    Starlette may build its middleware more than once, and a registry rejects metrics registered twice.
+    :param registry:
+    :return: requests by handler, method and status, their duration by handler and the number in flight
+    """
+    requests = Counter(
+        "molo_http_requests", "Http requests by handler, method and status", ("handler", "method", "status"),
+        registry=registry
+    )
+    duration = Histogram(
+        "molo_http_request_duration_seconds", "Duration of http requests by handler", ("handler", ),
+        registry=registry, buckets=DEFAULT_BUCKETS
+    )
+    in_flight = Gauge("molo_http_requests_in_flight", "Http requests being handled", registry=registry)
+    return requests, duration, in_flight
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware counting http requests by route, method and status, with their duration and the number in flight
+    """
+    def __init__(
+            self,
+            app,
+            registry: CollectorRegistry
+    ):
+        self.app = app
+        self.requests, self.duration, self.in_flight = get_http_metrics(registry)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        self.in_flight.inc()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            self.in_flight.dec()
+            # the router stores the matched endpoint in the scope, its name keeps the number of label values bounded
+            handler = getattr(scope.get("endpoint"), "__name__", "unmatched")
+            self.requests.labels(handler=handler, method=scope["method"], status=status).inc()
+            self.duration.labels(handler=handler).observe(time.perf_counter() - start)
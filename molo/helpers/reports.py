@@ -0,0 +1,299 @@
+"""
+PDF report generation in background worker processes
+"""
+import asyncio
+import functools
+import hashlib
+import logging
+import multiprocessing
+import re
+import time
+from collections import OrderedDict
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime as dt
+from typing import *
+
+import simplejson as json
+
+if TYPE_CHECKING:
+    from utils.storage_utils import StorageBackend
+
+# fields of the predictions that are not listed in reports
+REPORT_HIDDEN_FIELDS = ('uploadedImageUrl', 'gradCamImageUrl', 'predictedLabel', 'isConfirmed', 'inferenceTime')
+
+logger = logging.getLogger("reports.py")
+
+
+def to_report_records(
+        prediction_data: Iterable[dict]
+) -> Iterator[dict]:
+    """
+    Renames the fields of the predictions the way they appear in reports, one prediction at a time
+    :param prediction_data:
+    :return:
+    """
+    for item in prediction_data:
+        record = dict(item)
+        record['assigned label'] = record.pop('assignedLabel', "Null")
+        record['prediction confidence'] = record.pop('predictionConfidence', 0.0)
+        yield record
+
+
+class StorageThumbnailLoader:
+    """
+    Reads the uploaded image of a prediction from the storage backend to show next to it in the report,
+    None if it is not available. Only images in the app's own storage are read, with the backend's credentials,
+    so private buckets work too.
+    """
+    def __init__(
+            self,
+            storage_backend: "StorageBackend"
+    ):
+        """
+        :param storage_backend: where the uploaded images are stored
+        """
+        self.storage_backend = storage_backend
+
+    def __call__(
+            self,
+            record: dict
+    ) -> Optional[bytes]:
+        url = record.get('uploadedImageUrl')
+        path = self.storage_backend.path_for(url) if url else None
+        if path is None:
+            return None
+
+        data = self.storage_backend.download_bytes(path)
+        if data is None:
+            logger.warning(f"{url} is not in storage, it is left out of the report")
+        return data
+
+
+def render_report(
+        prediction_data: List[dict],
+        thumbnails: bool = False
+) -> bytes:
+    """
+    Renders a report for the predictions and returns the pdf. Runs in the report worker processes.
+    :param prediction_data: predictions as returned by the prediction endpoints
+    :param thumbnails: whether to show a thumbnail of every scan
+    :return:
+    """
+    from utils import storage_utils
+    from utils.pdf_utils import PDFReport
+
+    thumbnail_loader = None
+    if thumbnails:
+        thumbnail_loader = StorageThumbnailLoader(storage_utils.get_storage_backend())
+
+    return PDFReport().render(
+        to_report_records(prediction_data), thumbnail_loader=thumbnail_loader, hidden_keys=REPORT_HIDDEN_FIELDS
+    )
+
+
+def generate_report(
+        prediction_data: List[dict],
+        thumbnails: bool = False
+) -> str:
+    """
+    Renders a report for the predictions, stores it and returns its url. Runs in the report worker processes.
+    :param prediction_data: predictions as returned by the prediction endpoints
+    :param thumbnails: whether to show a thumbnail of every scan
+    :return:
+    """
+    from utils import storage_utils
+    from utils.pdf_utils import PDF_REPORTS_GCS_PATH
+
+    pdf_bytes = render_report(prediction_data, thumbnails)
+    report_name = f"oct_summary_report_{dt.now().isoformat()}.pdf"
+    return storage_utils.get_storage_backend().upload_bytes(
+        pdf_bytes, str(PDF_REPORTS_GCS_PATH / report_name), content_type="application/pdf"
+    )
+
+
+class ReportJobQueue:
+    """
+    Runs report generation as background jobs. Jobs are identified by a hash of their payload,
+    so submitting the same report again returns the existing job instead of rendering it twice.
+    Jobs are kept in the memory of the process that runs them. With a storage backend, their status is also
+    written to storage, so that the other worker processes of the server can answer for them.
+    """
+    def __init__(
+            self,
+            generate: Callable[..., str] = generate_report,
+            max_workers: int = 2,
+            executor: Optional[Executor] = None,
+            max_jobs: int = 1000,
+            storage_backend: Optional["StorageBackend"] = None,
+            storage_path: str = "report-jobs"
+    ):
+        """
+        :param generate: module level function that takes the payload as keyword arguments and returns the report url
+        :param max_workers: number of worker processes
+        :param executor: runs the jobs, a pool of max_workers processes by default.
+            Processes are spawned rather than forked, the server's threads and grpc channels are not fork-safe.
+        :param max_jobs: maximum number of jobs kept around, the oldest finished jobs are forgotten first
+        :param storage_backend: where the status of the jobs is shared with the other processes.
+            Jobs are only known to the process that runs them if not set.
+        :param storage_path: directory of the job statuses in storage
+        """
+        self.generate = generate
+        self.max_workers = max_workers
+        self.executor = executor or self._create_process_pool()
+        self.max_jobs = max_jobs
+        self.storage_backend = storage_backend
+        self.storage_path = storage_path.rstrip("/")
+        # a single thread, so that the statuses of a job are written in order
+        self.storage_executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="report-jobs"
+        ) if storage_backend is not None else None
+        self.jobs: "OrderedDict[str, dict]" = OrderedDict()
+        self.deduplicated_jobs = 0
+
+    def _create_process_pool(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def _submit(
+            self,
+            fn: Callable,
+            *args
+    ) -> Future:
+        try:
+            return self.executor.submit(fn, *args)
+        except BrokenProcessPool:
+            logger.warning("A report worker died, restarting the report worker pool")
+            self.executor = self._create_process_pool()
+            return self.executor.submit(fn, *args)
+
+    async def run(
+            self,
+            fn: Callable,
+            *args
+    ) -> Any:
+        """
+        Runs fn in the worker pool and waits for its result. A pool broken by a crashed worker is replaced.
+        :param fn: module level function
+        :param args:
+        :return:
+        """
+        return await asyncio.wrap_future(self._submit(fn, *args))
+
+    @staticmethod
+    def job_id_for(
+            payload: dict
+    ) -> str:
+        """
+        Returns the id of the job for a payload, the same for every identical payload
+        :param payload:
+        :return:
+        """
+        return hashlib.blake2b(json.dumps(payload, sort_keys=True).encode("utf-8"), digest_size=16).hexdigest()
+
+    def _status_path(
+            self,
+            job_id: str
+    ) -> str:
+        return f"{self.storage_path}/{job_id}.json"
+
+    def _save_status(
+            self,
+            job: dict
+    ):
+        try:
+            self.storage_backend.upload_bytes(
+                json.dumps(job).encode("utf-8"), self._status_path(job["jobId"]), content_type="application/json"
+            )
+        except Exception as e:
+            logger.error(f"Failed to store the status of report job {job['jobId']}: {e}")
+
+    def _load_status(
+            self,
+            job_id: str
+    ) -> Optional[dict]:
+        data = self.storage_backend.download_bytes(self._status_path(job_id))
+        return json.loads(data) if data is not None else None
+
+    def _evict(self):
+        for job_id in list(self.jobs.keys()):
+            if len(self.jobs) <= self.max_jobs:
+                break
+            if self.jobs[job_id]["status"] in ("done", "failed"):
+                del self.jobs[job_id]
+
+    def _on_done(
+            self,
+            job: dict,
+            future: Future
+    ):
+        job["finishedAt"] = time.time()
+        try:
+            job["reportUrl"] = future.result()
+            job["status"] = "done"
+        except Exception as e:
+            logger.error(f"Report job {job['jobId']} failed: {e}")
+            job["error"] = str(e)
+            job["status"] = "failed"
+
+        if self.storage_executor is not None:
+            self.storage_executor.submit(self._save_status, dict(job))
+
+    def submit(
+            self,
+            **payload
+    ) -> dict:
+        """
+        Queues a report job, or returns the job already queued or done for the same payload.
+        Failed jobs are retried.
+        :param payload: keyword arguments of the generate function, must be json serializable
+        :return: the job
+        """
+        job_id = self.job_id_for(payload)
+        job = self.jobs.get(job_id)
+        if job is not None and job["status"] != "failed":
+            self.deduplicated_jobs += 1
+            return job
+
+        job = {
+            "jobId": job_id, "status": "pending", "reportUrl": None, "error": None,
+            "createdAt": time.time(), "finishedAt": None
+        }
+        self.jobs[job_id] = job
+        self._evict()
+        if self.storage_executor is not None:
+            self.storage_executor.submit(self._save_status, dict(job))
+
+        # a partial of a module level function, so that it can be pickled and sent to a worker process.
+        # The callback runs on the pool's thread, jobs do not depend on the event loop that submitted them
+        future = self._submit(functools.partial(self.generate, **payload))
+        future.add_done_callback(lambda f: self._on_done(job, f))
+        return job
+
+    def get(
+            self,
+            job_id: str
+    ) -> Optional[dict]:
+        return self.jobs.get(job_id)
+
+    async def get_async(
+            self,
+            job_id: str
+    ) -> Optional[dict]:
+        """
+        Returns a job of this process, or else the status another process stored for it
+        :param job_id:
+        :return: None if there is no such job
+        """
+        job = self.jobs.get(job_id)
+        # ids are hashes, anything else could reach other objects in storage
+        if job is not None or self.storage_backend is None or re.fullmatch(r"[0-9a-f]{32}", job_id) is None:
+            return job
+        return await asyncio.get_event_loop().run_in_executor(self.storage_executor, self._load_status, job_id)
+
+    def close(
+            self,
+            wait: bool = True
+    ):
+        self.executor.shutdown(wait=wait)
+        if self.storage_executor is not None:
+            self.storage_executor.shutdown(wait=wait)
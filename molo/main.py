@@ -1,20 +1,251 @@
 import os
+import re
+import asyncio
+import functools
+import logging
 from pathlib import Path
 import time
+from typing import *
 
-from fastapi import UploadFile, File
+import numpy as np
+from fastapi import UploadFile, File, HTTPException, Request, Response
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram
 
 from app import get_app  # env vars will be loaded here from .env file
-from utils import image_utils, gcs_utils, prediction_api
-from utils.pdf_utils import PDFReport
+from utils import image_utils, prediction_api, prediction_backends, storage_utils, cache_utils
 from helpers.request_schemas import GeneratePDFReportSchema
+from helpers.batching import BatcherOverloadedError, MicroBatcher
+from helpers import metrics, reports
+from helpers.gradcam import GradCamService
 
-app = get_app()
+metrics_registry = CollectorRegistry()
+app = get_app(metrics_registry)
 
 GCS_PROJECT_BUCKET = os.environ.get("GCS_PROJECT_BUCKET")
 UPLOADED_IMAGES_GCS_PATH = Path(os.environ.get("UPLOADED_IMAGES_GCS_PATH"))
 CONFIDENCE_THRESHOLD = float(os.environ.get("CONFIDENCE_THRESHOLD", 80))
 IMG_SIZE = int(os.environ.get("IMAGE_SIZE", 80))  # assumes images are square
+REDUCED_DECODE = os.environ.get("REDUCED_DECODE", "true").lower() == "true"  # decode large JPEGs at lower resolution
+BATCH_MAX_SIZE = int(os.environ.get("BATCH_MAX_SIZE", 32))
+BATCH_MAX_WAIT_MS = float(os.environ.get("BATCH_MAX_WAIT_MS", 5))
+BATCH_MAX_CONCURRENT = int(os.environ.get("BATCH_MAX_CONCURRENT", 0))  # per backend, the backend's pool size if 0
+BATCH_MAX_QUEUE_SIZE = int(os.environ.get("BATCH_MAX_QUEUE_SIZE", 1024))  # requests beyond it get a 503
+UPLOAD_WORKERS = int(os.environ.get("UPLOAD_WORKERS", 4))
+UPLOAD_MAX_PENDING = int(os.environ.get("UPLOAD_MAX_PENDING", 64))
+REPORT_WORKERS = int(os.environ.get("REPORT_WORKERS", 2))
+REPORT_JOBS_STORAGE_PATH = os.environ.get("REPORT_JOBS_STORAGE_PATH", "report-jobs")  # shared by the workers
+BATCH_ENDPOINT_MAX_FILES = int(os.environ.get("BATCH_ENDPOINT_MAX_FILES", 256))
+BATCH_ENDPOINT_MAX_BYTES = int(os.environ.get("BATCH_ENDPOINT_MAX_BYTES", 512 * 2 ** 20))  # of images, uncompressed
+PREDICTION_CACHE_SIZE = int(os.environ.get("PREDICTION_CACHE_SIZE", 4096))
+PREDICTION_CACHE_TTL = float(os.environ.get("PREDICTION_CACHE_TTL", 0)) or None  # seconds, never expire if 0
+PREDICTION_CACHE_PATH = os.environ.get("PREDICTION_CACHE_PATH")  # sqlite file shared between workers, optional
+GRADCAM_MODEL_PATH = os.environ.get("GRADCAM_MODEL_PATH")  # keras model to explain, gradCamImageUrl is off if not set
+GRADCAM_PRECOMPUTE = os.environ.get("GRADCAM_PRECOMPUTE", "true").lower() == "true"
+GRADCAM_IMAGE_SIZE = int(os.environ.get("GRADCAM_IMAGE_SIZE", 256))
+GRADCAM_CACHE_SIZE = int(os.environ.get("GRADCAM_CACHE_SIZE", 1024))
+GRADCAM_MAX_PENDING = int(os.environ.get("GRADCAM_MAX_PENDING", 256))  # beyond it overlays are generated on request
+GRADCAM_THREADS = int(os.environ.get("GRADCAM_THREADS", 1))  # tensorflow threads, leaves the other cores to inference
+GRADCAM_STORAGE_PATH = Path(os.environ.get("GRADCAM_STORAGE_PATH", "gradcam"))  # shared by the workers
+GRADCAM_BASE_URL = os.environ.get("GRADCAM_BASE_URL", "").rstrip("/")  # public api url, from requests if unset
+
+stage_seconds = Histogram(
+    "molo_stage_seconds",
+    "Time spent in each stage of the prediction endpoints. read, storage and cache are timed per request, "
+    "decode and preprocess per image, queue_wait and inference per batch.",
+    ("backend", "stage"), registry=metrics_registry, buckets=metrics.DEFAULT_BUCKETS
+)
+predicted_images = Counter(
+    "molo_predicted_images", "Images predicted by the model or answered from the cache", ("backend", "outcome"),
+    registry=metrics_registry
+)
+prediction_errors = Counter(
+    "molo_prediction_errors", "Prediction requests that failed", ("backend", "endpoint"), registry=metrics_registry
+)
+predictions_in_flight = Gauge(
+    "molo_prediction_requests_in_flight", "Prediction requests being handled", ("backend", ),
+    registry=metrics_registry
+)
+batch_sizes = Histogram(
+    "molo_batch_size", "Number of images per inference batch", ("backend", ), registry=metrics_registry,
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256)
+)
+upload_seconds = Histogram(
+    "molo_upload_seconds", "Duration of the background uploads of images to storage", ("outcome", ),
+    registry=metrics_registry, buckets=metrics.DEFAULT_BUCKETS
+)
+
+
+def observe_batch(
+        backend: str,
+        batch_size: int,
+        wait_time: float,
+        inference_time: float
+):
+    batch_sizes.labels(backend=backend).observe(batch_size)
+    stage_seconds.labels(backend=backend, stage="queue_wait").observe(wait_time)
+    stage_seconds.labels(backend=backend, stage="inference").observe(inference_time)
+
+
+def observe_upload(
+        duration: float,
+        succeeded: bool
+):
+    upload_seconds.labels(outcome="ok" if succeeded else "error").observe(duration)
+
+
+# the same scans get uploaded again and again, e.g. when regenerating reports
+prediction_cache = cache_utils.PredictionCache(
+    memory_max_entries=PREDICTION_CACHE_SIZE, ttl=PREDICTION_CACHE_TTL, disk_path=PREDICTION_CACHE_PATH
+)
+
+# uploaded images are persisted in the background, off the prediction path
+uploader = storage_utils.BackgroundUploader(
+    storage_utils.get_storage_backend(), max_workers=UPLOAD_WORKERS, max_pending=UPLOAD_MAX_PENDING,
+    on_upload=observe_upload
+)
+
+# pdf reports are rendered in worker processes, off the event loop and away from inference.
+# The status of the jobs is kept in storage, so that any worker of the server can answer the polls
+report_jobs = reports.ReportJobQueue(
+    max_workers=REPORT_WORKERS, storage_backend=uploader.backend, storage_path=REPORT_JOBS_STORAGE_PATH
+)
+
+# backends are registered once at startup, concurrent requests to the same backend
+# are grouped into a single batched inference call by its batcher
+backends: Dict[str, prediction_backends.PredictionBackend] = {}
+batchers: Dict[str, MicroBatcher] = {}
+
+# grad-cam needs gradients, so it runs its own copy of the model in tensorflow, whatever backend predicted
+gradcam_service: Optional[GradCamService] = None
+
+# state kept by the other components, read when /metrics is scraped
+metrics.register_function(
+    metrics_registry, "molo_batch_queue_depth", "Requests waiting for a batch", lambda: {
+        (name, ): batcher.queue_depth for name, batcher in batchers.items()
+    }, labelnames=("backend", )
+)
+metrics.register_function(
+    metrics_registry, "molo_uploads_pending", "Queued and running uploads", lambda: uploader.pending_uploads
+)
+metrics.register_function(
+    metrics_registry, "molo_uploads_failed", "Uploads that failed", lambda: uploader.failed_uploads, kind="counter"
+)
+metrics.register_function(
+    metrics_registry, "molo_prediction_cache_lookups", "Prediction cache lookups by result", lambda: {
+        ("memory_hit", ): prediction_cache.memory_hits, ("disk_hit", ): prediction_cache.disk_hits,
+        ("miss", ): prediction_cache.misses
+    }, kind="counter", labelnames=("result", )
+)
+metrics.register_function(
+    metrics_registry, "molo_report_jobs", "Report jobs kept by the report queue, by status", lambda: {
+        (status, ): sum(job["status"] == status for job in list(report_jobs.jobs.values()))
+        for status in ("pending", "done", "failed")
+    }, labelnames=("status", )
+)
+
+
+@functools.lru_cache(maxsize=None)
+def get_gradcam():
+    from utils import gradcam_utils
+    return gradcam_utils.load_gradcam(GRADCAM_MODEL_PATH, num_threads=GRADCAM_THREADS)
+
+
+def explain_images(
+        images_bytes: Sequence[bytes]
+) -> List[bytes]:
+    return get_gradcam().explain_images(
+        images_bytes, (GRADCAM_IMAGE_SIZE, GRADCAM_IMAGE_SIZE), reduced_decode=REDUCED_DECODE
+    )
+
+
+async def save_gradcam_overlay(
+        key: str,
+        overlay: bytes
+):
+    await uploader.submit(overlay, str(GRADCAM_STORAGE_PATH / f"{key}.jpg"), content_type="image/jpeg")
+
+
+async def load_gradcam_overlay(
+        key: str
+) -> Optional[bytes]:
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, uploader.backend.download_bytes, str(GRADCAM_STORAGE_PATH / f"{key}.jpg"))
+
+
+def get_base_url(
+        request: Request
+) -> str:
+    """
+    Returns the public url of the api, which the frontend is not served from
+    :param request:
+    :return:
+    """
+    return GRADCAM_BASE_URL or str(request.base_url).rstrip("/")
+
+
+def register_gradcam(
+        image_bytes: bytes,
+        base_url: str
+) -> Optional[str]:
+    """
+    Registers an image for explanation and returns the url its Grad-CAM overlay is served at
+    :param image_bytes:
+    :param base_url: see get_base_url
+    :return: None if Grad-CAM is not enabled
+    """
+    if gradcam_service is None:
+        return None
+
+    key = cache_utils.hash_bytes(image_bytes)
+    gradcam_service.register(key, image_bytes)
+    return f"{base_url}/gradcam/{key}"
+
+
+async def warmup_backend(
+        name: str,
+        backend: prediction_backends.PredictionBackend
+):
+    try:
+        await backend.warmup()
+    except Exception as e:
+        logging.warning(f"Could not warm up the {name} backend: {e}")
+
+
+@app.on_event("startup")
+async def startup():
+    # heavy resources (tensorflow, interpreters, cloud clients) are created here rather than at import,
+    # and the backends warm up concurrently
+    backends.update(prediction_backends.create_backends(image_size=IMG_SIZE))
+    for name, backend in backends.items():
+        batchers[name] = MicroBatcher(
+            backend.predict_batch, max_batch_size=BATCH_MAX_SIZE, max_wait_ms=BATCH_MAX_WAIT_MS,
+            max_concurrent_batches=BATCH_MAX_CONCURRENT or backend.max_concurrent_batches, name=name,
+            on_batch=functools.partial(observe_batch, name), max_queue_size=BATCH_MAX_QUEUE_SIZE
+        )
+    await asyncio.gather(*[warmup_backend(name, backend) for name, backend in backends.items()])
+
+    global gradcam_service
+    if GRADCAM_MODEL_PATH:
+        gradcam_service = GradCamService(
+            explain_images, cache_size=GRADCAM_CACHE_SIZE, precompute=GRADCAM_PRECOMPUTE,
+            max_pending=GRADCAM_MAX_PENDING, save_overlay=save_gradcam_overlay, load_overlay=load_gradcam_overlay,
+            on_batch=functools.partial(observe_batch, "gradcam")
+        )
+        # the model is loaded on the grad-cam thread, startup does not wait for it
+        gradcam_service.executor.submit(get_gradcam)
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    for batcher in batchers.values():
+        await batcher.close()
+    for backend in backends.values():
+        await backend.close()
+    if gradcam_service is not None:
+        await gradcam_service.close()
+    uploader.close(wait=True)
+    report_jobs.close(wait=True)
+    prediction_cache.close(wait=True)
 
 
 @app.get("/")
@@ -25,8 +256,110 @@ async def home():
     return {"status": "ok"}
 
 
+@app.get("/metrics/batching")
+async def batching_metrics_endpoint():
+    """
+    Per-backend batch size, queue wait time and inference time metrics
+    :return:
+    """
+    return {name: batcher.get_metrics() for name, batcher in batchers.items()}
+
+
+@app.get("/metrics/cache")
+async def cache_metrics_endpoint():
+    """
+    Hit and miss counters of the prediction cache
+    :return:
+    """
+    return await prediction_cache.get_metrics_async()
+
+
+def build_prediction_response(
+        filename: str,
+        image_url: str,
+        predicted_label: str,
+        confidence: float,
+        inference_time: float,
+        gradcam_url: Optional[str] = None
+) -> dict:
+    """
+    Formats a single prediction the way the frontend and the /report endpoint expect it
+    :param gradcam_url: url of the Grad-CAM overlay, the uploaded image is shown instead if there is none
+    :return:
+    """
+    return {
+        "uploadedImageUrl": image_url,
+        "gradCamImageUrl": gradcam_url or image_url,
+        "predictedLabel": predicted_label,
+        "assignedLabel": predicted_label,
+        "predictionConfidence": round(confidence, 4),
+        "filename": filename,
+        "isConfirmed": str(confidence >= CONFIDENCE_THRESHOLD).lower(),
+        "inferenceTime": round(inference_time, 4)
+    }
+
+
+def build_error_response(
+        filename: str,
+        image_url: str,
+        error: str
+) -> dict:
+    """
+    Takes the place of the prediction of a file that could not be predicted, e.g. one that is not an image
+    :return:
+    """
+    return {"uploadedImageUrl": image_url, "filename": filename, "error": error}
+
+
+async def predict_image(
+        model: str,
+        batcher: MicroBatcher,
+        file: UploadFile,
+        base_url: str
+) -> dict:
+    # read the upload once, the same bytes are used for inference and persisted in the background
+    # so that we can display the image on the frontend
+    with stage_seconds.labels(backend=model, stage="read").time():
+        contents = await file.read()
+
+    # the upload overlaps the prediction, its url is only returned once the image is available there
+    file_save_path = UPLOADED_IMAGES_GCS_PATH / storage_utils.safe_filename(file.filename)
+    upload = asyncio.ensure_future(uploader.upload(contents, str(file_save_path), content_type=file.content_type))
+
+    s = time.time()
+    with stage_seconds.labels(backend=model, stage="cache").time():
+        cache_key = prediction_cache.make_key(contents, model, await backends[model].model_version(), IMG_SIZE)
+        cached_prediction, = await prediction_cache.get_many_async([cache_key])
+
+    if cached_prediction is not None:
+        predicted_label, confidence = cached_prediction
+        predicted_images.labels(backend=model, outcome="cached").inc()
+    else:
+        # process the image to be in the right format and get model predictions, as well as the GradCam output
+        with stage_seconds.labels(backend=model, stage="decode").time():
+            img = image_utils.decode_image(contents, (IMG_SIZE, IMG_SIZE) if REDUCED_DECODE else None)
+        if img is None:
+            raise HTTPException(status_code=400, detail=f"{file.filename} is not an image that can be decoded.")
+        with stage_seconds.labels(backend=model, stage="preprocess").time():
+            img = image_utils.prepare_image_for_prediction(img, (IMG_SIZE, IMG_SIZE))
+        s = time.time()
+        scores = await batcher.predict(img)
+        predicted_label, confidence = prediction_api.scores_to_predictions(np.stack(scores))[0]
+        prediction_cache.set_in_background(cache_key, (predicted_label, confidence))
+        predicted_images.labels(backend=model, outcome="predicted").inc()
+
+    with stage_seconds.labels(backend=model, stage="storage").time():
+        image_url = await upload
+
+    # registered once the prediction is done, so that its explanation never competes with it
+    return build_prediction_response(
+        file.filename, image_url, predicted_label, confidence, time.time() - s, register_gradcam(contents, base_url)
+    )
+
+
 @app.post('/predict/{model}')
 async def predict_endpoint(
+        request: Request,
         model: str = "tf-lite",
         file: UploadFile = File(...)
 ):
@@ -35,60 +368,232 @@ async def predict_endpoint(
     :return:
     """
 
-    op_selector_map = {
-        "tf-serving": prediction_api.predict_tf_serving,
-        "tf-lite": prediction_api.predict_tf_lite,
-        "ai-platform": prediction_api.predict_ai_platform
-    }
+    batcher = batchers.get(model)
+    if not batcher:
+        raise Exception(f"Invalid model type specified. Must be one of {' '.join(list(batchers.keys()))}")
 
-    get_prediction = op_selector_map.get(model)
-    if not get_prediction:
-        raise Exception(f"Invalid model type specified. Must be one of {' '.join(list(op_selector_map.keys()))}")
+    with predictions_in_flight.labels(backend=model).track_inprogress():
+        try:
+            return await predict_image(model, batcher, file, get_base_url(request))
+        except BatcherOverloadedError as e:
+            # shed load rather than letting the queue, and the latency of every request, grow without bound
+            raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+        except HTTPException:
+            raise
+        except Exception:
+            prediction_errors.labels(backend=model, endpoint="predict").inc()
+            raise
 
-    # we need to store the file in the cloud so that we can display it on the frontend
-    file_save_path = UPLOADED_IMAGES_GCS_PATH / file.filename
-    gcs_bucket = GCS_PROJECT_BUCKET
-    blob = gcs_utils.upload_to_gcs_from_file(file.file, gcs_bucket, str(file_save_path), return_blob=True)
 
-    # get the url of the blob
-    image_url = blob.media_link
+async def predict_images(
+        model: str,
+        backend: prediction_backends.PredictionBackend,
+        files: List[UploadFile],
+        base_url: str
+) -> List[dict]:
+    uploads = []
+    total_size = 0
+    with stage_seconds.labels(backend=model, stage="read").time():
+        for file in files:
+            contents = await file.read()
+            # archives are checked against what is left of the limits while they are extracted
+            try:
+                archive_members = image_utils.extract_images_from_archive(
+                    file.filename, contents, max_files=BATCH_ENDPOINT_MAX_FILES - len(uploads),
+                    max_total_size=BATCH_ENDPOINT_MAX_BYTES - total_size
+                )
+            except image_utils.ArchiveLimitExceeded as e:
+                raise HTTPException(
+                    status_code=413,
+                    detail=f"At most {BATCH_ENDPOINT_MAX_FILES} images and {BATCH_ENDPOINT_MAX_BYTES} bytes of "
+                           f"images per request. {e}"
+                )
 
-    # process the image to be in the right format and get model predictions, as well as the GradCam output
-    img = image_utils.bytes_to_numpy_array(blob.download_as_bytes())
-    img = image_utils.prepare_image_for_prediction(img, reshape_size=(IMG_SIZE, IMG_SIZE))
+            if archive_members is None:
+                uploads.append((file.filename, contents, file.content_type))
+            else:
+                uploads.extend((filename, data, None) for filename, data in archive_members)
+            total_size += len(contents) if archive_members is None else sum(len(data) for _, data in archive_members)
 
-    s = time.time()
-    predicted_label, confidence = get_prediction(img)
+            if len(uploads) > BATCH_ENDPOINT_MAX_FILES or total_size > BATCH_ENDPOINT_MAX_BYTES:
+                raise HTTPException(
+                    status_code=413,
+                    detail=f"At most {BATCH_ENDPOINT_MAX_FILES} images and {BATCH_ENDPOINT_MAX_BYTES} bytes of "
+                           f"images per request."
+                )
+
+    # the uploads overlap the predictions, their urls are only returned once the images are available there
+    image_uploads = asyncio.gather(*[
+        uploader.upload(
+            data, str(UPLOADED_IMAGES_GCS_PATH / storage_utils.safe_filename(filename)), content_type=content_type
+        )
+        for filename, data, content_type in uploads
+    ])
+
+    # only the images that are not in the cache are decoded and sent to the model
+    with stage_seconds.labels(backend=model, stage="cache").time():
+        model_version = await backend.model_version()
+        cache_keys = [prediction_cache.make_key(data, model, model_version, IMG_SIZE) for _, data, _ in uploads]
+        predictions = await prediction_cache.get_many_async(cache_keys)
+    missing = [i for i, prediction in enumerate(predictions) if prediction is None]
+    predicted_images.labels(backend=model, outcome="cached").inc(len(uploads) - len(missing))
+
+    inference_time = 0.
+    if missing:
+        # decoding releases the GIL, so images are decoded and resized in parallel, straight into the batch
+        loop = asyncio.get_event_loop()
+        inputs = np.empty((len(missing), IMG_SIZE, IMG_SIZE, 3), dtype=np.float32)
+        decode_timer = stage_seconds.labels(backend=model, stage="decode")
+        preprocess_timer = stage_seconds.labels(backend=model, stage="preprocess")
+
+        def _prepare(i: int, image_bytes: bytes) -> bool:
+            with decode_timer.time():
+                img = image_utils.decode_image(image_bytes, (IMG_SIZE, IMG_SIZE) if REDUCED_DECODE else None)
+            if img is None:
+                return False
+            with preprocess_timer.time():
+                image_utils.get_image_preprocessor((IMG_SIZE, IMG_SIZE)).prepare([img], out=inputs[i:i + 1])
+            return True
+
+        decoded = await asyncio.gather(
+            *[loop.run_in_executor(None, _prepare, i, uploads[j][1]) for i, j in enumerate(missing)]
+        )
+        # files that are not images get an error entry instead of failing the whole batch
+        if not all(decoded):
+            inputs = inputs[np.asarray(decoded)]
+            missing = [j for j, ok in zip(missing, decoded) if ok]
+            predicted_images.labels(backend=model, outcome="undecodable").inc(len(decoded) - len(missing))
+
+    if missing:
+        s = time.time()
+        new_predictions = prediction_api.scores_to_predictions(await backend.predict_batch(inputs))
+        inference_time = time.time() - s
+        batch_sizes.labels(backend=model).observe(len(missing))
+        stage_seconds.labels(backend=model, stage="inference").observe(inference_time)
+        predicted_images.labels(backend=model, outcome="predicted").inc(len(missing))
+
+        for j, prediction in zip(missing, new_predictions):
+            predictions[j] = prediction
+            prediction_cache.set_in_background(cache_keys[j], prediction)
+
+    with stage_seconds.labels(backend=model, stage="storage").time():
+        image_urls = await image_uploads
+
+    return [
+        build_error_response(filename, image_url, "Not an image that can be decoded.") if prediction is None else
+        build_prediction_response(
+            filename, image_url, prediction[0], prediction[1], inference_time, register_gradcam(data, base_url)
+        )
+        for (filename, data, _), image_url, prediction in zip(uploads, image_urls, predictions)
+    ]
 
-    response = {
-        "uploadedImageUrl": image_url,
-        "gradCamImageUrl": image_url,
-        "predictedLabel": predicted_label,
-        "assignedLabel": predicted_label,
-        "predictionConfidence": round(confidence, 4),
-        "filename": file.filename,
-        "isConfirmed": str(confidence >= CONFIDENCE_THRESHOLD).lower(),
-        "inferenceTime": round(time.time() - s, 4)
-    }
 
-    return response
+@app.post('/predict/batch/{model}')
+async def predict_batch_endpoint(
+        request: Request,
+        model: str = "tf-lite",
+        files: List[UploadFile] = File(...)
+):
+    """
+    Predicts a whole session of scans in one request. Accepts several image files and/or zip and tar archives of
+    images. Returns a list with one entry per image, in the same format as the single image endpoint.
+    :return:
+    """
+
+    backend = backends.get(model)
+    if not backend:
+        raise Exception(f"Invalid model type specified. Must be one of {' '.join(list(backends.keys()))}")
+
+    with predictions_in_flight.labels(backend=model).track_inprogress():
+        try:
+            return await predict_images(model, backend, files, get_base_url(request))
+        except HTTPException:
+            raise
+        except Exception:
+            prediction_errors.labels(backend=model, endpoint="predict_batch").inc()
+            raise
+
 
+@app.get('/gradcam/{key}')
+async def gradcam_endpoint(
+        key: str
+):
+    """
+    Grad-CAM overlay of a predicted image, as linked in gradCamImageUrl. Waits for the overlay if it is still
+    being generated. Overlays are saved to storage, so any worker can return them once they are generated.
+    :param key:
+    :return:
+    """
+    # keys are image hashes, anything else could reach other objects in storage
+    valid_key = re.fullmatch(r"[0-9a-f]{32}", key) is not None
+    overlay = await gradcam_service.get(key) if gradcam_service is not None and valid_key else None
+    if overlay is None:
+        raise HTTPException(status_code=404, detail=f"No Grad-CAM overlay for {key}")
+    # the key is the hash of the image, so an overlay never changes while the model stays the same
+    return Response(content=overlay, media_type="image/jpeg", headers={"Cache-Control": "public, max-age=3600"})
 
-@app.post('/report')
+
+@app.post('/report', status_code=202)
 async def generate_pdf_report_endpoint(
-        data: GeneratePDFReportSchema
+        data: GeneratePDFReportSchema,
+        inline: bool = False,
+        thumbnails: bool = False
 ):
-    # remove and clean up some of the fields
-    for item in data.predictionData:
-        item.pop('uploadedImageUrl', None)
-        item.pop('gradCamImageUrl', None)
-        item.pop('predictedLabel', None)
-        item.pop('isConfirmed', None)
-        item.pop('inferenceTime', None)
-        item['assigned label'] = item.pop('assignedLabel', "Null")
-        item['prediction confidence'] = item.pop('predictionConfidence', 0.0)
-
-    pdf_report = PDFReport()
-    return {
-        "reportUrl":  pdf_report.generate_report(prediction_data=data.predictionData)
-    }
\ No newline at end of file
+    """
+    Queues the generation of a pdf report, poll /report/{jobId} until it is done and download it from
+    /report/{jobId}/download.
+    Rendering runs in worker processes, identical reports are only rendered once.
+    With inline=true the report is rendered right away and returned in the response instead of being stored.
+    :return:
+    """
+    if inline:
+        pdf_bytes = await report_jobs.run(reports.render_report, data.predictionData, thumbnails)
+        return Response(
+            content=pdf_bytes,
+            media_type="application/pdf",
+            headers={"Content-Disposition": 'inline; filename="oct_summary_report.pdf"'}
+        )
+
+    return report_jobs.submit(prediction_data=data.predictionData, thumbnails=thumbnails)
+
+
+@app.get('/report/{job_id}')
+async def report_status_endpoint(
+        job_id: str
+):
+    """
+    Status of a report job, and the url of the report once it is done
+    :param job_id:
+    :return:
+    """
+    job = await report_jobs.get_async(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"No report job with id {job_id}")
+    return job
+
+
+@app.get('/report/{job_id}/download')
+async def report_download_endpoint(
+        job_id: str
+):
+    """
+    The pdf of a report job that is done, read from storage so that it can be downloaded from private buckets
+    :param job_id:
+    :return:
+    """
+    job = await report_jobs.get_async(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"No report job with id {job_id}")
+    if job["status"] != "done":
+        raise HTTPException(status_code=409, detail=f"Report job {job_id} is {job['status']}")
+
+    path = uploader.backend.path_for(job["reportUrl"])
+    loop = asyncio.get_event_loop()
+    pdf_bytes = await loop.run_in_executor(None, uploader.backend.download_bytes, path) if path else None
+    if pdf_bytes is None:
+        raise HTTPException(status_code=404, detail=f"The report of job {job_id} is no longer in storage")
+    return Response(
+        content=pdf_bytes,
+        media_type="application/pdf",
+        headers={"Content-Disposition": 'attachment; filename="oct_summary_report.pdf"'}
+    )
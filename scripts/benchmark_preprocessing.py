@@ -0,0 +1,69 @@
+"""
+Micro-benchmark of the image preprocessing done before every prediction.
+Compares the keras based pipeline (smart_resize + preprocess_input) with the cv2 based ImagePreprocessor.
+"""
+import time
+from argparse import ArgumentParser
+
+import cv2
+import numpy as np
+
+from utils import image_utils
+
+
+def time_function(f, repeats: int) -> float:
+    f()  # warm up
+    s = time.perf_counter()
+    for _ in range(repeats):
+        f()
+    return (time.perf_counter() - s) / repeats
+
+
+def main(
+        image_height: int,
+        image_width: int,
+        target_size: int,
+        batch_size: int,
+        repeats: int
+):
+    rng = np.random.RandomState(0)
+    img = (rng.rand(image_height, image_width, 3) * 255).astype(np.uint8)
+    image_bytes = cv2.imencode(".jpg", img)[1].tobytes()
+    images = [img] * batch_size
+    reshape_size = (target_size, target_size)
+    preprocessor = image_utils.ImagePreprocessor(reshape_size, max_batch_size=batch_size)
+
+    timings = {
+        "keras, single image": time_function(
+            lambda: image_utils.prepare_image_for_prediction_keras(img, reshape_size), repeats),
+        "cv2, single image": time_function(
+            lambda: image_utils.prepare_image_for_prediction(img, reshape_size), repeats),
+        f"keras, batch of {batch_size}": time_function(
+            lambda: np.concatenate([image_utils.prepare_image_for_prediction_keras(i, reshape_size) for i in images]),
+            repeats),
+        f"cv2, batch of {batch_size}": time_function(
+            lambda: preprocessor.prepare(images), repeats),
+        "decode (full) + keras, single image": time_function(
+            lambda: image_utils.prepare_image_for_prediction_keras(
+                image_utils.bytes_to_numpy_array(image_bytes), reshape_size), repeats),
+        "decode + cv2, single image": time_function(
+            lambda: image_utils.prepare_image_bytes_for_prediction(image_bytes, reshape_size, reduced_decode=False),
+            repeats),
+        "reduced decode + cv2, single image": time_function(
+            lambda: image_utils.prepare_image_bytes_for_prediction(image_bytes, reshape_size), repeats),
+    }
+
+    for name, seconds in timings.items():
+        print(f"{name:<40} {seconds * 1000:10.3f} ms")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--image-height", type=int, default=496, help="Height of the synthetic input image.")
+    parser.add_argument("--image-width", type=int, default=768, help="Width of the synthetic input image.")
+    parser.add_argument("--target-size", type=int, default=80, help="Model input size (images are square).")
+    parser.add_argument("--batch-size", type=int, default=32, help="Number of images in the batch benchmarks.")
+    parser.add_argument("--repeats", type=int, default=50, help="How many times each benchmark is run.")
+
+    args = parser.parse_args()
+    main(**args.__dict__)
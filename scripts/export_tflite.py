@@ -0,0 +1,65 @@
+"""
+Exports a trained model to TF Lite in every quantization mode (float32, dynamic range, float16 and full int8),
+and writes a report comparing their accuracy and single image latency against the float model.
+int8 is calibrated on images of the train flow, the variants are evaluated on the test (or val) flow.
+"""
+import json
+from argparse import ArgumentParser
+from typing import *
+
+import tensorflow as tf
+
+from utils import generator_utils, model_utils, tflite_utils
+
+
+def main(
+        model_path: str,
+        data_path: str,
+        output_directory: str,
+        modes: List[str],
+        accuracy_budget: float,
+        calibration_images: int,
+        evaluation_images: int,
+        threads: int,
+        int8_io: bool
+):
+    model = tf.keras.models.load_model(
+        model_path, compile=False, custom_objects={"ExtendedModel": model_utils.ExtendedModel}
+    )
+
+    train_generator, generator = generator_utils.get_generator_instances()
+    flows = generator_utils.create_flows(
+        data_path, train_generator, generator, target_size=tuple(model.input_shape[1:3]), seed=0
+    )
+    if "train" not in flows or not ({"test", "val"} & set(flows)):
+        raise ValueError(f"{data_path} needs a train directory and a test or val directory")
+
+    representative_images, _ = tflite_utils.sample_flow(flows["train"], calibration_images)
+    images, labels = tflite_utils.sample_flow(flows.get("test") or flows["val"], evaluation_images)
+
+    report = tflite_utils.export_tflite_models(
+        model, output_directory, representative_images, images, labels, modes, accuracy_budget, threads, int8_io
+    )
+    print(json.dumps({mode: {k: v for k, v in variant.items() if k != "filepath"}
+                      for mode, variant in report["variants"].items()}, indent=2))
+    print(f"Fastest model within the accuracy budget: {report['variants'][report['selected']]['filepath']}")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--model-path", required=True, help="Saved Keras model (SavedModel directory or h5 file).")
+    parser.add_argument("--data-path", required=True, help="Directory with train and test (or val) sub-directories.")
+    parser.add_argument("--output-directory", default="tflite", help="Where the models and the report are written.")
+    parser.add_argument("--modes", nargs="+", default=list(tflite_utils.QUANTIZATION_MODES),
+                        choices=tflite_utils.QUANTIZATION_MODES, help="Variants to export, float32 is always exported.")
+    parser.add_argument("--accuracy-budget", type=float, default=0.01,
+                        help="Allowed drop in accuracy compared to the float model, 0.01 is one point.")
+    parser.add_argument("--calibration-images", type=int, default=200, help="Train images int8 is calibrated on.")
+    parser.add_argument("--evaluation-images", type=int, default=1000, help="Images the variants are evaluated on.")
+    parser.add_argument("--threads", type=int, default=1,
+                        help="Threads per interpreter when measuring latency, like TF_LITE_NUM_THREADS.")
+    parser.add_argument("--int8-io", action="store_true",
+                        help="Also quantize the input and output of the int8 model, the server needs float32 io.")
+
+    args = parser.parse_args()
+    main(**args.__dict__)
@@ -1,7 +1,8 @@
-import os, shutil
+import os, time
 from pathlib import Path
 from collections import Counter
 from argparse import ArgumentParser
+from typing import *
 import simplejson as json
 
 # extension = "jpeg"
@@ -10,10 +11,61 @@ import simplejson as json
 # path_to_data_directory = root / data_directory_relative_path
 
 
+def emit_shards(
+        path_to_data_directory: Path,
+        path_to_shards_directory: Path,
+        subset_classes: Dict[str, List[str]],
+        class_map: Dict[str, int],
+        file_extension: str,
+        **shard_kwargs
+):
+    """
+    Writes the dataset as pre-decoded, pre-resized .npy shards plus a manifest, see utils.shard_utils
+    :param path_to_data_directory:
+    :param path_to_shards_directory:
+    :param subset_classes:
+    :param class_map:
+    :param file_extension:
+    :param shard_kwargs: passed on to shard_utils.write_shards
+    :return:
+    """
+    from utils import shard_utils
+
+    subset_files = {
+        subset: [
+            (str(path_to_data_directory / subset / class_name / file), class_map[class_name])
+            for class_name in class_names
+            for file in os.listdir(path_to_data_directory / subset / class_name) if file.endswith(file_extension)
+        ]
+        for subset, class_names in subset_classes.items()
+    }
+    class_names = sorted(class_map, key=class_map.get)
+
+    def progress(done: int, total: int):
+        print(f"Shards {done} / {total}", end="\r")
+
+    manifest = shard_utils.write_shards(
+        path_to_shards_directory, subset_files, class_names, progress=progress, **shard_kwargs
+    )
+    print()
+    for subset, subset_manifest in manifest["subsets"].items():
+        print(f"Subset {subset}: {subset_manifest['num_examples']} images in {len(subset_manifest['shards'])} shards")
+
+
 def main(
         data_root: str,
         data_relative_path: str,
-        file_extension: str
+        file_extension: str,
+        shards: bool = False,
+        skip_copy: bool = False,
+        shard_size: int = 1024,
+        target_size: int = 256,
+        channels: int = 1,
+        interpolation: str = "nearest",
+        workers: Optional[int] = None,
+        seed: int = 0,
+        mode: str = "copy",
+        verify: bool = False
 ):
     data_root = Path(data_root)
     data_relative_path = Path(data_relative_path)
@@ -39,31 +91,43 @@ def main(
     for class_name, count in counter.items():
         assert count == len(subsets), f"Class {class_name} is not present in all subsets."
 
-    # generate a class map, which maps a class name to an integer
-    class_map = {class_name: i for i, class_name in enumerate(counter.keys())}
-
-    # make the directory that will store our formatted data
+    # generate a class map, which maps a class name to an integer.
+    # An existing map is kept when the classes did not change, so that labels stay the same across runs
     path_to_new_data_directory = data_root / "processed_data" / "data"
-    if not path_to_new_data_directory.exists():
-        os.makedirs(path_to_new_data_directory)
-
-    for subset, class_names in subset_classes.items():
-        for class_name in class_names:
-            class_label = class_map[class_name]
-            new_path_ = path_to_new_data_directory / subset / str(class_label)
-            if not new_path_.exists():
-                os.makedirs(new_path_)
-
-            path_to_original_data = path_to_data_directory / subset / class_name
-            class_files = os.listdir(path_to_original_data)
-
-            for i, file in enumerate(class_files):
-                print(f"Subset {subset}, class {class_name}, file {i} / {len(class_files)}", end="\r")
-                if file.endswith(file_extension):
-                    shutil.copy(path_to_original_data / file, new_path_ / file)
-
-            print()  # add space between info prints
-        print()
+    class_map = {class_name: i for i, class_name in enumerate(counter.keys())}
+    if (path_to_new_data_directory / "formatted_data.json").exists():
+        with open(path_to_new_data_directory / "formatted_data.json") as f:
+            existing_class_map = json.load(f)
+        if set(existing_class_map) == set(class_map):
+            class_map = existing_class_map
+
+    if shards:
+        emit_shards(
+            path_to_data_directory, data_root / "processed_data" / "shards", subset_classes, class_map, file_extension,
+            target_size=(target_size, target_size), channels=channels, interpolation=interpolation,
+            shard_size=shard_size, workers=workers, seed=seed
+        )
+        if skip_copy:
+            print("Done!")
+            return
+
+    from utils import sync_utils
+
+    start = time.perf_counter()
+    files = sync_utils.scan_files(path_to_data_directory, subset_classes, class_map, file_extension)
+    print(f"Found {len(files)} files in {time.perf_counter() - start:.1f}s")
+
+    def progress(done: int, total: int):
+        print(f"Synced {done} / {total} new or changed files", end="\r")
+
+    stats = sync_utils.sync_files(
+        files, path_to_new_data_directory, mode=mode, verify=verify, workers=workers, progress=progress
+    )
+    print()
+    print(
+        f"{stats['added']} added, {stats['updated']} updated, {stats['unchanged']} unchanged, "
+        f"{stats['removed']} removed in {time.perf_counter() - start:.1f}s"
+    )
 
     # save the map as json file
     with open(path_to_new_data_directory / "formatted_data.json", "w+") as f:
@@ -77,6 +141,22 @@ if __name__ == "__main__":
     parser.add_argument("--data-root", required=True, help="Root path that contains the directory with the data.")
     parser.add_argument("--data-relative-path", required=True, help="Path to dataset relative to the root.")
     parser.add_argument("--file-extension", required=True, help="Extension of the data files.")
+    parser.add_argument("--shards", action="store_true",
+                        help="Also write pre-decoded, pre-resized .npy shards to processed_data/shards.")
+    parser.add_argument("--skip-copy", action="store_true", help="Only write the shards, do not copy the images.")
+    parser.add_argument("--shard-size", type=int, default=1024, help="Maximum number of images per shard.")
+    parser.add_argument("--target-size", type=int, default=256, help="Size the (square) images are resized to.")
+    parser.add_argument("--channels", type=int, default=1, choices=[1, 3],
+                        help="Channels stored per image, grayscale scans need 1.")
+    parser.add_argument("--interpolation", default="nearest", choices=["nearest", "linear", "area"],
+                        help="Resize method, nearest matches flow_from_directory.")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Processes writing shards and threads copying files.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the shuffle of the train images.")
+    parser.add_argument("--mode", default="copy", choices=["copy", "hardlink", "symlink"],
+                        help="How files are placed in processed_data/data. Hardlinks need the same filesystem.")
+    parser.add_argument("--verify", action="store_true",
+                        help="Hash every file, not only the ones whose size or modification time changed.")
 
     args = parser.parse_args()
     main(**args.__dict__)
@@ -0,0 +1,9 @@
+import sys
+from pathlib import Path
+
+# the app and the utilities package are not installed when running the tests from the repo root.
+# molo goes first, as in the app container, so that its helpers package shadows the one in utilities
+ROOT = Path(__file__).resolve().parent.parent
+for path in (ROOT / "utilities", ROOT / "molo"):
+    if path.is_dir() and str(path) not in sys.path:
+        sys.path.insert(0, str(path))
@@ -0,0 +1,54 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+ai_platform_utils = pytest.importorskip("utils.ai_platform_utils")
+fake_ai_platform = pytest.importorskip("utils.fake_ai_platform")
+
+
+def test_large_batches_are_split_below_the_payload_limit(tmp_path, monkeypatch):
+    monkeypatch.setattr(ai_platform_utils.AIPlatformClient, "_discovery_documents", {})
+    instances = np.random.rand(12, 16, 16, 3).round(3).tolist()
+    discovery_cache_path = str(tmp_path / "ml.v1.json")
+
+    with fake_ai_platform.FakeAIPlatformServer(max_payload_bytes=20_000) as server:
+        client = ai_platform_utils.AIPlatformClient(
+            "project", api_endpoint=server.api_endpoint, discovery_cache_path=discovery_cache_path,
+            max_payload_bytes=server.max_payload_bytes
+        )
+        predictions = client.predict("model", instances, version="v1")
+        assert server.predict_calls == len(client.split_instances(instances)) > 1
+        assert server.rejected_calls == 0
+
+        client.max_payload_bytes = 10 ** 7
+        with pytest.raises(Exception):
+            client.predict("model", instances)
+
+    assert np.allclose(predictions, server.predict(instances))
+    assert (tmp_path / "ml.v1.json").exists()
+
+
+def test_instances_are_serialized_once(tmp_path, monkeypatch):
+    monkeypatch.setattr(ai_platform_utils.AIPlatformClient, "_discovery_documents", {})
+    instances = np.random.rand(12, 16, 16, 3).round(3).tolist()
+    dumps_calls = []
+    dumps = ai_platform_utils.json.dumps
+
+    def record(value, *args, **kwargs):
+        dumps_calls.append(value)
+        return dumps(value, *args, **kwargs)
+
+    with fake_ai_platform.FakeAIPlatformServer(max_payload_bytes=20_000) as server:
+        client = ai_platform_utils.AIPlatformClient(
+            "project", api_endpoint=server.api_endpoint, discovery_cache_path=str(tmp_path / "ml.v1.json"),
+            max_payload_bytes=server.max_payload_bytes
+        )
+        client.get_service()
+        monkeypatch.setattr(ai_platform_utils.json, "dumps", record)
+        predictions = client.predict("model", instances)
+
+        assert server.predict_calls > 1
+        assert server.rejected_calls == 0
+
+    # the fake server answers with the same json module
+    assert sorted(id(value) for value in dumps_calls if isinstance(value, list)) == sorted(map(id, instances))
+    assert np.allclose(predictions, server.predict(instances))
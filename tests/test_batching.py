@@ -0,0 +1,93 @@
+import asyncio
+
+import pytest
+
+np = pytest.importorskip("numpy")
+batching = pytest.importorskip("helpers.batching")
+
+
+def test_concurrent_requests_are_batched():
+    batch_sizes = []
+
+    def predict_batch(inputs):
+        batch_sizes.append(len(inputs))
+        return [float(x.sum()) for x in inputs]
+
+    async def run():
+        batcher = batching.MicroBatcher(predict_batch, max_batch_size=4, max_wait_ms=50)
+        results = await asyncio.gather(*[batcher.predict(np.full((1, 2), i)) for i in range(6)])
+        metrics = batcher.get_metrics()
+        await batcher.close()
+        return results, metrics
+
+    results, metrics = asyncio.run(run())
+
+    assert results == [[2. * i] for i in range(6)]
+    assert batch_sizes == [4, 2]
+    assert metrics["totalBatches"] == 2
+    assert metrics["totalItems"] == 6
+
+
+def test_errors_are_propagated_to_every_request():
+    def predict_batch(inputs):
+        raise ValueError("boom")
+
+    async def run():
+        batcher = batching.MicroBatcher(predict_batch, max_batch_size=4, max_wait_ms=1)
+        results = await asyncio.gather(
+            batcher.predict(np.zeros((1, 2))), batcher.predict(np.zeros((1, 2))), return_exceptions=True
+        )
+        await batcher.close()
+        return results
+
+    assert all(isinstance(r, ValueError) for r in asyncio.run(run()))
+
+
+def test_requests_beyond_the_queue_size_are_rejected():
+    release = asyncio.Event()
+
+    async def predict_batch(inputs):
+        await release.wait()
+        return list(inputs)
+
+    async def run():
+        batcher = batching.MicroBatcher(
+            predict_batch, max_batch_size=1, max_wait_ms=0, max_concurrent_batches=2, max_queue_size=1
+        )
+        # two batches run, the next one waits for a slot, one request waits in the queue and the fifth is rejected
+        requests = []
+        for i in range(4):
+            requests.append(asyncio.ensure_future(batcher.predict(np.full((1, 2), i))))
+            await asyncio.sleep(0.01)
+        with pytest.raises(batching.BatcherOverloadedError):
+            await batcher.predict(np.zeros((1, 2)))
+        release.set()
+        results = await asyncio.gather(*requests)
+        metrics = batcher.get_metrics()
+        await batcher.close()
+        return results, metrics
+
+    results, metrics = asyncio.run(run())
+
+    assert [int(r[0][0]) for r in results] == [0, 1, 2, 3]
+    assert metrics["rejectedRequests"] == 1 and metrics["maxConcurrentBatches"] == 2
+
+
+def test_mismatched_inputs_fail_their_batch_only():
+    def predict_batch(inputs):
+        return [float(x.sum()) for x in inputs]
+
+    async def run():
+        batcher = batching.MicroBatcher(predict_batch, max_batch_size=4, max_wait_ms=20)
+        failed = await asyncio.wait_for(asyncio.gather(
+            batcher.predict(np.zeros((1, 2))), batcher.predict(np.zeros((1, 3))), return_exceptions=True
+        ), timeout=5)
+        # the batcher keeps serving requests after the failed batch
+        result = await asyncio.wait_for(batcher.predict(np.ones((1, 2))), timeout=5)
+        await batcher.close()
+        return failed, result
+
+    failed, result = asyncio.run(run())
+
+    assert all(isinstance(e, ValueError) for e in failed)
+    assert result == [2.]
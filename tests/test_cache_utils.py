@@ -0,0 +1,124 @@
+import pytest
+
+cache_utils = pytest.importorskip("utils.cache_utils")
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = cache_utils.LRUCache(max_entries=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+    assert cache.get("c") == 3
+
+
+def test_lru_cache_expires_entries(monkeypatch):
+    now = [1000.]
+    monkeypatch.setattr(cache_utils.time, "time", lambda: now[0])
+    cache = cache_utils.LRUCache(ttl=10)
+    cache.set("a", 1)
+
+    now[0] += 5
+    assert cache.get("a") == 1
+    now[0] += 10
+    assert cache.get("a") is None
+
+
+def test_prediction_cache_falls_back_to_disk(tmp_path):
+    disk_path = str(tmp_path / "cache.sqlite")
+    key = cache_utils.PredictionCache.make_key(b"image", "tf-lite", "1", 80)
+
+    cache_utils.PredictionCache(disk_path=disk_path).set(key, ["CNV", 99.5])
+    # a second cache on the same file, as in another worker process
+    cache = cache_utils.PredictionCache(disk_path=disk_path)
+
+    assert cache.get(key) == ["CNV", 99.5]
+    assert cache.get(key) == ["CNV", 99.5]
+    assert cache.get(cache_utils.PredictionCache.make_key(b"image", "tf-lite", "2", 80)) is None
+    assert cache.get_metrics()["diskHits"] == 1
+    assert cache.get_metrics()["memoryHits"] == 1
+    assert cache.get_metrics()["misses"] == 1
+
+
+def test_async_methods_keep_disk_io_off_the_event_loop(tmp_path, monkeypatch):
+    import asyncio
+    import threading
+
+    disk_threads = []
+    for name in ("get", "set"):
+        method = getattr(cache_utils.SQLiteCache, name)
+
+        def record(self, *args, method=method):
+            disk_threads.append(threading.current_thread().name)
+            return method(self, *args)
+
+        monkeypatch.setattr(cache_utils.SQLiteCache, name, record)
+
+    disk_path = str(tmp_path / "cache.sqlite")
+    keys = [cache_utils.PredictionCache.make_key(data, "tf-lite", "1", 80) for data in (b"a", b"b", b"c")]
+
+    async def run():
+        writer = cache_utils.PredictionCache(disk_path=disk_path)
+        writer.set_in_background(keys[0], ["CNV", 99.5])
+        writer.close(wait=True)
+
+        cache = cache_utils.PredictionCache(disk_path=disk_path)
+        try:
+            first = await cache.get_many_async(keys[:2])
+            second = await cache.get_many_async(keys)
+            return first, second, cache.get_metrics()
+        finally:
+            cache.close()
+
+    first, second, metrics = asyncio.run(run())
+
+    assert first == [["CNV", 99.5], None]
+    assert second == [["CNV", 99.5], None, None]
+    assert (metrics["diskHits"], metrics["memoryHits"], metrics["misses"]) == (1, 1, 3)
+    assert disk_threads and all(name.startswith("prediction-cache") for name in disk_threads)
+
+
+def test_sqlite_cache_evicts_on_the_writes_of_every_process(tmp_path, monkeypatch):
+    now = [1000.]
+    monkeypatch.setattr(cache_utils.time, "time", lambda: now[0])
+    monkeypatch.setattr(cache_utils.SQLiteCache, "EVICT_EVERY", 4)
+    disk_path = str(tmp_path / "cache.sqlite")
+    # two caches on the same file, as in two worker processes, each writing less often than EVICT_EVERY
+    caches = [cache_utils.SQLiteCache(disk_path, max_entries=2, ttl=10) for _ in range(2)]
+
+    for i in range(3):
+        caches[i % 2].set(f"old-{i}", i)
+        now[0] += 1
+    now[0] += 20
+    caches[1].set("new", 3)
+
+    # the fourth write evicted the expired entries, whichever process made it
+    assert len(caches[0]) == 1
+    assert caches[0].get("new") == 3
+
+
+def test_get_metrics_async_counts_disk_entries_off_the_event_loop(tmp_path, monkeypatch):
+    import asyncio
+    import threading
+
+    threads = []
+    length = cache_utils.SQLiteCache.__len__
+
+    def record(self):
+        threads.append(threading.current_thread().name)
+        return length(self)
+
+    monkeypatch.setattr(cache_utils.SQLiteCache, "__len__", record)
+    cache = cache_utils.PredictionCache(disk_path=str(tmp_path / "cache.sqlite"))
+    cache.set("a", 1)
+
+    try:
+        metrics = asyncio.run(cache.get_metrics_async())
+    finally:
+        cache.close()
+
+    assert (metrics["memoryEntries"], metrics["diskEntries"]) == (1, 1)
+    assert threads and all(name.startswith("prediction-cache") for name in threads)
@@ -0,0 +1,67 @@
+import os
+import threading
+
+import pytest
+
+np = pytest.importorskip("numpy")
+tf = pytest.importorskip("tensorflow")
+pytest.importorskip("google.cloud.storage")
+from callbacks.callbacks import ArtifactUploader, MachineLearningExperimentTracking, ThroughputProfiler
+
+
+class FakeBucket:
+    def __init__(self):
+        self.objects = set()
+        self.lock = threading.Lock()
+
+    def blob(self, name):
+        bucket = self
+
+        class Blob:
+            def upload_from_filename(self, filepath):
+                assert os.path.exists(filepath)
+                with bucket.lock:
+                    bucket.objects.add(name)
+
+            def delete(self):
+                with bucket.lock:
+                    bucket.objects.remove(name)
+
+        return Blob()
+
+
+def test_best_weights_are_checkpointed_in_the_background(tmp_path):
+    model = tf.keras.Sequential([tf.keras.Input((4, )), tf.keras.layers.Dense(1)], name="model")
+    model.compile("sgd", "mse")
+    bucket = FakeBucket()
+    callback = MachineLearningExperimentTracking(
+        "experiment", monitor="loss", mode="min", store_data_in_gcs=False, checkpoint_interval=0,
+        keep_checkpoints=2, checkpoint_directory=str(tmp_path)
+    )
+    callback.uploader = ArtifactUploader(bucket, "experiments/experiment/run")
+
+    x = np.random.rand(64, 4)
+    model.fit(x, x.sum(axis=1), epochs=5, verbose=0, callbacks=[callback])
+
+    assert len(os.listdir(tmp_path)) == 2
+    assert bucket.objects == {f"experiments/experiment/run/checkpoints/{f}" for f in os.listdir(tmp_path)}
+    restored = tf.keras.models.clone_model(model)
+    MachineLearningExperimentTracking.load_checkpoint(restored, str(tmp_path / sorted(os.listdir(tmp_path))[-1]))
+    for restored_weights, best_weights in zip(restored.get_weights(), callback.best_weights):
+        np.testing.assert_array_equal(restored_weights, best_weights)
+
+
+def test_throughput_profiler_summarizes_every_epoch():
+    model = tf.keras.Sequential([tf.keras.Input((4, )), tf.keras.layers.Dense(1)])
+    model.compile("sgd", "mse")
+    x = np.random.rand(64, 4).astype("float32")
+    profiler = ThroughputProfiler()
+
+    dataset = tf.data.Dataset.from_tensor_slices((x, x.sum(axis=1))).batch(8).prefetch(1)
+    model.fit(profiler.instrument(dataset), epochs=2, verbose=0, callbacks=[profiler])
+    epoch = profiler.summary["epochs"][-1]
+
+    assert len(profiler.summary["epochs"]) == 2 and epoch["steps"] == 8
+    assert epoch["step_time"]["p50"] > 0 and sum(epoch["step_time"]["histogram"]["counts"]) == 8
+    assert 0 <= epoch["input_wait_fraction"] <= 1
+    assert epoch["epoch_images_per_second"] > 0
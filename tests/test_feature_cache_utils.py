@@ -0,0 +1,68 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+cv2 = pytest.importorskip("cv2")
+tf = pytest.importorskip("tensorflow")
+feature_cache_utils = pytest.importorskip("utils.feature_cache_utils")
+from utils import generator_utils, model_utils
+
+
+@pytest.fixture
+def data_directory(tmp_path):
+    for subset in ("train", "val"):
+        for label in ("CNV", "NORMAL"):
+            (tmp_path / subset / label).mkdir(parents=True)
+            for i in range(3):
+                cv2.imwrite(str(tmp_path / subset / label / f"{label}-{i}.jpeg"), np.full((40, 40), 80 * i, np.uint8))
+    return tmp_path
+
+
+def test_head_trained_on_cached_features_matches_the_full_model(data_directory, tmp_path, monkeypatch):
+    model = model_utils.get_pre_trained_model("vgg16", (32, 32, 3), weights=None, num_classes=2)
+    backbone = tf.keras.Model(model.input, model.layers[-3].output)
+    features, labels, meta = feature_cache_utils.extract_features(
+        data_directory / "val", tmp_path / "cache", "vgg16", (32, 32, 3), weights=None, backbone=backbone
+    )
+    head = model_utils.get_classification_head((512, ), num_classes=2)
+    kernel, bias = head.layers[-1].get_weights()
+    head.layers[-1].set_weights([kernel * 1000, bias])
+    model_utils.load_head_weights(model, head)
+
+    val = generator_utils.create_dataset(data_directory / "val", target_size=(32, 32), shuffle=False)
+    assert features.shape == (6, 512) and labels.tolist() == [0, 0, 0, 1, 1, 1]
+    assert meta["class_names"] == ["CNV", "NORMAL"]
+    np.testing.assert_allclose(head.predict(np.asarray(features)), model.predict(val), atol=1e-5)
+
+
+def test_features_are_computed_once(data_directory, tmp_path, monkeypatch):
+    kwargs = dict(base_model="vgg16", input_shape=(32, 32, 3), weights=None, batch_size=4)
+    feature_cache_utils.create_feature_datasets(data_directory, tmp_path / "cache", **kwargs)
+
+    monkeypatch.setattr(model_utils, "get_backbone", None)
+    datasets = feature_cache_utils.create_feature_datasets(data_directory, tmp_path / "cache", **kwargs)
+    features, labels = next(iter(datasets["val"]))
+
+    assert set(datasets) == {"train", "val"}
+    assert features.shape == (4, 512) and labels.shape == (4, 2)
+    assert sum(len(batch[1]) for batch in datasets["train"]) == 6
+
+
+def test_feature_datasets_stream_the_cache(data_directory, tmp_path):
+    kwargs = dict(base_model="vgg16", input_shape=(32, 32, 3), weights=None, batch_size=4, class_mode="sparse")
+    datasets = feature_cache_utils.create_feature_datasets(data_directory, tmp_path / "cache", seed=0, **kwargs)
+    features, labels, _ = feature_cache_utils.extract_features(
+        data_directory / "val", tmp_path / "cache", "vgg16", (32, 32, 3), weights=None
+    )
+
+    val_features = np.concatenate([batch[0].numpy() for batch in datasets["val"]])
+    val_labels = np.concatenate([batch[1].numpy() for batch in datasets["val"]])
+    np.testing.assert_array_equal(val_features, features)
+    assert val_labels.tolist() == labels.tolist()
+
+    # every example once per epoch, features still paired with their labels
+    train_features, train_labels, _ = feature_cache_utils.extract_features(
+        data_directory / "train", tmp_path / "cache", "vgg16", (32, 32, 3), weights=None
+    )
+    for _ in range(2):
+        epoch = [(f.tobytes(), int(label)) for batch in datasets["train"] for f, label in zip(*map(np.asarray, batch))]
+        assert sorted(epoch) == sorted((f.tobytes(), int(label)) for f, label in zip(train_features, train_labels))
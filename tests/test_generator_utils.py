@@ -0,0 +1,56 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+cv2 = pytest.importorskip("cv2")
+pytest.importorskip("tensorflow")
+generator_utils = pytest.importorskip("utils.generator_utils")
+
+
+@pytest.fixture
+def data_directory(tmp_path):
+    for subset, n in (("train", 6), ("val", 2)):
+        for label in ("CNV", "NORMAL"):
+            (tmp_path / subset / label).mkdir(parents=True)
+            for i in range(n):
+                img = np.full((40, 50), 50 * i, dtype=np.uint8)
+                cv2.imwrite(str(tmp_path / subset / label / f"{label}-{i}.jpeg"), img)
+    return tmp_path
+
+
+def test_datasets_match_the_directory_layout(data_directory):
+    datasets = generator_utils.create_datasets(
+        data_directory, target_size=(32, 32), batch_size=4, seed=0, horizontal_flip=True, cache=True, epochs=3
+    )
+    images, labels = next(iter(datasets["val"]))
+
+    assert set(datasets) == {"train", "val"}
+    assert images.shape == (4, 32, 32, 3) and labels.shape == (4, 2)
+    assert 0.0 <= float(images.numpy().min()) and float(images.numpy().max()) <= 1.0
+    assert labels.numpy().argmax(axis=1).tolist() == [0, 0, 1, 1]
+    for epoch in range(2):
+        assert sum(len(batch[1]) for batch in datasets["train"]) == 12
+
+
+def test_shards_split_the_files_evenly(data_directory):
+    shards = [
+        generator_utils.create_dataset(
+            data_directory / "train", target_size=(8, 8), class_mode="sparse", shuffle=False,
+            num_shards=3, shard_index=i
+        )
+        for i in range(3)
+    ]
+    sizes = [sum(len(labels) for _, labels in shard) for shard in shards]
+
+    assert sizes == [4, 4, 4]
+
+
+def test_cached_datasets_mix_the_classes(data_directory):
+    dataset = generator_utils.create_dataset(
+        data_directory / "train", target_size=(8, 8), batch_size=6, class_mode="sparse", seed=0, cache=True,
+        shuffle_buffer_size=1
+    )
+    epochs = [[labels.numpy().tolist() for _, labels in dataset] for _ in range(2)]
+
+    # the files are listed class by class, so without shuffling them the first batch would only hold CNV images
+    assert len(set(epochs[0][0])) == 2
+    assert sorted(sum(epochs[1], [])) == [0] * 6 + [1] * 6
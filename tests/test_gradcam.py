@@ -0,0 +1,63 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("numpy")
+gradcam = pytest.importorskip("helpers.gradcam")
+
+
+def test_overlays_are_generated_once_per_image():
+    batches = []
+
+    def explain_batch(images_bytes):
+        batches.append(list(images_bytes))
+        return [b"overlay of " + image_bytes for image_bytes in images_bytes]
+
+    async def run():
+        service = gradcam.GradCamService(explain_batch, max_wait_ms=20, precompute=False)
+        service.register("a", b"a")
+        service.register("b", b"b")
+        overlays = await asyncio.gather(service.get("a"), service.get("b"), service.get("a"))
+        again = await service.get("a")
+        unknown = await service.get("c")
+        await service.close()
+        return overlays, again, unknown
+
+    overlays, again, unknown = asyncio.run(run())
+
+    assert overlays == [b"overlay of a", b"overlay of b", b"overlay of a"]
+    assert again == b"overlay of a" and unknown is None
+    assert batches == [[b"a", b"b"]]
+
+
+def test_overlays_are_shared_through_storage_and_precompute_is_bounded():
+    storage = {}
+
+    async def save_overlay(key, overlay):
+        storage[key] = overlay
+
+    async def load_overlay(key):
+        return storage.get(key)
+
+    def explain_batch(images_bytes):
+        return [b"overlay of " + image_bytes for image_bytes in images_bytes]
+
+    async def run():
+        service = gradcam.GradCamService(
+            explain_batch, precompute=True, max_pending=1, save_overlay=save_overlay, load_overlay=load_overlay
+        )
+        # another worker of the server, which only has the storage in common with the first one
+        other = gradcam.GradCamService(explain_batch, load_overlay=load_overlay)
+        service.register("a", b"a")
+        service.register("b", b"b")
+        pending = set(service._pending)
+        overlays = [await service.get("a"), await other.get("a"), await other.get("b"), await service.get("b")]
+        await service.close()
+        await other.close()
+        return pending, overlays
+
+    pending, overlays = asyncio.run(run())
+
+    assert pending == {"a"}
+    assert overlays == [b"overlay of a", b"overlay of a", None, b"overlay of b"]
+    assert storage == {"a": b"overlay of a", "b": b"overlay of b"}
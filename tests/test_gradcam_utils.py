@@ -0,0 +1,34 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+cv2 = pytest.importorskip("cv2")
+tf = pytest.importorskip("tensorflow")
+gradcam_utils = pytest.importorskip("utils.gradcam_utils")
+from utils import model_utils
+
+
+def test_batched_heatmaps_match_single_images():
+    model = model_utils.get_pre_trained_model("vgg16", (32, 32, 3), weights=None, num_classes=4)
+    gradcam = gradcam_utils.GradCam(model)
+    images = np.random.RandomState(0).uniform(-100, 100, (4, 32, 32, 3)).astype(np.float32)
+
+    heatmaps, class_indices = gradcam.heatmaps(images)
+    single_heatmaps = np.concatenate([gradcam.heatmaps(images[i:i + 1])[0] for i in range(4)])
+
+    assert gradcam.layer_name == "block5_conv3" and heatmaps.shape == (4, 2, 2)
+    assert class_indices.tolist() == model.predict(images, verbose=0).argmax(axis=1).tolist()
+    assert heatmaps.min() >= 0 and heatmaps.max() <= 1
+    np.testing.assert_allclose(heatmaps, single_heatmaps, atol=1e-5)
+
+
+def test_overlay_colors_hot_regions():
+    images = np.full((2, 8, 8, 3), 100, dtype=np.uint8)
+    heatmaps = np.zeros((2, 8, 8), dtype=np.float32)
+    heatmaps[1] = 1
+
+    overlays = gradcam_utils.overlay_heatmaps(images, heatmaps, alpha=0.5)
+    jet = gradcam_utils.get_colormap_lut()
+
+    assert overlays.shape == images.shape and overlays.dtype == np.uint8
+    np.testing.assert_allclose(overlays[0, 0, 0], (100 + jet[0].astype(int)) / 2, atol=1)
+    np.testing.assert_allclose(overlays[1, 0, 0], (100 + jet[255].astype(int)) / 2, atol=1)
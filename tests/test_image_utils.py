@@ -0,0 +1,91 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+cv2 = pytest.importorskip("cv2")
+image_utils = pytest.importorskip("utils.image_utils")
+
+
+def _random_image(shape, seed=0):
+    rng = np.random.RandomState(seed)
+    img = (rng.rand(*shape) * 255).astype(np.uint8)
+    return cv2.GaussianBlur(img, (5, 5), 0).reshape(shape)
+
+
+@pytest.mark.parametrize("shape", [(496, 512, 3), (512, 1024, 3), (100, 60, 3), (80, 80, 3)])
+def test_prepare_image_matches_keras_pipeline(shape):
+    img = _random_image(shape)
+
+    expected = np.asarray(image_utils.prepare_image_for_prediction_keras(img, (80, 80)))
+    result = image_utils.prepare_image_for_prediction(img, (80, 80))
+
+    assert result.shape == expected.shape
+    assert result.dtype == np.float32
+    # cv2 resizes uint8 images in uint8, so values can differ by up to a rounding step
+    np.testing.assert_allclose(result, expected, atol=1.0)
+
+
+def test_grayscale_images_are_expanded_to_three_channels():
+    gray = _random_image((300, 400))
+    color = cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR)
+
+    np.testing.assert_array_equal(
+        image_utils.prepare_image_for_prediction(gray, (80, 80)),
+        image_utils.prepare_image_for_prediction(color, (80, 80))
+    )
+
+
+def test_batch_is_written_into_the_preallocated_buffer():
+    preprocessor = image_utils.ImagePreprocessor((80, 80), max_batch_size=4)
+    images = [_random_image((200, 300, 3), seed=i) for i in range(3)]
+
+    batch = preprocessor.prepare(images)
+
+    assert batch.shape == (3, 80, 80, 3)
+    assert np.shares_memory(batch, preprocessor.buffer)
+    for img, prepared in zip(images, batch):
+        np.testing.assert_array_equal(prepared, image_utils.prepare_image_for_prediction(img, (80, 80))[0])
+
+
+def test_read_jpeg_header():
+    gray = cv2.imencode(".jpg", _random_image((496, 1024)))[1].tobytes()
+    color = cv2.imencode(".jpg", _random_image((200, 300, 3)))[1].tobytes()
+    png = cv2.imencode(".png", _random_image((20, 30, 3)))[1].tobytes()
+
+    assert image_utils.read_jpeg_header(gray) == (496, 1024, 1)
+    assert image_utils.read_jpeg_header(color) == (200, 300, 3)
+    assert image_utils.read_jpeg_header(png) is None
+
+
+def test_large_jpegs_are_decoded_at_reduced_resolution():
+    gradient = np.add.outer(np.linspace(0, 127, 496), np.linspace(0, 127, 1024)).astype(np.uint8)
+    image_bytes = cv2.imencode(".jpg", gradient)[1].tobytes()
+
+    assert image_utils.get_reduced_decode_factor(496, 1024, (80, 80)) == 4
+    assert image_utils.decode_image(image_bytes).shape == (496, 1024)
+    assert image_utils.decode_image(image_bytes, (80, 80)).shape == (124, 256)
+    assert image_utils.decode_image(image_bytes, (300, 300)).shape == (496, 1024)
+
+    reduced = image_utils.prepare_image_bytes_for_prediction(image_bytes, (80, 80))
+    full = image_utils.prepare_image_bytes_for_prediction(image_bytes, (80, 80), reduced_decode=False)
+    assert reduced.shape == full.shape == (1, 80, 80, 3)
+    assert np.abs(reduced - full).mean() < 1.0
+
+
+def test_archive_limits_are_checked_before_members_are_read():
+    import io
+    import zipfile
+
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr("scans/a.jpg", b"\0" * 2 ** 20)  # compresses to about a kilobyte
+        archive.writestr("scans/b.jpg", b"b")
+        archive.writestr("README.txt", b"not an image")
+    archive_bytes = buffer.getvalue()
+
+    assert len(archive_bytes) < 2 ** 14
+    assert [name for name, _ in image_utils.extract_images_from_archive("s.zip", archive_bytes)] == ["a.jpg", "b.jpg"]
+    with pytest.raises(image_utils.ArchiveLimitExceeded):
+        image_utils.extract_images_from_archive("s.zip", archive_bytes, max_total_size=2 ** 16)
+    with pytest.raises(image_utils.ArchiveLimitExceeded):
+        image_utils.extract_images_from_archive("s.zip", archive_bytes, max_files=1)
+    assert image_utils.extract_images_from_archive("a.jpg", b"\xff\xd8") is None
@@ -0,0 +1,43 @@
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("cv2")
+pytest.importorskip("dotenv")
+pytest.importorskip("fpdf")
+
+ROOT = Path(__file__).resolve().parents[1]
+
+# seconds, generous enough for slow CI machines but far below the cost of importing tensorflow
+IMPORT_TIME_BUDGET = float(os.environ.get("IMPORT_TIME_BUDGET", 2.5))
+HEAVY_MODULES = ["tensorflow", "google.cloud.storage", "googleapiclient", "grpc"]
+
+SCRIPT = f"""
+import sys, time
+start = time.perf_counter()
+import main
+print(time.perf_counter() - start)
+print(",".join(name for name in {HEAVY_MODULES!r} if name in sys.modules))
+"""
+
+
+def test_importing_the_app_is_fast_and_has_no_side_effects(tmp_path):
+    env = dict(
+        os.environ,
+        PYTHONPATH=os.pathsep.join([str(ROOT / "molo"), str(ROOT / "utilities")]),
+        MODEL_URI="localhost:8500",
+        UPLOADED_IMAGES_GCS_PATH="uploaded_images",
+        STORAGE_BACKEND="local",
+        LOCAL_STORAGE_ROOT=str(tmp_path),
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", SCRIPT], cwd=str(tmp_path), env=env, capture_output=True, text=True, check=True
+    ).stdout.split("\n")
+
+    assert output[1] == ""
+    assert float(output[0]) < IMPORT_TIME_BUDGET
+    assert not list(tmp_path.iterdir())
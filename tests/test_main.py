@@ -0,0 +1,170 @@
+import io
+import zipfile
+
+import pytest
+
+np = pytest.importorskip("numpy")
+cv2 = pytest.importorskip("cv2")
+pytest.importorskip("fastapi")
+
+
+class FakeBackend:
+    name = "fake"
+    max_concurrent_batches = 1
+
+    def __init__(self):
+        self.batch_sizes = []
+
+    async def predict_batch(self, inputs):
+        self.batch_sizes.append(len(inputs))
+        return np.tile([[0.7, 0.1, 0.1, 0.1]], (len(inputs), 1))
+
+    async def model_version(self):
+        return "1"
+
+    async def warmup(self):
+        pass
+
+    async def close(self):
+        pass
+
+
+@pytest.fixture(scope="module")
+def app_client(tmp_path_factory):
+    from fastapi.testclient import TestClient
+
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setenv("STORAGE_BACKEND", "local")
+        mp.setenv("LOCAL_STORAGE_ROOT", str(tmp_path_factory.mktemp("storage")))
+        mp.setenv("UPLOADED_IMAGES_GCS_PATH", "uploads")
+        mp.setenv("IMAGE_SIZE", "16")
+        mp.setenv("BATCH_ENDPOINT_MAX_FILES", "4")
+        import main
+        from utils import prediction_backends
+
+        backend = FakeBackend()
+        mp.setattr(prediction_backends, "create_backends", lambda image_size: {backend.name: backend})
+        with TestClient(main.app) as client:
+            yield client, backend
+
+
+def jpeg(seed: int) -> bytes:
+    img = np.random.RandomState(seed).randint(0, 256, (20, 30), dtype=np.uint8)
+    return cv2.imencode(".jpg", img)[1].tobytes()
+
+
+def make_zip(members: dict) -> bytes:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as archive:
+        for name, data in members.items():
+            archive.writestr(name, data)
+    return buffer.getvalue()
+
+
+def test_archive_members_are_predicted_and_bad_members_reported(app_client):
+    client, backend = app_client
+    archive = make_zip({
+        "scans/a.jpg": jpeg(0), "scans/b.jpg": jpeg(1), "scans/c.png": b"not an image", "README": b"hi"
+    })
+    response = client.post("/predict/batch/fake", files=[
+        ("files", ("session.zip", archive, "application/zip")), ("files", ("d.jpg", jpeg(2), "image/jpeg"))
+    ])
+
+    assert response.status_code == 200
+    entries = response.json()
+    assert [entry["filename"] for entry in entries] == ["a.jpg", "b.jpg", "c.png", "d.jpg"]
+    assert "error" in entries[2] and "predictedLabel" not in entries[2]
+    assert all("error" not in entries[i] for i in (0, 1, 3))
+    assert backend.batch_sizes[-1] == 3
+
+
+def test_requests_with_too_many_images_are_rejected(app_client):
+    client, _ = app_client
+    archive = make_zip({f"{i}.jpg": jpeg(i) for i in range(3)})
+    response = client.post("/predict/batch/fake", files=[
+        ("files", ("a.jpg", jpeg(10), "image/jpeg")), ("files", ("b.jpg", jpeg(11), "image/jpeg")),
+        ("files", ("session.zip", archive, "application/zip"))
+    ])
+
+    assert response.status_code == 413
+
+
+def test_gradcam_urls_are_absolute_and_overlays_are_shared_through_storage(app_client, monkeypatch):
+    import asyncio
+    import time
+    import main
+    from helpers.gradcam import GradCamService
+
+    client, _ = app_client
+
+    def explain_batch(images_bytes):
+        return [b"overlay of " + image_bytes[:4] for image_bytes in images_bytes]
+
+    service = GradCamService(
+        explain_batch, save_overlay=main.save_gradcam_overlay, load_overlay=main.load_gradcam_overlay
+    )
+    monkeypatch.setattr(main, "gradcam_service", service)
+    image = jpeg(20)
+    url = client.post("/predict/fake", files={"file": ("a.jpg", image, "image/jpeg")}).json()["gradCamImageUrl"]
+
+    assert url.startswith("http://testserver/gradcam/")
+    path = url[len("http://testserver"):]
+    assert client.get(path).content == b"overlay of " + image[:4]
+    assert client.get("/gradcam/..%2Fuploads%2Fa").status_code == 404
+
+    # another worker of the server, which did not make the prediction
+    deadline = time.time() + 5
+    while main.uploader.pending_uploads and time.time() < deadline:
+        time.sleep(0.01)
+    service.executor.shutdown(wait=False)
+    other = GradCamService(explain_batch, load_overlay=main.load_gradcam_overlay)
+    monkeypatch.setattr(main, "gradcam_service", other)
+    assert client.get(path).content == b"overlay of " + image[:4]
+    asyncio.run(other.close())
+
+
+def test_reports_are_queued_polled_and_downloaded_from_any_worker(app_client, monkeypatch, tmp_path):
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    import main
+    from helpers import reports
+    from utils import pdf_utils
+
+    client, _ = app_client
+    logo_path = tmp_path / "logo.png"
+    cv2.imwrite(str(logo_path), np.zeros((32, 32, 4), dtype=np.uint8))
+    monkeypatch.setattr(pdf_utils, "LOGO_PATH", str(logo_path))
+    pdf_utils.get_logo_info.cache_clear()
+    # threads instead of spawned processes, to keep the test fast
+    queue = reports.ReportJobQueue(
+        executor=ThreadPoolExecutor(max_workers=1), storage_backend=main.uploader.backend, storage_path="report-jobs"
+    )
+    monkeypatch.setattr(main, "report_jobs", queue)
+    prediction_data = [{
+        "filename": "a.jpg", "assignedLabel": "CNV", "predictionConfidence": 97.5, "uploadedImageUrl": None
+    }]
+
+    response = client.post("/report", json={"predictionData": prediction_data})
+    assert response.status_code == 202
+    job_id = response.json()["jobId"]
+
+    deadline = time.time() + 30
+    while client.get(f"/report/{job_id}").json()["status"] == "pending" and time.time() < deadline:
+        time.sleep(0.05)
+    assert client.get(f"/report/{job_id}").json()["status"] == "done"
+
+    download = client.get(f"/report/{job_id}/download")
+    assert download.status_code == 200
+    assert download.headers["content-type"] == "application/pdf" and download.content.startswith(b"%PDF")
+
+    # another worker of the server, which did not run the job
+    queue.close(wait=True)
+    other = reports.ReportJobQueue(
+        executor=ThreadPoolExecutor(max_workers=1), storage_backend=main.uploader.backend, storage_path="report-jobs"
+    )
+    monkeypatch.setattr(main, "report_jobs", other)
+    assert client.get(f"/report/{job_id}").json()["status"] == "done"
+    assert client.get(f"/report/{job_id}/download").content == download.content
+    assert client.get("/report/" + "0" * 32).status_code == 404
+    assert client.get("/report/..%2Fuploads%2Fa").status_code == 404
+    other.close()
@@ -0,0 +1,44 @@
+import pytest
+
+prometheus_client = pytest.importorskip("prometheus_client")
+metrics = pytest.importorskip("helpers.metrics")
+
+
+def test_functions_are_read_when_scraped():
+    registry = prometheus_client.CollectorRegistry()
+    depths = {("tf-lite", ): 3}
+    metrics.register_function(
+        registry, "queue_depth", "Queue depth", lambda: depths, labelnames=("backend", )
+    )
+    metrics.register_function(registry, "failures", "Failures", lambda: 2, kind="counter")
+
+    assert 'queue_depth{backend="tf-lite"} 3.0' in prometheus_client.generate_latest(registry).decode()
+    depths[("tf-lite", )] = 5
+    text = prometheus_client.generate_latest(registry).decode()
+
+    assert 'queue_depth{backend="tf-lite"} 5.0' in text
+    assert "counter\nfailures_total 2.0" in text
+    with pytest.raises(ValueError):
+        metrics.FunctionCollector("x", "x", lambda: 0, kind="histogram")
+
+
+def test_middleware_counts_requests_by_handler():
+    pytest.importorskip("fastapi")
+    from fastapi.testclient import TestClient
+    from app import get_app
+
+    registry = prometheus_client.CollectorRegistry()
+    app = get_app(registry)
+
+    @app.get("/items/{item}")
+    async def get_item(item: int):
+        return {"item": item}
+
+    with TestClient(app) as client:
+        for item in range(3):
+            client.get(f"/items/{item}")
+        response = client.get("/metrics")
+
+    assert response.headers["content-type"] == prometheus_client.CONTENT_TYPE_LATEST
+    assert 'molo_http_requests_total{handler="get_item",method="GET",status="200"} 3.0' in response.text
+    assert 'molo_http_request_duration_seconds_count{handler="get_item"} 3.0' in response.text
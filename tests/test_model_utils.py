@@ -0,0 +1,21 @@
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+model_utils = pytest.importorskip("utils.model_utils")
+
+
+def test_mixed_precision_model_keeps_a_float32_output():
+    model = model_utils.get_pre_trained_and_compiled_model(
+        "vgg16", (32, 32, 3), weights=None, mixed_precision="mixed_bfloat16", steps_per_execution=2
+    )
+
+    assert model.output.dtype == tf.float32
+    assert tf.keras.mixed_precision.global_policy().name == "float32"
+    assert model_utils.get_training_options(model) == {
+        "dtype_policy": "mixed_bfloat16", "jit_compile": False, "steps_per_execution": 2
+    }
+
+
+def test_unknown_policies_are_rejected():
+    with pytest.raises(ValueError):
+        model_utils.get_pre_trained_model("vgg16", (32, 32, 3), weights=None, mixed_precision="float8")
@@ -0,0 +1,51 @@
+import os
+import tempfile
+
+import pytest
+
+np = pytest.importorskip("numpy")
+cv2 = pytest.importorskip("cv2")
+pytest.importorskip("fpdf")
+pdf_utils = pytest.importorskip("utils.pdf_utils")
+
+
+def test_reports_render_in_memory_from_the_template(tmp_path, monkeypatch):
+    logo = np.zeros((32, 32, 4), dtype=np.uint8)
+    logo[8:24, 8:24] = (255, 105, 20, 255)
+    logo_path = tmp_path / "logo.png"
+    cv2.imwrite(str(logo_path), logo)
+
+    monkeypatch.setattr(pdf_utils, "LOGO_PATH", str(logo_path))
+    pdf_utils.get_logo_info.cache_clear()
+    temp_files = set(os.listdir(tempfile.gettempdir()))
+
+    rows = [{"filename": f"scan_{i}.jpg", "assigned label": "CNV", "prediction confidence": 99.1} for i in range(3)]
+    reports = [pdf_utils.PDFReport().render(rows, title="Test report") for _ in range(2)]
+
+    assert all(report.startswith(b"%PDF") and report.rstrip().endswith(b"%%EOF") for report in reports)
+    assert pdf_utils.get_logo_info.cache_info().misses == 1
+    assert set(os.listdir(tempfile.gettempdir())) == temp_files
+
+
+def test_large_reports_are_paginated(monkeypatch):
+    monkeypatch.setattr(pdf_utils, "LOGO_PATH", None)
+    monkeypatch.setattr(pdf_utils, "get_report_template", lambda *args: pdf_utils.PDFReport())
+    scan = cv2.imencode(".jpg", np.full((300, 400), 128, dtype=np.uint8))[1].tobytes()
+    loaded = []
+
+    def load_thumbnail(record):
+        loaded.append(record["filename"])
+        return scan
+
+    def records(n):
+        for i in range(n):
+            yield {"filename": f"scan_{i}.jpg", "assigned label": "DME", "url": "hidden"}
+
+    report = pdf_utils.PDFReport()
+    report.add_page()
+    report.write_prediction_table(records(100), thumbnail_loader=load_thumbnail, hidden_keys=("url",))
+
+    assert report.page > 1
+    assert report.get_y() <= report.page_break_trigger
+    assert len(loaded) == 100
+    assert report.images["thumbnail_0"]["w"] == pdf_utils.THUMBNAIL_PIXELS
@@ -0,0 +1,28 @@
+import asyncio
+
+import pytest
+
+np = pytest.importorskip("numpy")
+prediction_backends = pytest.importorskip("utils.prediction_backends")
+serving_utils = pytest.importorskip("utils.serving_utils")
+
+
+def test_fake_tf_serving_backend_costs_one_rpc_per_batch():
+    async def run():
+        backend = prediction_backends.FakeTFServingBackend(
+            input_shape=(8, 8, 3), client=serving_utils.TFServingClient(pool_size=2)
+        )
+        try:
+            await backend.warmup()
+            scores = [await backend.predict_batch(np.random.rand(n, 8, 8, 3).astype(np.float32)) for n in (1, 5)]
+            return scores, await backend.model_version(), backend.server.service
+        finally:
+            await backend.close()
+
+    scores, model_version, service = asyncio.run(run())
+
+    assert [s.shape for s in scores] == [(1, 4), (5, 4)]
+    np.testing.assert_allclose(scores[1].sum(axis=1), 1.0, rtol=1e-5)
+    assert model_version == "1"
+    assert service.metadata_calls == 1
+    assert service.predict_calls == 3  # warmup and two batches
@@ -0,0 +1,60 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+reports = pytest.importorskip("helpers.reports")
+storage_utils = pytest.importorskip("utils.storage_utils")
+
+calls = []
+
+
+def fake_generate(prediction_data, thumbnails=False):
+    calls.append(prediction_data)
+    if not prediction_data:
+        raise ValueError("nothing to report")
+    return f"https://reports/{len(calls)}.pdf"
+
+
+def wait_for(job, timeout=5.0):
+    deadline = time.time() + timeout
+    while job["status"] == "pending" and time.time() < deadline:
+        time.sleep(0.01)
+    return job
+
+
+def test_identical_reports_are_generated_once():
+    queue = reports.ReportJobQueue(fake_generate, executor=ThreadPoolExecutor(max_workers=1))
+    payload = [{"filename": "a.jpg", "assignedLabel": "CNV", "predictionConfidence": 97.5}]
+
+    job = wait_for(queue.submit(prediction_data=payload))
+    duplicate = queue.submit(prediction_data=[dict(item) for item in payload])
+    other = wait_for(queue.submit(prediction_data=payload, thumbnails=True))
+    failed = wait_for(queue.submit(prediction_data=[]))
+    queue.close()
+
+    assert job["status"] == "done" and job["reportUrl"].endswith(".pdf")
+    assert duplicate is job and queue.deduplicated_jobs == 1
+    assert other["jobId"] != job["jobId"]
+    assert failed["status"] == "failed" and "nothing to report" in failed["error"]
+    assert queue.get(job["jobId"]) is job
+    assert len(calls) == 3
+
+
+def test_report_records_rename_fields():
+    records = list(reports.to_report_records([{"filename": "a.jpg", "assignedLabel": "DME"}]))
+
+    assert records == [{"filename": "a.jpg", "assigned label": "DME", "prediction confidence": 0.0}]
+
+
+def test_thumbnails_are_read_through_the_storage_backend(tmp_path):
+    # no base url, so the urls are file:// urls that could not be fetched over http
+    backend = storage_utils.LocalStorageBackend(tmp_path / "storage")
+    url = backend.upload_bytes(b"scan", "uploads/a.jpg")
+    loader = reports.StorageThumbnailLoader(backend)
+
+    assert loader({"uploadedImageUrl": url}) == b"scan"
+    assert loader({"uploadedImageUrl": backend.url_for("uploads/missing.jpg")}) is None
+    assert loader({"uploadedImageUrl": (tmp_path / "outside.jpg").as_uri()}) is None
+    assert loader({"uploadedImageUrl": "https://elsewhere/a.jpg"}) is None
+    assert loader({}) is None
@@ -0,0 +1,110 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+serving_utils = pytest.importorskip("utils.serving_utils")
+
+
+def test_tensor_content_round_trip():
+    array = np.random.rand(2, 80, 80, 3).astype(np.float32)
+
+    tensor = serving_utils.ndarray_to_tensor_proto(array)
+
+    assert len(tensor.float_val) == 0
+    assert [d.size for d in tensor.tensor_shape.dim] == [2, 80, 80, 3]
+    np.testing.assert_array_equal(serving_utils.tensor_proto_to_ndarray(tensor), array)
+
+
+def test_repeated_field_values_are_decoded_with_their_shape():
+    tensor = serving_utils.tensor_pb2.TensorProto(dtype=serving_utils.types_pb2.DT_FLOAT)
+    for size in (2, 4):
+        tensor.tensor_shape.dim.add(size=size)
+    tensor.float_val.extend([0.1, 0.2, 0.6, 0.1, 0.7, 0.1, 0.1, 0.1])
+
+    scores = serving_utils.tensor_proto_to_ndarray(tensor)
+
+    assert scores.shape == (2, 4)
+    np.testing.assert_allclose(scores[1], [0.7, 0.1, 0.1, 0.1])
+
+
+@pytest.fixture
+def fake_server():
+    fake_serving = pytest.importorskip("utils.fake_serving")
+    with fake_serving.FakeTFServingServer(input_shape=(8, 8, 3)) as server:
+        yield server
+
+
+def test_stubs_are_handed_out_round_robin_from_the_pool(fake_server):
+    client = serving_utils.TFServingClient(pool_size=3)
+    stubs = [client.get_stub(fake_server.address) for _ in range(6)]
+    client.close()
+
+    assert len({id(stub) for stub in stubs}) == 3
+    assert stubs[:3] == stubs[3:]
+
+
+def test_concurrent_signature_misses_share_one_metadata_call(fake_server):
+    from concurrent.futures import ThreadPoolExecutor
+
+    client = serving_utils.TFServingClient(pool_size=2)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        signatures = list(executor.map(lambda _: client.get_signature(fake_server.address, "simclr-oct"), range(16)))
+
+    assert len({id(signature) for signature in signatures}) == 1
+    assert signatures[0].input_name == "input_1" and signatures[0].inputs["input_1"].shape == (8, 8, 3)
+    assert fake_server.service.metadata_calls == 1
+
+    client.invalidate("simclr-oct")
+    client.get_signature(fake_server.address, "simclr-oct")
+    client.close()
+    assert fake_server.service.metadata_calls == 2
+
+
+def test_signature_is_refetched_when_a_new_version_is_served(fake_server):
+    client = serving_utils.TFServingClient(pool_size=1)
+    inputs = np.random.rand(2, 8, 8, 3).astype(np.float32)
+    client.predict(inputs, fake_server.address, "simclr-oct")
+    assert client.get_signature(fake_server.address, "simclr-oct").version == 1
+
+    fake_server.service.version = 2
+    client.predict(inputs, fake_server.address, "simclr-oct")
+    signature = client.get_signature(fake_server.address, "simclr-oct")
+    client.close()
+
+    assert signature.version == 2
+    assert fake_server.service.metadata_calls == 2
+
+
+def test_signature_misses_do_not_block_the_event_loop(fake_server):
+    import asyncio
+    import time
+
+    client = serving_utils.TFServingClient(pool_size=1)
+    get_model_metadata = client.get_model_metadata
+
+    def slow_get_model_metadata(*args, **kwargs):
+        time.sleep(0.2)
+        return get_model_metadata(*args, **kwargs)
+
+    client.get_model_metadata = slow_get_model_metadata
+
+    async def run():
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        ticker = asyncio.ensure_future(tick())
+        inputs = np.random.rand(2, 8, 8, 3).astype(np.float32)
+        result = await client.predict_async(inputs, fake_server.address, "simclr-oct")
+        ticker.cancel()
+        return result, ticks
+
+    result, ticks = asyncio.run(run())
+    client.close()
+
+    assert result.model_spec.version.value == 1
+    assert ticks >= 5
+    assert fake_server.service.metadata_calls == 1
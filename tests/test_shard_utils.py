@@ -0,0 +1,47 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+cv2 = pytest.importorskip("cv2")
+shard_utils = pytest.importorskip("utils.shard_utils")
+
+
+@pytest.fixture
+def shards_directory(tmp_path):
+    subset_files = {"train": [], "val": []}
+    for subset, n in (("train", 5), ("val", 2)):
+        for label, class_name in enumerate(("CNV", "NORMAL")):
+            for i in range(n):
+                path = tmp_path / "images" / f"{subset}-{class_name}-{i}.jpeg"
+                path.parent.mkdir(exist_ok=True)
+                cv2.imwrite(str(path), np.full((40, 50), 20 * i + label, dtype=np.uint8))
+                subset_files[subset].append((str(path), label))
+
+    shard_utils.write_shards(
+        tmp_path / "shards", subset_files, ["CNV", "NORMAL"], target_size=(16, 16), shard_size=4, workers=1
+    )
+    return tmp_path / "shards"
+
+
+def test_shards_read_back_across_shard_boundaries(shards_directory):
+    manifest = shard_utils.load_manifest(shards_directory)
+    train = shard_utils.ShardedArrayDataset(shards_directory, "train")
+
+    assert [len(manifest["subsets"][s]["shards"]) for s in ("train", "val")] == [3, 1]
+    assert len(train) == 10 and sorted(train.labels.tolist()) == [0] * 5 + [1] * 5
+    assert train.get_images(2, 9).shape == (7, 16, 16, 1)
+    assert np.array_equal(train.get_images(3, 5), np.concatenate([train.images[0][3:], train.images[1][:1]]))
+
+    images, labels = next(train.iter_batches(batch_size=6))
+    assert images.shape == (6, 16, 16, 3) and images.dtype == np.float32 and labels.shape == (6,)
+
+
+def test_datasets_from_shards(shards_directory):
+    pytest.importorskip("tensorflow")
+    from utils import generator_utils
+
+    datasets = generator_utils.create_datasets_from_shards(shards_directory, batch_size=4, seed=0, horizontal_flip=True)
+    images, labels = next(iter(datasets["val"]))
+
+    assert set(datasets) == {"train", "val"}
+    assert images.shape == (4, 16, 16, 3) and labels.numpy().argmax(axis=1).tolist() == [0, 0, 1, 1]
+    assert sum(len(batch[1]) for batch in datasets["train"]) == 10
@@ -0,0 +1,125 @@
+import asyncio
+import threading
+
+import pytest
+
+storage_utils = pytest.importorskip("utils.storage_utils")
+
+
+class FailingBackend(storage_utils.StorageBackend):
+    def upload_bytes(self, data, path, content_type=None):
+        raise IOError("bucket is gone")
+
+    def url_for(self, path):
+        return f"https://storage/{path}"
+
+
+class BlockingBackend(FailingBackend):
+    def __init__(self):
+        self.release = threading.Event()
+        self.uploaded = []
+
+    def upload_bytes(self, data, path, content_type=None):
+        self.release.wait(5)
+        self.uploaded.append(path)
+
+
+def test_uploads_are_persisted_and_failures_counted(tmp_path):
+    uploads = []
+    uploader = storage_utils.BackgroundUploader(
+        storage_utils.LocalStorageBackend(tmp_path), on_upload=lambda duration, ok: uploads.append(ok)
+    )
+    failing_uploader = storage_utils.BackgroundUploader(
+        FailingBackend(), on_upload=lambda duration, ok: uploads.append(ok)
+    )
+
+    async def run():
+        url = await uploader.submit(b"scan", "images/a.jpg")
+        await asyncio.gather(*[failing_uploader.submit(b"scan", f"images/{i}.jpg") for i in range(3)])
+        return url
+
+    url = asyncio.run(run())
+    uploader.close(wait=True)
+    failing_uploader.close(wait=True)
+
+    assert url == (tmp_path / "images" / "a.jpg").resolve().as_uri()
+    assert (tmp_path / "images" / "a.jpg").read_bytes() == b"scan"
+    assert failing_uploader.failed_uploads == 3 and uploader.failed_uploads == 0
+    assert sorted(uploads) == [False, False, False, True]
+
+
+def test_submit_does_not_wait_for_the_upload():
+    backend = BlockingBackend()
+    uploader = storage_utils.BackgroundUploader(backend, max_workers=1)
+
+    async def run():
+        url = await asyncio.wait_for(uploader.submit(b"scan", "images/a.jpg"), timeout=1)
+        return url, uploader.pending_uploads, list(backend.uploaded)
+
+    url, pending, uploaded = asyncio.run(run())
+    backend.release.set()
+    uploader.close(wait=True)
+
+    assert url == "https://storage/images/a.jpg"
+    assert pending == 1 and uploaded == []
+    assert backend.uploaded == ["images/a.jpg"]
+
+
+def test_client_file_names_can_not_escape_the_storage_root(tmp_path):
+    backend = storage_utils.LocalStorageBackend(tmp_path / "root", base_url="https://files")
+
+    with pytest.raises(ValueError):
+        backend.upload_bytes(b"scan", "images/../../x")
+    with pytest.raises(ValueError):
+        backend.url_for("/etc/passwd")
+
+    assert storage_utils.safe_filename("../x") == "x"
+    assert storage_utils.safe_filename("..\\..\\scan.jpg") == "scan.jpg"
+    assert storage_utils.safe_filename("..") == "upload"
+    assert backend.url_for("images/" + storage_utils.safe_filename("../x")) == "https://files/images/x"
+    assert backend.url_for("") == "https://files/"
+    assert not (tmp_path / "x").exists()
+
+
+def test_upload_returns_the_url_once_the_object_is_stored(tmp_path):
+    backend = BlockingBackend()
+    uploader = storage_utils.BackgroundUploader(backend, max_workers=1)
+    failing_uploader = storage_utils.BackgroundUploader(FailingBackend())
+
+    async def run():
+        upload = asyncio.ensure_future(uploader.upload(b"scan", "images/a.jpg"))
+        await asyncio.sleep(0.05)
+        pending = not upload.done()
+        backend.release.set()
+        return pending, await upload, await failing_uploader.upload(b"scan", "images/b.jpg")
+
+    pending, url, failed_url = asyncio.run(run())
+    uploader.close(wait=True)
+    failing_uploader.close(wait=True)
+
+    assert pending
+    assert url == "https://storage/images/a.jpg" and backend.uploaded == ["images/a.jpg"]
+    assert failed_url is None and failing_uploader.failed_uploads == 1
+
+
+def test_gcs_urls_are_authenticated_unless_the_bucket_is_public():
+    path = "uploads/scan 1.jpg"
+
+    assert storage_utils.GCSStorageBackend("bucket").url_for(path) == \
+        "https://storage.googleapis.com/download/storage/v1/b/bucket/o/uploads%2Fscan%201.jpg?alt=media"
+    assert storage_utils.GCSStorageBackend("bucket", public_urls=True).url_for(path) == \
+        "https://storage.googleapis.com/bucket/uploads/scan%201.jpg"
+
+
+def test_urls_are_mapped_back_to_storage_paths(tmp_path):
+    path = "uploads/scan 1.jpg"
+    gcs = storage_utils.GCSStorageBackend("bucket")
+    public_gcs = storage_utils.GCSStorageBackend("bucket", public_urls=True)
+    local = storage_utils.LocalStorageBackend(tmp_path, base_url="https://files")
+
+    assert gcs.path_for(gcs.url_for(path)) == gcs.path_for(public_gcs.url_for(path)) == path
+    assert gcs.path_for("https://storage.googleapis.com/other-bucket/a.jpg") is None
+    assert local.path_for(local.url_for(path)) == path
+    assert storage_utils.LocalStorageBackend(tmp_path).path_for((tmp_path / path).as_uri()) == path
+    assert local.path_for("https://files/../x") is None
+    assert local.path_for("https://elsewhere/a.jpg") is None
@@ -0,0 +1,45 @@
+import os
+
+import pytest
+
+pytest.importorskip("simplejson")
+from utils import sync_utils
+
+
+@pytest.fixture
+def source_directory(tmp_path):
+    for subset in ("train", "val"):
+        for class_name in ("CNV", "NORMAL"):
+            (tmp_path / "source" / subset / class_name).mkdir(parents=True)
+            for i in range(3):
+                (tmp_path / "source" / subset / class_name / f"{class_name}-{i}.jpeg").write_bytes(os.urandom(64))
+    return tmp_path / "source"
+
+
+def scan(source_directory):
+    subset_classes = {"train": ["CNV", "NORMAL"], "val": ["CNV", "NORMAL"]}
+    return sync_utils.scan_files(source_directory, subset_classes, {"CNV": 0, "NORMAL": 1}, "jpeg")
+
+
+def test_only_new_and_changed_files_are_synced(source_directory, tmp_path):
+    destination = tmp_path / "data"
+    assert sync_utils.sync_files(scan(source_directory), destination)["added"] == 12
+
+    (source_directory / "train" / "CNV" / "CNV-new.jpeg").write_bytes(b"new")
+    (source_directory / "train" / "NORMAL" / "NORMAL-0.jpeg").write_bytes(b"changed")
+    (source_directory / "val" / "CNV" / "CNV-0.jpeg").unlink()
+    os.utime(source_directory / "val" / "NORMAL" / "NORMAL-1.jpeg", ns=(0, 0))
+    stats = sync_utils.sync_files(scan(source_directory), destination)
+
+    assert stats == {"added": 1, "updated": 1, "unchanged": 10, "removed": 1}
+    assert (destination / "train" / "1" / "NORMAL-0.jpeg").read_bytes() == b"changed"
+    assert not (destination / "val" / "0" / "CNV-0.jpeg").exists()
+    manifest = sync_utils.load_manifest(destination)
+    assert manifest["files"]["train/0/CNV-new.jpeg"]["hash"] == sync_utils.file_digest(destination / "train/0/CNV-new.jpeg")
+
+
+def test_hardlinks(source_directory, tmp_path):
+    sync_utils.sync_files(scan(source_directory), tmp_path / "data", mode="hardlink")
+
+    source = source_directory / "val" / "NORMAL" / "NORMAL-2.jpeg"
+    assert os.path.samefile(source, tmp_path / "data" / "val" / "1" / "NORMAL-2.jpeg")
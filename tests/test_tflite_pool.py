@@ -0,0 +1,78 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+np = pytest.importorskip("numpy")
+tf = pytest.importorskip("tensorflow")
+serving_utils = pytest.importorskip("utils.serving_utils")
+
+
+@pytest.fixture(scope="module")
+def model_path(tmp_path_factory):
+    inputs = tf.keras.Input((8, 8, 3))
+    x = tf.keras.layers.Conv2D(4, 3, activation="relu")(inputs)
+    x = tf.keras.layers.GlobalAveragePooling2D()(x)
+    model = tf.keras.Model(inputs, tf.keras.layers.Dense(4, activation="softmax")(x))
+
+    path = tmp_path_factory.mktemp("tflite") / "model.tflite"
+    path.write_bytes(tf.lite.TFLiteConverter.from_keras_model(model).convert())
+    return str(path)
+
+
+@pytest.fixture
+def images():
+    return np.random.RandomState(0).uniform(0, 1, (16, 8, 8, 3)).astype(np.float32)
+
+
+def test_concurrent_predictions_match_sequential_ones(model_path, images):
+    pool = serving_utils.TFLiteInterpreterPool(model_path, size=3)
+    expected = [pool.predict(images[i:i + 1]) for i in range(len(images))]
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        scores = list(executor.map(lambda i: pool.predict(images[i:i + 1]), list(range(len(images))) * 4))
+    pool.close()
+
+    for i, s in enumerate(scores):
+        np.testing.assert_allclose(s, expected[i % len(images)], rtol=1e-5)
+
+
+def test_batches_of_any_size_are_split_across_the_interpreters(model_path, images):
+    pool = serving_utils.TFLiteInterpreterPool(model_path, size=3)
+    single = np.concatenate([pool.predict(images[i:i + 1]) for i in range(len(images))])
+
+    async def run():
+        return [await pool.predict_async(images[:n]) for n in (16, 5, 1, 0)]
+
+    scores = asyncio.run(run())
+    resized = pool.predict(images[:7])
+    pool.close()
+
+    assert [s.shape for s in scores] == [(16, 4), (5, 4), (1, 4), (0, 4)]
+    np.testing.assert_allclose(scores[0], single, rtol=1e-5)
+    np.testing.assert_allclose(scores[1], single[:5], rtol=1e-5)
+    np.testing.assert_allclose(resized, single[:7], rtol=1e-5)
+
+
+def test_batches_are_split_into_power_of_two_sizes():
+    assert serving_utils.split_into_buckets(0, 4) == []
+    assert serving_utils.split_into_buckets(5, 3) == [2, 2, 1]
+    assert serving_utils.split_into_buckets(17, 1) == [16, 1]
+    assert serving_utils.split_into_buckets(23, 2) == [8, 8, 4, 2, 1]
+    for n in range(1, 70):
+        sizes = serving_utils.split_into_buckets(n, 4)
+        assert sum(sizes) == n and all(size & (size - 1) == 0 for size in sizes)
+
+
+def test_interpreters_are_not_resized_for_every_batch(model_path, images):
+    pool = serving_utils.TFLiteInterpreterPool(model_path, size=2)
+
+    async def run():
+        for n in (16, 13, 11, 16, 9, 14) * 3:
+            await pool.predict_async(images[:n])
+
+    asyncio.run(run())
+    pool.close()
+
+    # 18 batches of 6 sizes, split into chunks of 4 power of two sizes, allocated once per slot
+    assert pool.resizes <= 2 * 4
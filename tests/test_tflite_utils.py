@@ -0,0 +1,63 @@
+import json
+
+import pytest
+
+np = pytest.importorskip("numpy")
+cv2 = pytest.importorskip("cv2")
+tf = pytest.importorskip("tensorflow")
+tflite_utils = pytest.importorskip("utils.tflite_utils")
+from utils import generator_utils, model_utils
+
+
+@pytest.fixture
+def flows(tmp_path):
+    for subset in ("train", "val"):
+        for i, label in enumerate(("CNV", "NORMAL")):
+            (tmp_path / subset / label).mkdir(parents=True)
+            for j in range(4):
+                # textured, since a flat image can leave every activation at zero, which int8 cannot calibrate on
+                img = (150 * i + np.random.RandomState(j).randint(0, 100, (40, 40))).astype(np.uint8)
+                cv2.imwrite(str(tmp_path / subset / label / f"{label}-{j}.jpeg"), img)
+
+    train_generator, generator = generator_utils.get_generator_instances()
+    return generator_utils.create_flows(
+        tmp_path, train_generator, generator, target_size=(16, 16), batch_size=4, seed=0
+    )
+
+
+@pytest.fixture
+def model():
+    inputs = tf.keras.Input((16, 16, 3))
+    x = tf.keras.layers.Conv2D(4, 3, activation="relu")(inputs)
+    x = tf.keras.layers.GlobalMaxPooling2D()(x)
+    return model_utils.ExtendedModel(inputs, tf.keras.layers.Dense(2, activation="softmax")(x), name="tiny")
+
+
+def test_every_variant_is_exported_and_compared(flows, model, tmp_path):
+    representative_images, _ = tflite_utils.sample_flow(flows["train"], 6)
+    images, labels = tflite_utils.sample_flow(flows["val"], 8)
+
+    report = tflite_utils.export_tflite_models(
+        model, str(tmp_path / "tflite"), representative_images, images, labels, accuracy_budget=1.
+    )
+
+    assert representative_images.shape == (6, 16, 16, 3) and sorted(labels.tolist()) == [0] * 4 + [1] * 4
+    assert list(report["variants"]) == list(tflite_utils.QUANTIZATION_MODES)
+    assert report["variants"]["float32"]["accuracy_drop"] == 0 and report["variants"]["float32"]["agreement"] == 1
+    assert report["selected"] in report["variants"]
+    with open(tmp_path / "tflite" / tflite_utils.REPORT_FILENAME) as f:
+        assert json.load(f)["selected"] == report["selected"]
+
+
+def test_int8_export_keeps_float_io(flows, model, tmp_path):
+    filepath = model.export_tflite(
+        str(tmp_path / "tiny.tflite"), representative_flow=flows["train"], num_calibration_images=4
+    )
+    interpreter = tf.lite.Interpreter(model_path=filepath)
+    interpreter.allocate_tensors()
+    tensor_types = {details["dtype"] for details in interpreter.get_tensor_details()}
+
+    assert interpreter.get_input_details()[0]["dtype"] == np.float32
+    assert np.int8 in tensor_types
+    with pytest.raises(ValueError):
+        model.export_tflite(str(tmp_path / "uncalibrated.tflite"))
@@ -0,0 +1,19 @@
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("tensorflow")
+pytest.importorskip("wandb")
+
+
+def test_dense_net_sweep_builds_the_model():
+    from wandb_sweep_helpers import wandb_dense_net_sweep
+
+    config = SimpleNamespace(
+        weights=None, pooling="avg", dropout_rate=0.2, dense_start_dimension=16, n_dense_cls_head=1,
+        dense_cls_activation="relu", reduction_factor=2
+    )
+    model = wandb_dense_net_sweep.get_model(config, input_shape=(32, 32, 3), n_classes=4)
+
+    assert model.name == "dense-net-121"
+    assert model.output_shape == (None, 4)
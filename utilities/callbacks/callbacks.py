@@ -5,6 +5,9 @@ from datetime import datetime as dt
 import time
 import random
 import string
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 import simplejson as json
 
 import numpy as np
@@ -13,10 +16,110 @@ from tensorflow.keras.models import Model
 from tensorflow.keras.callbacks import Callback
 from google.cloud import storage
 
+from utils import model_utils
+
 logger = logging.getLogger("callbacks.py")
 logger.setLevel(logging.INFO)
 
 
+class ArtifactUploader:
+    """
+    Uploads files to a GCS bucket from a pool of background threads, so that training never waits on the network
+    """
+    def __init__(
+            self,
+            bucket: storage.Bucket,
+            prefix: str,
+            max_workers: int = 4
+    ):
+        """
+        :param bucket:
+        :param prefix: path in the bucket the files are uploaded under
+        :param max_workers: number of uploads running at the same time
+        """
+        self.bucket = bucket
+        self.prefix = prefix.rstrip("/")
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="artifact-upload")
+        self.futures: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def _upload(
+            self,
+            filepath: str,
+            name: str,
+            remove: bool
+    ) -> str:
+        self.bucket.blob(f"{self.prefix}/{name}").upload_from_filename(os.path.abspath(filepath))
+        if remove:
+            os.remove(filepath)
+        return name
+
+    def upload(
+            self,
+            filepath: str,
+            name: Optional[str] = None,
+            remove: bool = False
+    ) -> Future:
+        """
+        Queues the upload of a file
+        :param filepath:
+        :param name: path of the file under the prefix, the file name by default
+        :param remove: delete the local file once it is uploaded
+        :return:
+        """
+        name = name or os.path.basename(filepath)
+        future = self.executor.submit(self._upload, filepath, name, remove)
+        with self._lock:
+            self.futures[name] = future
+        return future
+
+    def delete(
+            self,
+            name: str,
+            filepath: Optional[str] = None
+    ) -> Future:
+        """
+        Queues the deletion of an uploaded file, once its upload is done
+        :param name:
+        :param filepath: local copy of the file, deleted as well
+        :return:
+        """
+        with self._lock:
+            upload = self.futures.pop(name, None)
+
+        def delete():
+            # uploads are queued first, so this never waits on an upload that has not started
+            uploaded = upload is None or upload.exception() is None
+            if filepath is not None and os.path.exists(filepath):
+                os.remove(filepath)
+            if uploaded:
+                self.bucket.blob(f"{self.prefix}/{name}").delete()
+
+        future = self.executor.submit(delete)
+        with self._lock:
+            self.futures[f"{name} (deletion)"] = future
+        return future
+
+    def wait(self) -> List[Exception]:
+        """
+        Waits for the queued uploads
+        :return: the errors of the uploads and deletions that failed, which are logged as well
+        """
+        with self._lock:
+            futures, self.futures = self.futures, {}
+
+        errors = []
+        for name, future in futures.items():
+            if future.exception() is not None:
+                logger.error(f"Failed to sync {name}: {future.exception()}")
+                errors.append(future.exception())
+        return errors
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown(wait=True)
+
+
 class MachineLearningExperimentTracking(Callback):
     """
     Can be used to track basic info during model training and store data in GCS
@@ -33,11 +136,22 @@ class MachineLearningExperimentTracking(Callback):
             store_data_in_gcs: bool = True,
             experiment_description: Optional[str] = None,
             run_id: Optional[str] = None,
+            checkpoint_interval: float = 60.0,
+            keep_checkpoints: int = 3,
+            checkpoint_directory: Optional[str] = None,
+            upload_workers: int = 4,
             **kwargs
     ):
         """
         :param model: an instance of a keras.models.Model that is being trained
+        :param save_best_weights: checkpoint the weights whenever the monitored metric improves.
+            Checkpoints are written and uploaded in the background, see load_checkpoint.
         :param experiment_description: description of what was done or is being tested in this iteration of the model
+        :param checkpoint_interval: minimum number of seconds between two checkpoints, an improvement in between
+            is checkpointed at the end of a later epoch or at the end of training
+        :param keep_checkpoints: number of checkpoints kept, locally and in GCS
+        :param checkpoint_directory: local directory of the checkpoints, experiment_name/run_id/checkpoints by default
+        :param upload_workers: number of uploads to GCS running at the same time
         :param kwargs:
         """
         super(MachineLearningExperimentTracking, self).__init__()
@@ -58,6 +172,19 @@ class MachineLearningExperimentTracking(Callback):
 
         self.run_id = run_id if run_id else self.__gen_run_id()
         self.gcs_bucket = self.__get_gcs_bucket() if self.store_data_in_gcs else None
+        self.uploader = ArtifactUploader(
+            self.gcs_bucket, f"experiments/{self.experiment_name}/{self.run_id}", max_workers=upload_workers
+        ) if self.store_data_in_gcs else None
+
+        self.checkpoint_interval = checkpoint_interval
+        self.keep_checkpoints = keep_checkpoints
+        self.checkpoint_directory = checkpoint_directory or os.path.join(experiment_name, self.run_id, "checkpoints")
+        self.checkpoints = []
+        self._pending_checkpoint = None
+        self._last_checkpoint_time = -np.inf
+        self._checkpoint_future = None
+        # a single thread, checkpoints are written in order
+        self._checkpoint_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="checkpoint")
 
         self.model_train_doc = {}
         self.best_weights = None
@@ -93,6 +220,7 @@ class MachineLearningExperimentTracking(Callback):
             "model_output_shape": self.model.output_shape,
             "optimizer": {**self.model.optimizer.get_config(), "class": str(self.model.optimizer.__class__)},
             "loss_function": str(self.model.loss),
+            "training_options": model_utils.get_training_options(self.model),
             "logs": {},
             "experiment_description": self.experiment_description,
             "additional_parameters": self.kwargs
@@ -116,8 +244,14 @@ class MachineLearningExperimentTracking(Callback):
                 monitor_value = logs[self.monitor]
                 if self._f(monitor_value, self.best):
                     self.best = monitor_value
-                    self.best_weights = self.model.weights
                     self.model_train_doc['best'] = self.best
+                    if self.save_best_weights:
+                        # a copy of the values, the variables keep changing while the copy is written
+                        self.best_weights = self.model.get_weights()
+                        self._pending_checkpoint = (epoch, self.best_weights)
+
+        if self.save_best_weights:
+            self._checkpoint()
 
         self.current_epoch_train_time = time.time() - self.current_epoch_start
         self.total_training_time += self.current_epoch_train_time
@@ -126,7 +260,81 @@ class MachineLearningExperimentTracking(Callback):
         self.model_train_doc["total_training_time"] = self.total_training_time
         self.model_train_doc["epoch_train_times"] = self.epoch_train_times
 
+    def _checkpoint(
+            self,
+            force: bool = False
+    ):
+        """
+        Queues the write of the pending checkpoint, unless the last one was written less than checkpoint_interval
+        seconds ago or is still being written
+        :param force: queue it regardless
+        :return:
+        """
+        if self._pending_checkpoint is None:
+            return
+        if not force:
+            if self._checkpoint_future is not None and not self._checkpoint_future.done():
+                return
+            if time.time() - self._last_checkpoint_time < self.checkpoint_interval:
+                return
+
+        epoch, weights = self._pending_checkpoint
+        self._pending_checkpoint = None
+        self._last_checkpoint_time = time.time()
+        self._checkpoint_future = self._checkpoint_executor.submit(self._write_checkpoint, epoch, weights)
+
+    def _write_checkpoint(
+            self,
+            epoch: int,
+            weights: List[np.ndarray]
+    ):
+        os.makedirs(self.checkpoint_directory, exist_ok=True)
+        filename = f"{self.model.name}_best-epoch-{epoch + 1:04d}.npz"
+        filepath = os.path.join(self.checkpoint_directory, filename)
+        with open(filepath + ".tmp", "wb") as f:
+            np.savez(f, *weights)
+        os.replace(filepath + ".tmp", filepath)
+        logger.info(f"Checkpointed the weights of epoch {epoch + 1} in {filepath}")
+
+        self.checkpoints.append(filename)
+        if self.uploader is not None:
+            self.uploader.upload(filepath, f"checkpoints/{filename}")
+
+        while len(self.checkpoints) > self.keep_checkpoints:
+            old_filepath = os.path.join(self.checkpoint_directory, self.checkpoints.pop(0))
+            if self.uploader is not None:
+                self.uploader.delete(f"checkpoints/{os.path.basename(old_filepath)}", old_filepath)
+            else:
+                os.remove(old_filepath)
+
+    def wait_for_checkpoints(self):
+        """
+        Writes the pending checkpoint if there is one and waits for the checkpoints to be written
+        :return:
+        """
+        self._checkpoint(force=True)
+        if self._checkpoint_future is not None:
+            self._checkpoint_future.result()
+
+    @staticmethod
+    def load_checkpoint(
+            model: Model,
+            filepath: str
+    ):
+        """
+        Loads the weights of a checkpoint into a model with the same architecture
+        :param model:
+        :param filepath:
+        :return:
+        """
+        with np.load(filepath) as checkpoint:
+            model.set_weights([checkpoint[f"arr_{i}"] for i in range(len(checkpoint.files))])
+
     def on_train_end(self, logs=None):
+        if self.save_best_weights:
+            self.wait_for_checkpoints()
+        if self.uploader is not None:
+            self.uploader.wait()
 
         if self.store_data_locally:
             logger.info(f"Storing model and training data locally in directory {self.run_id}")
@@ -166,10 +374,6 @@ class MachineLearningExperimentTracking(Callback):
     def __are_gcp_credentials_set():
         return bool(os.environ.get('GOOGLE_APPLICATION_CREDENTIALS'))
 
-    def __upload_file_to_gcp_bucket(self, filepath):
-        blob = self.gcs_bucket.blob(f"experiments/{self.experiment_name}/{self.run_id}/{filepath}")
-        blob.upload_from_filename(os.path.abspath(filepath))
-
     def __get_and_create_local_experiment_directory_if_needed(self):
         directory = f"{self.experiment_name}/{self.run_id}/"
         if self.store_data_locally and not os.path.exists(directory):
@@ -249,28 +453,202 @@ class MachineLearningExperimentTracking(Callback):
         self.save_model_training_document()
         self.save_model_graph()
 
-    def store_weights_in_gcp(self, weights_filepath: str = None):
+    def store_weights_in_gcp(self, weights_filepath: str = None) -> Future:
         weights_filepath = self.save_model_weights(weights_filepath)
-        self.__upload_file_to_gcp_bucket(weights_filepath)
-        os.remove(os.path.abspath(weights_filepath))
+        return self.uploader.upload(weights_filepath, remove=True)
 
-    def store_model_graph_in_gcp(self):
+    def store_model_graph_in_gcp(self) -> Future:
         graph_image_path = self.save_model_graph()
-        self.__upload_file_to_gcp_bucket(graph_image_path)
-        os.remove(graph_image_path)
+        return self.uploader.upload(graph_image_path, remove=True)
 
-    def store_model_config_in_gcp(self):
+    def store_model_config_in_gcp(self) -> Future:
         model_config_path = self.save_model_config()
-        self.__upload_file_to_gcp_bucket(model_config_path)
-        os.remove(model_config_path)
+        return self.uploader.upload(model_config_path, remove=True)
 
-    def store_model_training_document_in_gcp(self):
+    def store_model_training_document_in_gcp(self) -> Future:
         path_to_document = self.save_model_training_document()
-        self.__upload_file_to_gcp_bucket(path_to_document)
-        os.remove(path_to_document)
+        return self.uploader.upload(path_to_document, remove=True)
 
     def store_info_in_gcs(self):
+        # files are written one after the other, uploaded in parallel
         self.store_weights_in_gcp()
         self.store_model_graph_in_gcp()
         self.store_model_config_in_gcp()
         self.store_model_training_document_in_gcp()
+        self.uploader.wait()
+
+
+def get_host_memory() -> Dict[str, Optional[float]]:
+    """
+    Returns the current and peak resident memory of this process in MB, None where the platform does not tell
+    :return:
+    """
+    rss_mb, peak_rss_mb = None, None
+    try:
+        with open("/proc/self/statm") as f:
+            rss_mb = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError, IndexError):
+        pass
+
+    try:
+        import resource
+        # kilobytes on linux
+        peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+    except ImportError:
+        pass
+
+    return {"rss_mb": rss_mb, "peak_rss_mb": peak_rss_mb}
+
+
+class ThroughputProfiler(Callback):
+    """
+    Records the duration of every training step, the share of it spent waiting on the input pipeline and
+    the number of images per second, and summarizes them per epoch as percentiles and histograms.
+    With experiment_tracking, the summaries go into its training document under "throughput".
+
+    Input wait is only measured for a tf.data dataset passed through instrument, as the time from the start of a
+    step to the moment its batch comes out of the dataset. With steps_per_execution > 1, a step is a whole execution.
+    """
+    def __init__(
+            self,
+            experiment_tracking: Optional[MachineLearningExperimentTracking] = None,
+            batch_size: Optional[int] = None,
+            profile_batches: Optional[Tuple[int, int]] = None,
+            profile_log_dir: str = "profiler-logs",
+            histogram_bins: int = 20,
+            percentiles: Tuple[int, ...] = (50, 90, 99)
+    ):
+        """
+        :param experiment_tracking: the callback whose training document receives the summaries
+        :param batch_size: number of images per step, needed for images per second when the dataset is not instrumented
+        :param profile_batches: (first, last) training steps, counted from the start of training,
+            to capture a TensorFlow profiler trace of in profile_log_dir, for TensorBoard
+        :param profile_log_dir:
+        :param histogram_bins:
+        :param percentiles:
+        """
+        super(ThroughputProfiler, self).__init__()
+        self.experiment_tracking = experiment_tracking
+        self.batch_size = batch_size
+        self.profile_batches = profile_batches
+        self.profile_log_dir = profile_log_dir
+        self.histogram_bins = histogram_bins
+        self.percentiles = percentiles
+
+        self.summary = {}
+        self.global_step = 0
+        self._profiling = False
+        self._step_start = None
+        self._ready = deque()
+        self._reset_epoch()
+
+    def _reset_epoch(self):
+        self.step_times = []
+        self.input_wait_times = []
+        self.step_images = []
+
+    def instrument(
+            self,
+            dataset: tf.data.Dataset
+    ) -> tf.data.Dataset:
+        """
+        Returns the dataset with every batch time-stamped when it is handed to the model.
+        Must be applied last, after prefetch, and only to the training dataset.
+        :param dataset: dataset of batches
+        :return:
+        """
+        def record_ready(batch_size):
+            self._ready.append((time.perf_counter(), int(batch_size)))
+            return 0
+
+        def stamp(*batch):
+            ready = tf.py_function(record_ready, [tf.shape(tf.nest.flatten(batch)[0])[0]], tf.int64)
+            with tf.control_dependencies([ready]):
+                batch = tf.nest.map_structure(tf.identity, batch)
+            return batch if len(batch) > 1 else batch[0]
+
+        return dataset.map(stamp)
+
+    def on_train_begin(self, logs=None):
+        self.summary = {"epochs": [], "first_step_time": None}
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._reset_epoch()
+
+    def on_train_batch_begin(self, batch, logs=None):
+        if self.profile_batches and self.global_step == self.profile_batches[0]:
+            tf.profiler.experimental.start(self.profile_log_dir)
+            self._profiling = True
+        self._step_start = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        step_end = time.perf_counter()
+        step_time = step_end - self._step_start
+
+        ready_time, images = None, 0
+        while self._ready and self._ready[0][0] <= step_end:
+            ready_time, batch_size = self._ready.popleft()
+            images += batch_size
+
+        if self.global_step == 0:
+            # tracing and compiling the train function
+            self.summary["first_step_time"] = step_time
+        else:
+            self.step_times.append(step_time)
+            self.step_images.append(images or self.batch_size or 0)
+            if ready_time is not None:
+                self.input_wait_times.append(min(max(ready_time - self._step_start, 0.0), step_time))
+
+        if self._profiling and self.global_step >= self.profile_batches[1]:
+            self._stop_profiling()
+        self.global_step += 1
+
+    def _stop_profiling(self):
+        tf.profiler.experimental.stop()
+        self._profiling = False
+        logger.info(f"Saved a profiler trace of steps {self.profile_batches} in {self.profile_log_dir}")
+
+    def summarize(
+            self,
+            values: List[float]
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Returns the mean, percentiles and histogram of values
+        :param values:
+        :return:
+        """
+        if not values:
+            return None
+
+        values = np.asarray(values, dtype=np.float64)
+        counts, edges = np.histogram(values, bins=self.histogram_bins)
+        return {
+            "mean": float(values.mean()),
+            **{f"p{p}": float(v) for p, v in zip(self.percentiles, np.percentile(values, self.percentiles))},
+            "histogram": {"counts": counts.tolist(), "edges": [round(float(e), 6) for e in edges]}
+        }
+
+    def on_epoch_end(self, epoch, logs=None):
+        total_step_time = float(np.sum(self.step_times))
+        epoch_summary = {
+            "epoch": epoch,
+            "steps": len(self.step_times),
+            "step_time": self.summarize(self.step_times),
+            "input_wait_time": self.summarize(self.input_wait_times),
+            "input_wait_fraction": float(np.sum(self.input_wait_times)) / total_step_time
+            if self.input_wait_times and total_step_time else None,
+            "images_per_second": self.summarize(
+                [images / step_time for images, step_time in zip(self.step_images, self.step_times) if images]
+            ),
+            "epoch_images_per_second": float(np.sum(self.step_images)) / total_step_time
+            if total_step_time and any(self.step_images) else None,
+            "host_memory": get_host_memory()
+        }
+        self.summary["epochs"].append(epoch_summary)
+
+        if self.experiment_tracking is not None:
+            self.experiment_tracking.model_train_doc["throughput"] = self.summary
+
+    def on_train_end(self, logs=None):
+        if self._profiling:
+            self._stop_profiling()
@@ -1,6 +1,227 @@
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import *
+
+import httplib2
+import simplejson as json
 import googleapiclient.discovery
+from googleapiclient.model import JsonModel
 from google.api_core.client_options import ClientOptions
 
+# AI Platform rejects online prediction requests with bodies larger than 1.5 MB
+MAX_PAYLOAD_BYTES = int(1.5 * 1024 * 1024)
+DISCOVERY_URI = "https://www.googleapis.com/discovery/v1/apis/ml/v1/rest"
+
+
+class PreserializedJsonModel(JsonModel):
+    """
+    JSON model of the API requests which sends bodies that are already serialized as they are
+    """
+    def serialize(self, body_value):
+        if isinstance(body_value, str):
+            return body_value
+        return super().serialize(body_value)
+
+
+class AIPlatformClient:
+    """
+    Long-lived client for online predictions on AI Platform.
+    The discovery document is loaded once (and optionally cached on disk), every thread builds its service
+    and authorized HTTP session once and reuses it, and large lists of instances are split into as few
+    requests as the payload limit allows, which are sent in parallel.
+    """
+    _discovery_documents: Dict[str, str] = {}
+    _discovery_lock = threading.Lock()
+
+    def __init__(
+            self,
+            project: str,
+            region: Optional[str] = None,
+            api_endpoint: Optional[str] = None,
+            discovery_cache_path: Optional[str] = None,
+            credentials=None,
+            max_payload_bytes: int = MAX_PAYLOAD_BYTES,
+            max_parallel_requests: int = 4
+    ):
+        """
+        :param project: project where the Cloud ML Engine Model is deployed.
+        :param region: regional endpoint to use; set to None for ml.googleapis.com
+        :param api_endpoint: overrides the endpoint derived from the region, e.g. to point at a local stand-in.
+            Requests to http:// endpoints are not authorized.
+        :param discovery_cache_path: file the discovery document is cached in between processes
+        :param credentials: google.auth credentials, application default credentials are used if not set
+        :param max_payload_bytes: requests are split so that their bodies stay below this size
+        :param max_parallel_requests: how many of the split requests are in flight at the same time
+        """
+        self.project = project
+        if api_endpoint is None:
+            prefix = "{}-ml".format(region) if region else "ml"
+            api_endpoint = "https://{}.googleapis.com".format(prefix)
+        self.api_endpoint = api_endpoint
+        self.discovery_cache_path = discovery_cache_path
+        self.credentials = credentials
+        self.max_payload_bytes = max_payload_bytes
+        self.max_parallel_requests = max_parallel_requests
+        self.executor = ThreadPoolExecutor(max_workers=max_parallel_requests, thread_name_prefix="ai-platform")
+        self._local = threading.local()
+
+    def get_discovery_document(self) -> str:
+        """
+        Returns the discovery document of the ml v1 API. Looked up in memory, then on disk, then in the
+        documents shipped with googleapiclient and only then fetched over the network.
+        :return:
+        """
+        with self._discovery_lock:
+            if "ml.v1" in self._discovery_documents:
+                return self._discovery_documents["ml.v1"]
+
+            document = None
+            if self.discovery_cache_path and os.path.exists(self.discovery_cache_path):
+                with open(self.discovery_cache_path) as f:
+                    document = f.read()
+
+            if document is None:
+                try:
+                    from googleapiclient.discovery_cache import get_static_doc
+                    document = get_static_doc("ml", "v1")
+                except ImportError:
+                    document = None
+
+            if document is None:
+                response, content = httplib2.Http().request(DISCOVERY_URI)
+                if response.status >= 400:
+                    raise RuntimeError(f"Failed to fetch the discovery document: HTTP {response.status}")
+                document = content.decode("utf-8")
+
+            if self.discovery_cache_path and not os.path.exists(self.discovery_cache_path):
+                # written atomically, other processes may be reading the cache at the same time
+                directory = os.path.dirname(os.path.abspath(self.discovery_cache_path))
+                fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+                with os.fdopen(fd, "w") as f:
+                    f.write(document)
+                os.replace(tmp_path, self.discovery_cache_path)
+
+            self._discovery_documents["ml.v1"] = document
+            return document
+
+    def _get_http(self):
+        if self.api_endpoint.startswith("http://"):
+            return httplib2.Http()
+
+        import google.auth
+        import google_auth_httplib2
+
+        if self.credentials is None:
+            self.credentials, _ = google.auth.default(scopes=["https://www.googleapis.com/auth/cloud-platform"])
+        return google_auth_httplib2.AuthorizedHttp(self.credentials, http=httplib2.Http())
+
+    def get_service(self):
+        """
+        Returns the ML Engine service object of the calling thread, building it on first use.
+        httplib2 sessions are not thread-safe, so they are not shared between threads.
+        :return:
+        """
+        service = getattr(self._local, "service", None)
+        if service is None:
+            service = googleapiclient.discovery.build_from_document(
+                self.get_discovery_document(),
+                http=self._get_http(),
+                model=PreserializedJsonModel(),
+                client_options=ClientOptions(api_endpoint=self.api_endpoint)
+            )
+            self._local.service = service
+        return service
+
+    def split_instances(
+            self,
+            instances: List[Any]
+    ) -> List[List[str]]:
+        """
+        Serializes every instance once and splits them into consecutive chunks whose request bodies
+        stay below max_payload_bytes. The bodies are then built from the serialized instances.
+        :param instances:
+        :return: chunks of JSON serialized instances
+        """
+        # {"instances": [...]} plus a separator between instances
+        overhead = len('{"instances": []}')
+        chunks, chunk, chunk_size = [], [], overhead
+        for instance in instances:
+            serialized = json.dumps(instance)
+            size = len(serialized) + 1
+            if chunk and chunk_size + size > self.max_payload_bytes:
+                chunks.append(chunk)
+                chunk, chunk_size = [], overhead
+            chunk.append(serialized)
+            chunk_size += size
+
+        if chunk:
+            chunks.append(chunk)
+        return chunks
+
+    def _predict_chunk(
+            self,
+            name: str,
+            serialized_instances: List[str]
+    ) -> List[Any]:
+        response = self.get_service().projects().predict(
+            name=name,
+            body='{"instances": [' + ",".join(serialized_instances) + ']}'
+        ).execute()
+
+        if 'error' in response:
+            raise RuntimeError(response['error'])
+
+        return response['predictions']
+
+    def predict(
+            self,
+            model: str,
+            instances: List[Any],
+            version: Optional[str] = None
+    ) -> List[Any]:
+        """
+        Sends instances to a deployed model for prediction, in as many requests as the payload limit requires
+        :param model: model name.
+        :param instances: list of instances, e.g. one nested list per image
+        :param version: version of the model to target.
+        :return: one prediction per instance
+        """
+        name = 'projects/{}/models/{}'.format(self.project, model)
+        if version is not None:
+            name += '/versions/{}'.format(version)
+
+        chunks = self.split_instances(instances)
+        if len(chunks) == 1:
+            return self._predict_chunk(name, chunks[0])
+
+        predictions = []
+        for chunk_predictions in self.executor.map(lambda chunk: self._predict_chunk(name, chunk), chunks):
+            predictions.extend(chunk_predictions)
+        return predictions
+
+
+@lru_cache(maxsize=None)
+def get_ai_platform_client(
+        project: str,
+        region: Optional[str] = None
+) -> AIPlatformClient:
+    """
+    Returns a shared client for the project and region. AI_PLATFORM_ENDPOINT overrides the endpoint
+    and AI_PLATFORM_DISCOVERY_CACHE sets the file the discovery document is cached in.
+    :param project:
+    :param region:
+    :return:
+    """
+    return AIPlatformClient(
+        project,
+        region,
+        api_endpoint=os.environ.get("AI_PLATFORM_ENDPOINT"),
+        discovery_cache_path=os.environ.get("AI_PLATFORM_DISCOVERY_CACHE")
+    )
+
 
 def predict_json(project, region, model, instances, version=None):
     """Send json data to a deployed model for prediction.
@@ -18,25 +239,7 @@ def predict_json(project, region, model, instances, version=None):
         Mapping[str: any]: dictionary of prediction results defined by the
             model.
     """
-    # Create the ML Engine service object.
+    # The service object is created once per client and thread.
     # To authenticate set the environment variable
     # GOOGLE_APPLICATION_CREDENTIALS=<path_to_service_account_file>
-    prefix = "{}-ml".format(region) if region else "ml"
-    api_endpoint = "https://{}.googleapis.com".format(prefix)
-    client_options = ClientOptions(api_endpoint=api_endpoint)
-    service = googleapiclient.discovery.build(
-        'ml', 'v1', client_options=client_options)
-    name = 'projects/{}/models/{}'.format(project, model)
-
-    if version is not None:
-        name += '/versions/{}'.format(version)
-
-    response = service.projects().predict(
-        name=name,
-        body={'instances': instances}
-    ).execute()
-
-    if 'error' in response:
-        raise RuntimeError(response['error'])
-
-    return response['predictions']
\ No newline at end of file
+    return get_ai_platform_client(project, region).predict(model, instances, version)
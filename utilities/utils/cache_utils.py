@@ -0,0 +1,360 @@
+"""
+Caches for predictions and other expensive, content-addressable results
+"""
+import os
+import time
+import asyncio
+import logging
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import *
+
+import simplejson as json
+
+logger = logging.getLogger("cache_utils.py")
+
+
+def hash_bytes(
+        data: bytes
+) -> str:
+    """
+    Returns a fast, 128 bit hex digest of the data
+    :param data:
+    :return:
+    """
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+class LRUCache:
+    """
+    Thread-safe, in-process least recently used cache with an optional time to live
+    """
+    def __init__(
+            self,
+            max_entries: int = 4096,
+            ttl: Optional[float] = None
+    ):
+        """
+        :param max_entries: the least recently used entries are evicted beyond this size
+        :param ttl: entries older than this many seconds are not returned
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(
+            self,
+            key: str
+    ) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            created, value = entry
+            if self.ttl is not None and time.time() - created > self.ttl:
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(
+            self,
+            key: str,
+            value: Any
+    ):
+        with self._lock:
+            self._entries[key] = (time.time(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteCache:
+    """
+    On-disk cache backed by a SQLite database, which can be shared between the worker processes of a server.
+    Values must be JSON serializable.
+    """
+    EVICT_EVERY = 1000
+
+    def __init__(
+            self,
+            path: str,
+            max_entries: int = 100000,
+            ttl: Optional[float] = None
+    ):
+        """
+        :param path: path to the database file, created if it does not exist
+        :param max_entries: the oldest entries are evicted beyond this size
+        :param ttl: entries older than this many seconds are not returned, and deleted when evicting
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._local = threading.local()
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with self._connection() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS cache_created ON cache (created)")
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite connections can't be shared between threads, so every thread gets its own
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5.0)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def get(
+            self,
+            key: str
+    ) -> Optional[Any]:
+        row = self._connection().execute("SELECT value, created FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+
+        value, created = row
+        if self.ttl is not None and time.time() - created > self.ttl:
+            return None
+        return json.loads(value)
+
+    def set(
+            self,
+            key: str,
+            value: Any
+    ):
+        now = time.time()
+        with self._connection() as connection:
+            cursor = connection.execute(
+                "INSERT OR REPLACE INTO cache (key, value, created) VALUES (?, ?, ?)", (key, json.dumps(value), now)
+            )
+
+        # evicting is relatively expensive, so only do it every so often. The rowid of a new row is one more
+        # than the largest in the table, so it counts the writes of every process sharing the file.
+        if cursor.lastrowid % self.EVICT_EVERY == 0:
+            self.evict(now)
+
+    def evict(
+            self,
+            now: Optional[float] = None
+    ):
+        """
+        Deletes the expired entries, then the oldest ones beyond max_entries
+        :param now: defaults to the current time
+        :return:
+        """
+        now = now or time.time()
+        with self._connection() as connection:
+            if self.ttl is not None:
+                connection.execute("DELETE FROM cache WHERE created < ?", (now - self.ttl,))
+            connection.execute(
+                "DELETE FROM cache WHERE key IN "
+                "(SELECT key FROM cache ORDER BY created DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+
+    def clear(self):
+        with self._connection() as connection:
+            connection.execute("DELETE FROM cache")
+
+    def __len__(self):
+        return self._connection().execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+
+class PredictionCache:
+    """
+    Two-tier cache of predictions keyed by the hash of the uploaded image, the backend, the model version
+    and the input size. An in-process LRU tier sits in front of an optional on-disk tier shared between workers.
+    Entries of a previous model version are never returned, since the version is part of the key.
+    From async code, use get_many_async and set_in_background, which keep the disk I/O on the cache's own threads.
+    """
+    def __init__(
+            self,
+            memory_max_entries: int = 4096,
+            ttl: Optional[float] = None,
+            disk_path: Optional[str] = None,
+            disk_max_entries: int = 100000,
+            disk_workers: int = 2
+    ):
+        """
+        :param memory_max_entries: size of the in-process tier
+        :param ttl: time to live of the entries, in seconds. Entries never expire if not set.
+        :param disk_path: path to the SQLite database of the on-disk tier. There is no on-disk tier if not set.
+        :param disk_max_entries: size of the on-disk tier
+        :param disk_workers: number of threads the on-disk tier is read and written from by the async methods
+        """
+        self.memory = LRUCache(memory_max_entries, ttl)
+        self.disk = SQLiteCache(disk_path, disk_max_entries, ttl) if disk_path else None
+        self.executor = ThreadPoolExecutor(
+            max_workers=disk_workers, thread_name_prefix="prediction-cache"
+        ) if self.disk is not None else None
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(
+            image_bytes: bytes,
+            backend: str,
+            model_version: str,
+            image_size: int
+    ) -> str:
+        return f"{hash_bytes(image_bytes)}:{backend}:{model_version}:{image_size}"
+
+    def get(
+            self,
+            key: str
+    ) -> Optional[Any]:
+        value = self.memory.get(key)
+        if value is not None:
+            self.memory_hits += 1
+            return value
+
+        if self.disk is not None:
+            value = self.disk.get(key)
+            if value is not None:
+                self.disk_hits += 1
+                self.memory.set(key, value)
+                return value
+
+        self.misses += 1
+        return None
+
+    def _get_from_disk(
+            self,
+            keys: List[str]
+    ) -> List[Optional[Any]]:
+        values = [self.disk.get(key) for key in keys]
+        for key, value in zip(keys, values):
+            if value is not None:
+                self.memory.set(key, value)
+        return values
+
+    async def get_many_async(
+            self,
+            keys: Sequence[str]
+    ) -> List[Optional[Any]]:
+        """
+        Looks keys up like get, without blocking the event loop. The in-process tier is checked inline,
+        the keys it misses are read from the on-disk tier in one call on the cache's threads.
+        :param keys:
+        :return: the value of every key, None for the ones that are not cached
+        """
+        values = [self.memory.get(key) for key in keys]
+        missing = [i for i, value in enumerate(values) if value is None]
+        self.memory_hits += len(keys) - len(missing)
+
+        if missing and self.disk is not None:
+            disk_values = await asyncio.get_event_loop().run_in_executor(
+                self.executor, self._get_from_disk, [keys[i] for i in missing]
+            )
+            for i, value in zip(missing, disk_values):
+                values[i] = value
+            self.disk_hits += sum(value is not None for value in disk_values)
+
+        self.misses += sum(value is None for value in values)
+        return values
+
+    def set(
+            self,
+            key: str,
+            value: Any
+    ):
+        self.memory.set(key, value)
+        if self.disk is not None:
+            self.disk.set(key, value)
+
+    def _set_on_disk(
+            self,
+            key: str,
+            value: Any
+    ):
+        try:
+            self.disk.set(key, value)
+        except Exception as e:
+            logger.error(f"Failed to write {key} to the on-disk prediction cache: {e}")
+
+    def set_in_background(
+            self,
+            key: str,
+            value: Any
+    ):
+        """
+        Sets the value in the in-process tier right away and writes it to the on-disk tier on the cache's threads,
+        so it can be called from the event loop
+        :param key:
+        :param value:
+        :return:
+        """
+        self.memory.set(key, value)
+        if self.disk is not None:
+            self.executor.submit(self._set_on_disk, key, value)
+
+    def invalidate(self):
+        """
+        Drops every entry from both tiers
+        :return:
+        """
+        self.memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
+
+    def get_metrics(self) -> Dict[str, Any]:
+        return self._metrics(len(self.disk) if self.disk is not None else 0)
+
+    async def get_metrics_async(self) -> Dict[str, Any]:
+        """
+        Returns the metrics like get_metrics, counting the entries of the on-disk tier on the cache's threads
+        :return:
+        """
+        disk_entries = 0
+        if self.disk is not None:
+            disk_entries = await asyncio.get_event_loop().run_in_executor(self.executor, len, self.disk)
+        return self._metrics(disk_entries)
+
+    def _metrics(
+            self,
+            disk_entries: int
+    ) -> Dict[str, Any]:
+        hits = self.memory_hits + self.disk_hits
+        lookups = hits + self.misses
+        return {
+            "hits": hits,
+            "memoryHits": self.memory_hits,
+            "diskHits": self.disk_hits,
+            "misses": self.misses,
+            "hitRate": round(hits / lookups, 4) if lookups else 0.0,
+            "memoryEntries": len(self.memory),
+            "diskEntries": disk_entries
+        }
+
+    def close(
+            self,
+            wait: bool = True
+    ):
+        """
+        Stops the threads of the on-disk tier
+        :param wait: whether to wait for the writes still queued
+        :return:
+        """
+        if self.executor is not None:
+            self.executor.shutdown(wait=wait)
@@ -0,0 +1,128 @@
+"""
+A local HTTP stand-in for AI Platform online predictions, for tests and load tests without a GCP project
+"""
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import *
+
+import numpy as np
+import simplejson as json
+
+from utils.ai_platform_utils import MAX_PAYLOAD_BYTES
+
+PREDICT_PATH_PATTERN = re.compile(r"^/v1/projects/(?P<project>[^/]+)/models/(?P<model>[^/:]+)"
+                                  r"(?:/versions/(?P<version>[^/:]+))?:predict$")
+
+
+class FakeAIPlatformServer:
+    """
+    Serves POST /v1/projects/{project}/models/{model}[/versions/{version}]:predict on a local port.
+    Predictions come from a fixed random linear classifier on the per-channel means of the instances,
+    bodies larger than the payload limit are rejected like the real service does.
+    """
+    def __init__(
+            self,
+            host: str = "127.0.0.1",
+            port: int = 0,
+            num_classes: int = 4,
+            max_payload_bytes: int = MAX_PAYLOAD_BYTES,
+            latency_ms: float = 0.0,
+            seed: int = 0
+    ):
+        """
+        :param host:
+        :param port: port to listen on, a free port is picked if 0
+        :param num_classes: number of output scores per instance
+        :param max_payload_bytes: requests with larger bodies get a 400 response
+        :param latency_ms: time every request sleeps for, to simulate the cost of a forward pass
+        :param seed: seed of the random classifier weights
+        """
+        self.num_classes = num_classes
+        self.max_payload_bytes = max_payload_bytes
+        self.latency = latency_ms / 1000.
+        self.rng = np.random.RandomState(seed)
+        self.weights = None
+        self.bias = self.rng.normal(size=num_classes)
+
+        self.predict_calls = 0
+        self.predicted_instances = 0
+        self.rejected_calls = 0
+        self._lock = threading.Lock()
+
+        self.server = ThreadingHTTPServer((host, port), self._make_handler())
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.api_endpoint = f"http://{host}:{self.port}"
+        self._thread = None
+
+    def predict(
+            self,
+            instances: List[Any]
+    ) -> List[List[float]]:
+        inputs = np.asarray(instances, dtype=np.float32)
+        channel_means = inputs.reshape(len(inputs), -1, inputs.shape[-1]).mean(axis=1)
+        if self.weights is None:
+            self.weights = self.rng.normal(scale=0.05, size=(inputs.shape[-1], self.num_classes))
+
+        logits = channel_means @ self.weights + self.bias
+        scores = np.exp(logits - logits.max(axis=1, keepdims=True))
+        scores /= scores.sum(axis=1, keepdims=True)
+        return scores.tolist()
+
+    def _make_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _respond(self, status: int, body: dict):
+                content = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length)
+
+                if PREDICT_PATH_PATTERN.match(self.path.split("?")[0]) is None:
+                    return self._respond(404, {"error": {"code": 404, "message": f"Unknown path {self.path}"}})
+
+                if length > fake.max_payload_bytes:
+                    with fake._lock:
+                        fake.rejected_calls += 1
+                    return self._respond(400, {"error": {
+                        "code": 400, "message": f"Request payload size exceeds the limit: {fake.max_payload_bytes} bytes."
+                    }})
+
+                instances = json.loads(body)["instances"]
+                if fake.latency:
+                    time.sleep(fake.latency)
+
+                with fake._lock:
+                    predictions = fake.predict(instances)
+                    fake.predict_calls += 1
+                    fake.predicted_instances += len(instances)
+                self._respond(200, {"predictions": predictions})
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def start(self) -> "FakeAIPlatformServer":
+        self._thread = threading.Thread(target=self.server.serve_forever, name="fake-ai-platform", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
@@ -0,0 +1,149 @@
+"""
+An in-process stand-in for TF Serving, for tests and load tests on machines without the real service
+"""
+import time
+from concurrent import futures
+from typing import *
+
+import grpc
+import numpy as np
+from tensorflow_serving.apis import predict_pb2, get_model_metadata_pb2, prediction_service_pb2_grpc
+from tensorflow_serving.apis.get_model_metadata_pb2 import SignatureDefMap
+
+from utils.serving_utils import ndarray_to_tensor_proto, tensor_proto_to_ndarray, types_pb2
+
+
+class FakePredictionService(prediction_service_pb2_grpc.PredictionServiceServicer):
+    """
+    Implements the GetModelMetadata and Predict RPCs of TF Serving for a single model.
+    Predictions come from a fixed random linear classifier on the per-channel means of the images,
+    so they are cheap and deterministic.
+    """
+    def __init__(
+            self,
+            model_name: str = "simclr-oct",
+            version: int = 1,
+            input_shape: Tuple[int, int, int] = (80, 80, 3),
+            num_classes: int = 4,
+            input_name: str = "input_1",
+            output_name: str = "dense",
+            signature_name: str = "serving_default",
+            latency_ms: float = 0.0,
+            seed: int = 0
+    ):
+        """
+        :param model_name: name of the served model, requests for other models are rejected
+        :param version: version reported in the responses
+        :param input_shape: shape of a single input image
+        :param num_classes: number of output scores per image
+        :param input_name:
+        :param output_name:
+        :param signature_name:
+        :param latency_ms: time every Predict call sleeps for, to simulate the cost of a forward pass
+        :param seed: seed of the random classifier weights
+        """
+        self.model_name = model_name
+        self.version = version
+        self.input_shape = tuple(input_shape)
+        self.num_classes = num_classes
+        self.input_name = input_name
+        self.output_name = output_name
+        self.signature_name = signature_name
+        self.latency = latency_ms / 1000.
+
+        rng = np.random.RandomState(seed)
+        self.weights = rng.normal(scale=0.05, size=(input_shape[-1], num_classes)).astype(np.float32)
+        self.bias = rng.normal(size=num_classes).astype(np.float32)
+
+        self.metadata_calls = 0
+        self.predict_calls = 0
+        self.predicted_images = 0
+
+    def _check_model_spec(self, model_spec, context):
+        if model_spec.name != self.model_name:
+            context.abort(grpc.StatusCode.NOT_FOUND, f"Servable not found for request: Latest({model_spec.name})")
+
+    def GetModelMetadata(self, request, context):
+        self._check_model_spec(request.model_spec, context)
+        self.metadata_calls += 1
+
+        signature_def_map = SignatureDefMap()
+        signature_def = signature_def_map.signature_def[self.signature_name]
+        signature_def.inputs[self.input_name].dtype = types_pb2.DT_FLOAT
+        for size in (-1, *self.input_shape):
+            signature_def.inputs[self.input_name].tensor_shape.dim.add(size=size)
+        signature_def.outputs[self.output_name].dtype = types_pb2.DT_FLOAT
+        for size in (-1, self.num_classes):
+            signature_def.outputs[self.output_name].tensor_shape.dim.add(size=size)
+
+        response = get_model_metadata_pb2.GetModelMetadataResponse()
+        response.model_spec.name = self.model_name
+        response.model_spec.version.value = self.version
+        response.metadata["signature_def"].Pack(signature_def_map)
+        return response
+
+    def Predict(self, request, context):
+        self._check_model_spec(request.model_spec, context)
+        if self.input_name not in request.inputs:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, f"input tensor alias not found in signature")
+
+        inputs = tensor_proto_to_ndarray(request.inputs[self.input_name])
+        if inputs.shape[1:] != self.input_shape:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, f"Expected inputs of shape {self.input_shape}")
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        logits = inputs.mean(axis=(1, 2)) @ self.weights + self.bias
+        scores = np.exp(logits - logits.max(axis=1, keepdims=True))
+        scores /= scores.sum(axis=1, keepdims=True)
+
+        self.predict_calls += 1
+        self.predicted_images += len(inputs)
+
+        response = predict_pb2.PredictResponse()
+        response.model_spec.name = self.model_name
+        response.model_spec.version.value = self.version
+        response.model_spec.signature_name = self.signature_name
+        response.outputs[self.output_name].CopyFrom(ndarray_to_tensor_proto(scores.astype(np.float32)))
+        return response
+
+
+class FakeTFServingServer:
+    """
+    Runs a FakePredictionService on a local gRPC server
+    """
+    def __init__(
+            self,
+            host: str = "127.0.0.1",
+            port: int = 0,
+            max_workers: int = 8,
+            **service_kwargs
+    ):
+        """
+        :param host:
+        :param port: port to listen on, a free port is picked if 0
+        :param max_workers: number of threads serving requests
+        :param service_kwargs: passed on to FakePredictionService
+        """
+        self.service = FakePredictionService(**service_kwargs)
+        self.server = grpc.server(futures.ThreadPoolExecutor(max_workers=max_workers))
+        prediction_service_pb2_grpc.add_PredictionServiceServicer_to_server(self.service, self.server)
+        self.port = self.server.add_insecure_port(f"{host}:{port}")
+        self.address = f"{host}:{self.port}"
+
+    def start(self) -> "FakeTFServingServer":
+        self.server.start()
+        return self
+
+    def stop(
+            self,
+            grace: Optional[float] = None
+    ):
+        self.server.stop(grace)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
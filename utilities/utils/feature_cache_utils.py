@@ -0,0 +1,242 @@
+"""
+Pooled features of the frozen pre-trained backbones, computed once per dataset and stored as memory-mapped .npy files.
+get_pre_trained_model freezes the backbone, so training only its classification head
+(model_utils.get_classification_head) on cached features gives the same model without running the backbone
+every epoch. Augmentation can not be applied to cached features.
+
+Layout of a cache directory, one entry per subset directory, backbone, weights, pooling and input shape:
+    <key>/features.npy  float32 array of shape (n, feature dimension)
+    <key>/labels.npy    int16 array of shape (n,)
+    <key>/meta.json     written last, an entry without it is incomplete
+"""
+import functools
+import hashlib
+import os
+from pathlib import Path
+from typing import *
+
+import numpy as np
+import simplejson as json
+import tensorflow as tf
+from tensorflow.keras.models import Model
+
+from utils import generator_utils, model_utils
+
+FEATURE_CACHE_VERSION = 1
+AUTOTUNE = tf.data.experimental.AUTOTUNE
+
+
+def feature_cache_key(
+        base_model: str,
+        weights: Optional[str],
+        pooling: str,
+        input_shape: Tuple[int, int, int],
+        file_paths: List[str]
+) -> str:
+    """
+    Returns the name of the cache entry for the features of a list of files.
+    Files are identified by their path, size and modification time, any change to them invalidates the entry.
+    :param base_model:
+    :param weights:
+    :param pooling:
+    :param input_shape:
+    :param file_paths:
+    :return:
+    """
+    fingerprint = hashlib.blake2b(digest_size=16)
+    fingerprint.update(json.dumps({
+        "version": FEATURE_CACHE_VERSION, "base_model": base_model, "weights": weights, "pooling": pooling,
+        "input_shape": list(input_shape)
+    }, sort_keys=True).encode("utf-8"))
+    for path in file_paths:
+        stat = os.stat(path)
+        fingerprint.update(f"{path}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode("utf-8"))
+
+    return f"{base_model}-{pooling}-{'x'.join(str(d) for d in input_shape)}-{fingerprint.hexdigest()}"
+
+
+def load_cached_features(
+        entry: Path
+) -> Optional[Tuple[np.ndarray, np.ndarray, dict]]:
+    """
+    Returns the features (memory-mapped), labels and metadata of a cache entry, None if it does not exist
+    :param entry:
+    :return:
+    """
+    try:
+        with open(entry / "meta.json") as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        return None
+
+    return np.load(entry / "features.npy", mmap_mode="r"), np.load(entry / "labels.npy"), meta
+
+
+def extract_features(
+        directory: Union[Path, str],
+        cache_directory: Union[Path, str],
+        base_model: str,
+        input_shape: Tuple[int, int, int] = (256, 256, 3),
+        pooling: str = "max",
+        weights: Optional[str] = "imagenet",
+        batch_size: int = 64,
+        mixed_precision: Optional[str] = None,
+        backbone: Optional[Model] = None
+) -> Tuple[np.ndarray, np.ndarray, dict]:
+    """
+    Returns the pooled backbone features of the images in a directory laid out like flow_from_directory expects,
+    computing and caching them the first time.
+    Images go through the same decoding and scaling as generator_utils.create_dataset.
+    :param directory:
+    :param cache_directory:
+    :param base_model: one of model_utils.BASE_NAME_MODEL_MAP
+    :param input_shape:
+    :param pooling: max or avg
+    :param weights:
+    :param batch_size:
+    :param mixed_precision: see model_utils.get_pre_trained_model, features are stored as float32 regardless
+    :param backbone: the backbone to use, built from the other arguments if not given
+    :return: features (memory-mapped), labels and metadata with the class names
+    """
+    file_paths, labels, class_names = generator_utils.list_image_files(directory)
+    if not file_paths:
+        raise ValueError(f"Found no images in {directory}")
+
+    entry = Path(cache_directory) / feature_cache_key(base_model, weights, pooling, input_shape, file_paths)
+    cached = load_cached_features(entry)
+    if cached is not None:
+        return cached
+
+    if backbone is None:
+        with model_utils.global_dtype_policy(mixed_precision):
+            backbone = model_utils.get_backbone(base_model, input_shape, pooling, weights)
+
+    @tf.function
+    def embed(images):
+        return tf.cast(backbone(images, training=False), tf.float32)
+
+    dataset = generator_utils.create_dataset(
+        directory, target_size=input_shape[:2], batch_size=batch_size, class_mode="sparse", shuffle=False
+    )
+
+    entry.mkdir(parents=True, exist_ok=True)
+    features = np.lib.format.open_memmap(
+        entry / "features.npy.tmp", mode="w+", dtype=np.float32, shape=(len(file_paths), backbone.output_shape[-1])
+    )
+    start = 0
+    for images, _ in dataset:
+        batch_features = embed(images).numpy()
+        features[start:start + len(batch_features)] = batch_features
+        start += len(batch_features)
+    features.flush()
+    del features
+
+    os.replace(entry / "features.npy.tmp", entry / "features.npy")
+    np.save(entry / "labels.npy", np.asarray(labels, dtype=np.int16))
+    meta = {
+        "directory": str(directory), "base_model": base_model, "weights": weights, "pooling": pooling,
+        "input_shape": list(input_shape), "class_names": class_names, "num_examples": len(file_paths)
+    }
+    with open(entry / "meta.json", "w") as f:
+        json.dump(meta, f)
+
+    return load_cached_features(entry)
+
+
+def create_feature_datasets(
+        path_to_data: Union[Path, str],
+        cache_directory: Union[Path, str],
+        base_model: str,
+        input_shape: Tuple[int, int, int] = (256, 256, 3),
+        pooling: str = "max",
+        weights: Optional[str] = "imagenet",
+        batch_size: int = 32,
+        class_mode: str = "categorical",
+        seed: Optional[int] = None,
+        extraction_batch_size: int = 64,
+        mixed_precision: Optional[str] = None
+) -> Dict[str, tf.data.Dataset]:
+    """
+    Counterpart of generator_utils.create_datasets yielding (features, labels) batches of cached backbone features,
+    for training a model_utils.get_classification_head. Only the train dataset is shuffled.
+    Features missing from the cache are computed with a single instance of the backbone.
+    :param path_to_data: directory with train, val and test sub-directories
+    :param cache_directory:
+    :param base_model: one of model_utils.BASE_NAME_MODEL_MAP
+    :param input_shape:
+    :param pooling:
+    :param weights:
+    :param batch_size:
+    :param class_mode: 'categorical' for one-hot labels, 'sparse' for class indices
+    :param seed: seed for shuffling
+    :param extraction_batch_size: batch size of the backbone when computing features
+    :param mixed_precision: see model_utils.get_pre_trained_model
+    :return:
+    """
+    if class_mode not in ("categorical", "sparse"):
+        raise ValueError(f"{class_mode} is not a valid class mode. Must be one of ['categorical', 'sparse']")
+
+    path_to_data = Path(path_to_data)
+    backbone = None
+
+    datasets = {}
+    for subset in ("train", "val", "test"):
+        if not (path_to_data / subset).is_dir():
+            continue
+
+        file_paths, _, _ = generator_utils.list_image_files(path_to_data / subset)
+        cached = load_cached_features(
+            Path(cache_directory) / feature_cache_key(base_model, weights, pooling, input_shape, file_paths)
+        )
+        if cached is None and backbone is None:
+            with model_utils.global_dtype_policy(mixed_precision):
+                backbone = model_utils.get_backbone(base_model, input_shape, pooling, weights)
+
+        print(f"{'Loading' if cached else 'Computing'} {subset} features.")
+        features, labels, meta = cached or extract_features(
+            path_to_data / subset, cache_directory, base_model, input_shape, pooling, weights,
+            batch_size=extraction_batch_size, backbone=backbone
+        )
+
+        # only the indices go through the pipeline, so that features are read from the memory-mapped cache
+        # batch by batch instead of being copied into the graph, which is limited to 2 GB
+        dataset = tf.data.Dataset.range(len(features))
+        if subset == "train":
+            dataset = dataset.shuffle(len(features), seed=seed, reshuffle_each_iteration=True)
+        dataset = dataset.batch(batch_size).map(
+            functools.partial(
+                gather_cached_features, features=features, labels=labels.astype(np.int32),
+                num_classes=len(meta["class_names"]) if class_mode == "categorical" else None
+            ),
+            num_parallel_calls=AUTOTUNE
+        )
+        datasets[subset] = dataset.prefetch(AUTOTUNE)
+
+    return datasets
+
+
+def gather_cached_features(
+        indices: tf.Tensor,
+        features: np.ndarray,
+        labels: np.ndarray,
+        num_classes: Optional[int] = None
+) -> Tuple[tf.Tensor, tf.Tensor]:
+    """
+    Reads a batch of cached features and their labels
+    :param indices: indices of the examples of the batch
+    :param features: memory-mapped features of the cache entry
+    :param labels:
+    :param num_classes: labels are one-hot encoded if set
+    :return:
+    """
+    def _gather(batch_indices):
+        # in increasing order, so that the memory-mapped file is read sequentially
+        batch_indices = np.sort(batch_indices)
+        return np.asarray(features[batch_indices]), labels[batch_indices]
+
+    batch_features, batch_labels = tf.numpy_function(_gather, [indices], (tf.float32, tf.int32))
+    batch_features.set_shape((None, features.shape[-1]))
+    batch_labels.set_shape((None, ))
+    if num_classes is not None:
+        batch_labels = tf.one_hot(batch_labels, num_classes)
+    return batch_features, batch_labels
@@ -1,13 +1,37 @@
 """
 All Google Cloud Storage utilities go here
 """
+import threading
 from typing import *
 
-from google.cloud import storage
+if TYPE_CHECKING:
+    from google.cloud import storage
 
 
-# create a reusable client instead of opening up a new one each time
-STORAGE_CLIENT = storage.Client()
+_storage_client = None
+_storage_client_lock = threading.Lock()
+
+
+def get_storage_client() -> "storage.Client":
+    """
+    Returns a reusable client instead of opening up a new one each time.
+    The client is created on first use, so importing this module does not touch the network.
+    :return:
+    """
+    global _storage_client
+    if _storage_client is None:
+        with _storage_client_lock:
+            if _storage_client is None:
+                from google.cloud import storage
+                _storage_client = storage.Client()
+    return _storage_client
+
+
+def __getattr__(name: str):
+    # STORAGE_CLIENT used to be created at import, keep it available as a lazy attribute
+    if name == "STORAGE_CLIENT":
+        return get_storage_client()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def upload_to_gcs_from_file(
@@ -15,7 +39,7 @@ def upload_to_gcs_from_file(
         bucket_name: str,
         file_save_path: str,
         return_blob: bool = False,
-) -> Union[None, storage.blob.Blob]:
+) -> Union[None, "storage.blob.Blob"]:
     """
     Uploads a file to the specified gcs bucket. If specified returns instance of gcs blob
     :param file:
@@ -24,7 +48,7 @@ def upload_to_gcs_from_file(
     :param return_blob:
     :return:
     """
-    client = STORAGE_CLIENT
+    client = get_storage_client()
     bucket = client.bucket(bucket_name)
     blob = bucket.blob(file_save_path)
     blob.upload_from_file(file)
@@ -38,7 +62,7 @@ def upload_to_gcs_from_filename(
         bucket_name: str,
         file_save_path: str,
         return_blob: bool = False,
-) -> Union[None, storage.blob.Blob]:
+) -> Union[None, "storage.blob.Blob"]:
     """
     Uploads a file to the specified gcs bucket from a filename. If specified returns instance of gcs blob
     :param filename:
@@ -47,7 +71,7 @@ def upload_to_gcs_from_filename(
     :param return_blob:
     :return:
     """
-    client = STORAGE_CLIENT
+    client = get_storage_client()
     bucket = client.bucket(bucket_name)
     blob = bucket.blob(file_save_path)
     blob.upload_from_filename(filename)
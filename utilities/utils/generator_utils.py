@@ -1,8 +1,20 @@
 import os
 from typing import *
 from pathlib import Path
+
+import numpy as np
+import tensorflow as tf
 from tensorflow.keras.preprocessing.image import ImageDataGenerator
 
+AUTOTUNE = tf.data.experimental.AUTOTUNE
+IMAGE_EXTENSIONS = ('.jpeg', '.jpg', '.png', '.bmp', '.gif')
+
+# ImageDataGenerator augmentation arguments the tf.data pipeline supports
+AUGMENTATION_ARGUMENTS = (
+    'horizontal_flip', 'vertical_flip', 'rotation_range', 'width_shift_range', 'height_shift_range',
+    'zoom_range', 'fill_mode', 'cval', 'channel_shift_range', 'brightness_range'
+)
+
 
 def get_generator_instances(
         **kwargs
@@ -52,7 +64,8 @@ def get_generator_instances(
 def create_flows(
         path_to_data: Union[Path, str],
         train_generator: ImageDataGenerator,
-        generator: ImageDataGenerator
+        generator: ImageDataGenerator,
+        **flow_kwargs
 ):
     """
     Returns flows obtained from the ImageDataGenerator class.
@@ -60,6 +73,7 @@ def create_flows(
     :param path_to_data:
     :param train_generator:
     :param generator:
+    :param flow_kwargs: passed on to flow_from_directory, e.g. target_size or batch_size
     :return:
     """
     if isinstance(path_to_data, str):
@@ -79,17 +93,361 @@ def create_flows(
 
     if "train" in subsets:
         print(f"Creating train data flow.")
-        flows['train'] = train_generator.flow_from_directory(path_to_data / "train")
+        flows['train'] = train_generator.flow_from_directory(path_to_data / "train", **flow_kwargs)
 
     if "val" in subsets:
         print(f"Creating val data flow.")
-        flows['val'] = generator.flow_from_directory(path_to_data / "val")
+        flows['val'] = generator.flow_from_directory(path_to_data / "val", **flow_kwargs)
 
     if "test" in subsets:
         print(f"Creating test data flow.")
-        flows['test'] = generator.flow_from_directory(path_to_data / "test")
+        flows['test'] = generator.flow_from_directory(path_to_data / "test", **flow_kwargs)
 
     flows = {subset: flow for subset, flow in flows.items() if flow is not None}
     return flows
 
 
+def list_image_files(
+        directory: Union[Path, str]
+) -> Tuple[List[str], List[int], List[str]]:
+    """
+    Lists the images in a directory laid out like flow_from_directory expects, one sub-directory per class.
+    Files and classes are sorted, so the order is the same on every machine.
+    :param directory:
+    :return: file paths, class index of every file, class names
+    """
+    directory = Path(directory)
+    class_names = sorted(d.name for d in directory.iterdir() if d.is_dir())
+
+    file_paths, labels = [], []
+    for class_index, class_name in enumerate(class_names):
+        for root, _, filenames in sorted(os.walk(directory / class_name)):
+            for filename in sorted(filenames):
+                if filename.lower().endswith(IMAGE_EXTENSIONS):
+                    file_paths.append(os.path.join(root, filename))
+                    labels.append(class_index)
+
+    return file_paths, labels, class_names
+
+
+def _get_preprocessing_layers():
+    # the random image layers are experimental in tf 2.4 and part of the stable api in later versions
+    try:
+        return tf.keras.layers.experimental.preprocessing
+    except AttributeError:
+        return tf.keras.layers
+
+
+def get_augmentation_model(
+        target_size: Tuple[int, int],
+        horizontal_flip: bool = False,
+        vertical_flip: bool = False,
+        rotation_range: float = 0,
+        width_shift_range: float = 0.0,
+        height_shift_range: float = 0.0,
+        zoom_range: float = 0.0,
+        fill_mode: str = 'nearest',
+        cval: float = 0.0,
+        seed: Optional[int] = None
+) -> Optional[tf.keras.Sequential]:
+    """
+    Builds the random transformations of an ImageDataGenerator with the same arguments
+    out of keras preprocessing layers, which run on whole batches inside the tf.data pipeline.
+    Returns None if no transformation is enabled.
+    :param target_size: (height, width) of the images, shifts given in pixels are relative to it
+    :param horizontal_flip:
+    :param vertical_flip:
+    :param rotation_range: degrees
+    :param width_shift_range: fraction of the width, or pixels if >= 1
+    :param height_shift_range: fraction of the height, or pixels if >= 1
+    :param zoom_range:
+    :param fill_mode: one of 'constant', 'nearest', 'reflect' or 'wrap'
+    :param cval: value used for points outside the boundaries when fill_mode is 'constant'
+    :param seed:
+    :return:
+    """
+    preprocessing = _get_preprocessing_layers()
+    layers = []
+
+    flip_mode = "_and_".join(
+        mode for mode, enabled in (("horizontal", horizontal_flip), ("vertical", vertical_flip)) if enabled
+    )
+    if flip_mode:
+        layers.append(preprocessing.RandomFlip(flip_mode, seed=seed))
+
+    if rotation_range:
+        layers.append(preprocessing.RandomRotation(
+            rotation_range / 360., fill_mode=fill_mode, fill_value=cval, seed=seed
+        ))
+
+    if width_shift_range or height_shift_range:
+        height_factor = height_shift_range / target_size[0] if height_shift_range >= 1 else height_shift_range
+        width_factor = width_shift_range / target_size[1] if width_shift_range >= 1 else width_shift_range
+        layers.append(preprocessing.RandomTranslation(
+            height_factor, width_factor, fill_mode=fill_mode, fill_value=cval, seed=seed
+        ))
+
+    if zoom_range:
+        layers.append(preprocessing.RandomZoom(zoom_range, fill_mode=fill_mode, fill_value=cval, seed=seed))
+
+    if not layers:
+        return None
+    return tf.keras.Sequential(layers, name="augmentation")
+
+
+def create_dataset(
+        directory: Union[Path, str],
+        target_size: Tuple[int, int] = (256, 256),
+        batch_size: int = 32,
+        class_mode: str = "categorical",
+        shuffle: bool = True,
+        seed: Optional[int] = None,
+        interpolation: str = "nearest",
+        cache: Union[bool, str] = False,
+        shuffle_buffer_size: int = 1000,
+        num_shards: int = 1,
+        shard_index: int = 0,
+        channel_shift_range: float = 0.0,
+        brightness_range: Optional[Tuple[float, float]] = None,
+        **augmentation_kwargs
+) -> tf.data.Dataset:
+    """
+    tf.data counterpart of ImageDataGenerator.flow_from_directory, yielding the same (images, labels) batches
+    with the pixel values scaled to [0, 1].
+    Images are decoded and resized in parallel, cached as uint8 if requested, augmented batch-wise
+    and prefetched while the model trains on the previous batch.
+    :param directory: directory with one sub-directory of images per class
+    :param target_size: (height, width) images are resized to
+    :param batch_size:
+    :param class_mode: 'categorical' for one-hot labels, 'sparse' for class indices
+    :param shuffle: whether to shuffle the images, reshuffled every epoch
+    :param seed: seed for shuffling and augmentation
+    :param interpolation: resize method, 'nearest' as in flow_from_directory
+    :param cache: True to cache the decoded images in memory, a path to cache them in files with that prefix
+    :param shuffle_buffer_size: number of decoded images shuffled at a time every epoch when the images are cached
+    :param num_shards: number of shards the files are split into, e.g. one per worker of a distributed job
+    :param shard_index: shard of this worker. Files are sharded before shuffling, so shards never overlap.
+    :param channel_shift_range: as in ImageDataGenerator, in the 0-255 range
+    :param brightness_range: as in ImageDataGenerator, (min, max) factor the images are multiplied with
+    :param augmentation_kwargs: passed on to get_augmentation_model, unknown arguments are ignored
+    :return:
+    """
+    file_paths, labels, class_names = list_image_files(directory)
+    if not file_paths:
+        raise ValueError(f"Found no images in {directory}")
+
+    if class_mode == "categorical":
+        labels = tf.one_hot(labels, len(class_names))
+    elif class_mode != "sparse":
+        raise ValueError(f"{class_mode} is not a valid class mode. Must be one of ['categorical', 'sparse']")
+
+    dataset = tf.data.Dataset.from_tensor_slices((file_paths, labels))
+    if num_shards > 1:
+        dataset = dataset.shard(num_shards, shard_index)
+
+    # without a cache, shuffling the (cheap) file names every epoch is enough. A cache freezes the order of
+    # its first epoch, so cached datasets shuffle the file names once, for the files are listed class by class
+    # and a buffer alone would not mix the classes, and shuffle the decoded images coming out of the cache too
+    if shuffle:
+        dataset = dataset.shuffle(len(file_paths), seed=seed, reshuffle_each_iteration=not cache)
+
+    def decode(path, label):
+        img = tf.io.decode_image(tf.io.read_file(path), channels=3, expand_animations=False)
+        img = tf.image.resize(img, target_size, method=interpolation)
+        return tf.cast(img, tf.uint8), label
+
+    dataset = dataset.map(decode, num_parallel_calls=AUTOTUNE)
+
+    if cache:
+        dataset = dataset.cache("" if cache is True else str(cache))
+        if shuffle:
+            dataset = dataset.shuffle(shuffle_buffer_size, seed=seed, reshuffle_each_iteration=True)
+
+    return batch_and_augment(
+        dataset, batch_size, target_size, seed=seed, channel_shift_range=channel_shift_range,
+        brightness_range=brightness_range, **augmentation_kwargs
+    )
+
+
+def batch_and_augment(
+        dataset: tf.data.Dataset,
+        batch_size: int,
+        target_size: Tuple[int, int],
+        seed: Optional[int] = None,
+        channel_shift_range: float = 0.0,
+        brightness_range: Optional[Tuple[float, float]] = None,
+        **augmentation_kwargs
+) -> tf.data.Dataset:
+    """
+    Batches a dataset of (uint8 image, label) pairs, augments the batches, scales them to [0, 1] and prefetches them.
+    Single channel images are expanded to 3 channels.
+    :param dataset:
+    :param batch_size:
+    :param target_size: (height, width) of the images
+    :param seed: seed for the augmentation
+    :param channel_shift_range: see create_dataset
+    :param brightness_range: see create_dataset
+    :param augmentation_kwargs: passed on to get_augmentation_model, unknown arguments are ignored
+    :return:
+    """
+    dataset = dataset.batch(batch_size)
+
+    augmentation = get_augmentation_model(
+        target_size, seed=seed, **{k: v for k, v in augmentation_kwargs.items() if k in AUGMENTATION_ARGUMENTS}
+    )
+
+    def transform(images, labels):
+        images = tf.cast(images, tf.float32)
+        if images.shape[-1] == 1:
+            images = tf.image.grayscale_to_rgb(images)
+        if brightness_range:
+            factors = tf.random.uniform([tf.shape(images)[0], 1, 1, 1], *brightness_range, seed=seed)
+            images = images * factors
+        if channel_shift_range:
+            shifts = tf.random.uniform(
+                [tf.shape(images)[0], 1, 1, 3], -channel_shift_range, channel_shift_range, seed=seed
+            )
+            images = tf.clip_by_value(images + shifts, 0., 255.)
+        if augmentation is not None:
+            images = augmentation(images, training=True)
+        return images / 255., labels
+
+    dataset = dataset.map(transform, num_parallel_calls=AUTOTUNE)
+    return dataset.prefetch(AUTOTUNE)
+
+
+def create_datasets(
+        path_to_data: Union[Path, str],
+        cache: Union[bool, str] = False,
+        **kwargs
+) -> Dict[str, tf.data.Dataset]:
+    """
+    tf.data counterpart of create_flows, returns a dataset for each of the train, val and test directories found.
+    Augmentation arguments (see create_dataset) only apply to the train dataset,
+    the val and test datasets are not shuffled.
+    :param path_to_data:
+    :param cache: True to cache the decoded images in memory, a directory to cache them in files
+    :param kwargs: passed on to create_dataset, unknown arguments are ignored, so a whole config can be passed
+    :return:
+    """
+    if isinstance(path_to_data, str):
+        path_to_data = Path(path_to_data)
+
+    subsets = [s for s in os.listdir(path_to_data) if
+               os.path.isdir(path_to_data / s)]
+
+    dataset_kwargs = {
+        k: kwargs[k] for k in (
+            "target_size", "batch_size", "class_mode", "seed", "interpolation",
+            "shuffle_buffer_size", "num_shards", "shard_index"
+        ) if k in kwargs
+    }
+    augmentation_kwargs = {k: v for k, v in kwargs.items() if k in AUGMENTATION_ARGUMENTS}
+
+    datasets = {}
+    for subset in ("train", "val", "test"):
+        if subset not in subsets:
+            continue
+
+        print(f"Creating {subset} dataset.")
+        subset_cache = cache
+        if cache and cache is not True:
+            Path(cache).mkdir(parents=True, exist_ok=True)
+            subset_cache = str(Path(cache) / subset)
+
+        subset_kwargs = dict(dataset_kwargs, cache=subset_cache)
+        if subset == "train":
+            subset_kwargs.update(augmentation_kwargs)
+        else:
+            subset_kwargs.update(shuffle=False)
+
+        datasets[subset] = create_dataset(path_to_data / subset, **subset_kwargs)
+
+    return datasets
+
+
+def create_datasets_from_shards(
+        shards_directory: Union[Path, str],
+        batch_size: int = 32,
+        class_mode: str = "categorical",
+        seed: Optional[int] = None,
+        shuffle_buffer_size: int = 1000,
+        num_shards: int = 1,
+        shard_index: int = 0,
+        cycle_length: int = 4,
+        **kwargs
+) -> Dict[str, tf.data.Dataset]:
+    """
+    Counterpart of create_datasets for a directory of pre-decoded, pre-resized shards written by
+    scripts/preprocess_data_for_tf_generator.py --shards, see shard_utils.
+    Shards are read through memory maps and interleaved, nothing is decoded during training.
+    Augmentation arguments (see create_dataset) only apply to the train dataset, which is the only one shuffled.
+    :param shards_directory:
+    :param batch_size:
+    :param class_mode: 'categorical' for one-hot labels, 'sparse' for class indices
+    :param seed: seed for shuffling and augmentation
+    :param shuffle_buffer_size: number of images shuffled at a time, on top of the shuffled shard order
+    :param num_shards: number of workers the shard files are split between
+    :param shard_index: index of this worker
+    :param cycle_length: number of shard files read from at the same time
+    :param kwargs: augmentation arguments, unknown arguments are ignored, so a whole config can be passed
+    :return:
+    """
+    from utils import shard_utils
+
+    if class_mode not in ("categorical", "sparse"):
+        raise ValueError(f"{class_mode} is not a valid class mode. Must be one of ['categorical', 'sparse']")
+
+    shards_directory = Path(shards_directory)
+    manifest = shard_utils.load_manifest(shards_directory)
+    target_size = tuple(manifest["target_size"])
+    n_classes = len(manifest["class_names"])
+    image_spec = tf.TensorSpec((None, *target_size, manifest["channels"]), tf.uint8)
+    label_spec = tf.TensorSpec((None,), tf.int16)
+
+    def read_shard(images_path, labels_path):
+        # yields chunks rather than single images, the per-element cost of a python generator adds up
+        images = np.load(images_path.decode(), mmap_mode="r")
+        labels = np.load(labels_path.decode())
+        for start in range(0, len(labels), 256):
+            yield np.asarray(images[start:start + 256]), labels[start:start + 256]
+
+    def to_label(image, label):
+        label = tf.cast(label, tf.int32)
+        if class_mode == "categorical":
+            label = tf.one_hot(label, n_classes)
+        return image, label
+
+    datasets = {}
+    for subset in ("train", "val", "test"):
+        if subset not in manifest["subsets"]:
+            continue
+
+        print(f"Creating {subset} dataset from shards.")
+        shards = manifest["subsets"][subset]["shards"][shard_index::num_shards]
+        shard_paths = tf.data.Dataset.from_tensor_slices((
+            [str(shards_directory / shard["images"]) for shard in shards],
+            [str(shards_directory / shard["labels"]) for shard in shards]
+        ))
+
+        is_train = subset == "train"
+        if is_train:
+            shard_paths = shard_paths.shuffle(len(shards), seed=seed, reshuffle_each_iteration=True)
+
+        dataset = shard_paths.interleave(
+            lambda images_path, labels_path: tf.data.Dataset.from_generator(
+                read_shard, output_signature=(image_spec, label_spec), args=(images_path, labels_path)
+            ),
+            cycle_length=cycle_length,
+            num_parallel_calls=AUTOTUNE,
+            deterministic=not is_train
+        ).unbatch()
+
+        if is_train:
+            dataset = dataset.shuffle(shuffle_buffer_size, seed=seed, reshuffle_each_iteration=True)
+        dataset = dataset.map(to_label, num_parallel_calls=AUTOTUNE)
+
+        augmentation_kwargs = {k: v for k, v in kwargs.items() if k in AUGMENTATION_ARGUMENTS} if is_train else {}
+        datasets[subset] = batch_and_augment(dataset, batch_size, target_size, seed=seed, **augmentation_kwargs)
+
+    return datasets
@@ -0,0 +1,259 @@
+"""
+Grad-CAM class activation maps for the models built by model_utils.get_pre_trained_model.
+The heatmaps of a whole batch of images are computed in a single forward and backward pass,
+and rendered as overlays with a colormap lookup table.
+"""
+import functools
+import logging
+from typing import *
+
+import cv2
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras.layers import Dense, InputLayer
+from tensorflow.keras.models import Model
+
+from utils import image_utils
+
+POOLING_LAYERS = (
+    tf.keras.layers.MaxPooling2D, tf.keras.layers.AveragePooling2D,
+    tf.keras.layers.GlobalMaxPooling2D, tf.keras.layers.GlobalAveragePooling2D
+)
+
+
+def find_last_conv_layer(
+        model: Model
+) -> str:
+    """
+    Returns the name of the last layer with a spatial (4D) output, i.e. the last feature map of the backbone.
+    Pooling layers are skipped, their output is a downsampled copy of the feature map before them.
+    :param model:
+    :return:
+    """
+    for layer in reversed(model.layers):
+        if isinstance(layer, (InputLayer, ) + POOLING_LAYERS):
+            continue
+        if len(layer.output.shape) == 4:
+            return layer.name
+
+    raise ValueError(f"{model.name} has no layer with a 4D output")
+
+
+@functools.lru_cache(maxsize=None)
+def get_colormap_lut(
+        colormap: int = cv2.COLORMAP_JET
+) -> np.ndarray:
+    """
+    Returns the (256, 3) BGR lookup table of a cv2 colormap
+    :param colormap:
+    :return:
+    """
+    return cv2.applyColorMap(np.arange(256, dtype=np.uint8).reshape(256, 1), colormap).reshape(256, 3)
+
+
+def resize_heatmaps(
+        heatmaps: np.ndarray,
+        size: Tuple[int, int]
+) -> np.ndarray:
+    """
+    Resizes a batch of heatmaps
+    :param heatmaps: float32 array of shape (n, h, w)
+    :param size: (height, width) to resize to
+    :return: float32 array of shape (n, *size)
+    """
+    height, width = size
+    resized = np.empty((len(heatmaps), height, width), dtype=np.float32)
+    # cv2 resizes up to 512 channels at once, so the heatmaps are resized as the channels of a single image
+    for start in range(0, len(heatmaps), 512):
+        chunk = np.ascontiguousarray(heatmaps[start:start + 512].transpose(1, 2, 0), dtype=np.float32)
+        chunk = cv2.resize(chunk, (width, height), interpolation=cv2.INTER_LINEAR)
+        resized[start:start + 512] = chunk.reshape(height, width, -1).transpose(2, 0, 1)
+
+    return resized
+
+
+def overlay_heatmaps(
+        images: np.ndarray,
+        heatmaps: np.ndarray,
+        alpha: float = 0.4,
+        colormap: int = cv2.COLORMAP_JET
+) -> np.ndarray:
+    """
+    Blends colored heatmaps over a batch of images
+    :param images: uint8 BGR array of shape (n, height, width, 3)
+    :param heatmaps: array of shape (n, h, w) with values in [0, 1], resized to the images
+    :param alpha: opacity of the heatmaps
+    :param colormap: cv2 colormap
+    :return: uint8 BGR array of the same shape as images
+    """
+    n, height, width, _ = images.shape
+    heatmaps = resize_heatmaps(heatmaps, (height, width))
+    colored = get_colormap_lut(colormap)[np.rint(np.clip(heatmaps, 0, 1) * 255).astype(np.uint8)]
+
+    # blending the whole batch as one 2D image is a single saturating cv2 call
+    blended = cv2.addWeighted(
+        np.ascontiguousarray(images).reshape(n * height, width * 3), 1 - alpha,
+        colored.reshape(n * height, width * 3), alpha, 0
+    )
+    return blended.reshape(n, height, width, 3)
+
+
+def prepare_display_images(
+        images: Sequence[np.ndarray],
+        input_size: Tuple[int, int],
+        display_size: Tuple[int, int]
+) -> np.ndarray:
+    """
+    Crops decoded images to the region the model sees (see image_utils.get_center_crop_box) and resizes them,
+    so that they can be stacked into a batch and overlaid with their heatmaps
+    :param images: uint8 arrays as returned by image_utils.decode_image
+    :param input_size: (height, width) of the model input
+    :param display_size: (height, width) of the overlays
+    :return: uint8 BGR array of shape (len(images), *display_size, 3)
+    """
+    height, width = display_size
+    display_images = np.empty((len(images), height, width, 3), dtype=np.uint8)
+    for img, out in zip(images, display_images):
+        if img.ndim == 3 and img.shape[2] == 1:
+            img = img[..., 0]
+
+        top, left, crop_height, crop_width = image_utils.get_center_crop_box(*img.shape[:2], *input_size)
+        crop = cv2.resize(img[top:top + crop_height, left:left + crop_width], (width, height), interpolation=cv2.INTER_AREA)
+        out[...] = crop[..., np.newaxis] if crop.ndim == 2 else crop[..., :3]
+
+    return display_images
+
+
+class GradCam:
+    """
+    Computes Grad-CAM heatmaps of a Keras classifier. The sub-model up to the last feature map and the traced
+    gradient function are built once and reused for every batch.
+    Gradients are taken of the class scores before the softmax, when the output layer is a Dense softmax layer.
+    """
+    def __init__(
+            self,
+            model: Model,
+            layer_name: Optional[str] = None
+    ):
+        """
+        :param model: a model whose layers after the explained layer form a chain, like the ones built by
+            model_utils.get_pre_trained_model
+        :param layer_name: layer to explain, defaults to the last feature map of the model (see find_last_conv_layer)
+        """
+        self.model = model
+        self.layer_name = layer_name or find_last_conv_layer(model)
+
+        layer_index = [layer.name for layer in model.layers].index(self.layer_name)
+        self.feature_model = Model(model.inputs, model.layers[layer_index].output)
+        self.head_layers = model.layers[layer_index + 1:]
+        self.input_size = tuple(model.input_shape[1:3])
+
+        self._compute_heatmaps = tf.function(self._heatmaps, input_signature=[
+            tf.TensorSpec((None, *model.input_shape[1:]), tf.float32), tf.TensorSpec((None, ), tf.int32)
+        ])
+
+    def _logits(
+            self,
+            feature_maps: tf.Tensor
+    ) -> tf.Tensor:
+        x = feature_maps
+        for layer in self.head_layers[:-1]:
+            x = layer(x, training=False)
+
+        output = self.head_layers[-1]
+        if isinstance(output, Dense) and getattr(output.activation, "__name__", None) == "softmax":
+            return tf.matmul(tf.cast(x, output.kernel.dtype), output.kernel) + output.bias
+        return output(x, training=False)
+
+    def _heatmaps(
+            self,
+            images: tf.Tensor,
+            class_indices: tf.Tensor
+    ) -> Tuple[tf.Tensor, tf.Tensor]:
+        feature_maps = self.feature_model(images, training=False)
+        with tf.GradientTape() as tape:
+            tape.watch(feature_maps)
+            logits = tf.cast(self._logits(feature_maps), tf.float32)
+            class_indices = tf.where(class_indices < 0, tf.argmax(logits, axis=-1, output_type=tf.int32), class_indices)
+            # every image only contributes to the gradients of its own feature map,
+            # so one backward pass of the summed class scores gives the gradients of the whole batch
+            class_scores = tf.gather(logits, class_indices, axis=1, batch_dims=1)
+
+        gradients = tf.cast(tape.gradient(class_scores, feature_maps), tf.float32)
+        channel_weights = tf.reduce_mean(gradients, axis=(1, 2), keepdims=True)
+        heatmaps = tf.nn.relu(tf.reduce_sum(channel_weights * tf.cast(feature_maps, tf.float32), axis=-1))
+        heatmaps /= tf.reduce_max(heatmaps, axis=(1, 2), keepdims=True) + 1e-7
+        return heatmaps, class_indices
+
+    def heatmaps(
+            self,
+            images: np.ndarray,
+            class_indices: Optional[Sequence[int]] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the Grad-CAM heatmaps of a batch of images
+        :param images: float32 batch prepared for the model
+        :param class_indices: the class to explain for every image, the predicted one by default
+        :return: heatmaps of shape (n, h, w) at the resolution of the feature map, scaled to [0, 1] per image,
+            and the explained class of every image
+        """
+        if class_indices is None:
+            class_indices = np.full(len(images), -1, dtype=np.int32)
+
+        heatmaps, class_indices = self._compute_heatmaps(
+            tf.convert_to_tensor(images, tf.float32), tf.convert_to_tensor(class_indices, tf.int32)
+        )
+        return heatmaps.numpy(), class_indices.numpy()
+
+    def explain_images(
+            self,
+            images_bytes: Sequence[bytes],
+            display_size: Tuple[int, int] = (256, 256),
+            alpha: float = 0.4,
+            reduced_decode: bool = True,
+            quality: int = 90
+    ) -> List[bytes]:
+        """
+        Decodes a batch of encoded images, prepares them like the server does (see image_utils.ImagePreprocessor)
+        and returns their Grad-CAM overlays as JPEGs
+        :param images_bytes:
+        :param display_size: (height, width) of the overlays
+        :param alpha: opacity of the heatmaps
+        :param reduced_decode: whether large JPEGs can be decoded at a reduced resolution, see image_utils.decode_image
+        :param quality: JPEG quality of the overlays
+        :return:
+        """
+        decode_size = tuple(max(a, b) for a, b in zip(self.input_size, display_size)) if reduced_decode else None
+        images = [image_utils.decode_image(image_bytes, decode_size) for image_bytes in images_bytes]
+        inputs = np.empty((len(images), *self.input_size, 3), dtype=np.float32)
+        image_utils.get_image_preprocessor(self.input_size).prepare(images, out=inputs)
+
+        heatmaps, _ = self.heatmaps(inputs)
+        overlays = overlay_heatmaps(prepare_display_images(images, self.input_size, display_size), heatmaps, alpha)
+        return [cv2.imencode(".jpg", overlay, [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tobytes() for overlay in overlays]
+
+
+def load_gradcam(
+        model_path: str,
+        layer_name: Optional[str] = None,
+        num_threads: Optional[int] = None
+) -> GradCam:
+    """
+    Loads a saved Keras model (SavedModel directory or h5 file) and returns its GradCam
+    :param model_path:
+    :param layer_name: see GradCam
+    :param num_threads: threads tensorflow runs the ops of the process on. Only applies if nothing has used
+        tensorflow yet in the process, its thread pools are fixed once they are created.
+    :return:
+    """
+    from utils.model_utils import ExtendedModel
+
+    if num_threads:
+        try:
+            tf.config.threading.set_intra_op_parallelism_threads(num_threads)
+            tf.config.threading.set_inter_op_parallelism_threads(num_threads)
+        except RuntimeError:
+            logging.warning(f"Tensorflow is already initialized, Grad-CAM can not be limited to {num_threads} threads")
+
+    model = tf.keras.models.load_model(model_path, compile=False, custom_objects={"ExtendedModel": ExtendedModel})
+    return GradCam(model, layer_name)
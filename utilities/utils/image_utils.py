@@ -1,12 +1,19 @@
+import io
 import imghdr
+import tarfile
+import threading
+import zipfile
+from pathlib import PurePosixPath
 from typing import *
 
 from PIL import Image
 import cv2
 import numpy as np
-import tensorflow as tf
-from tensorflow.keras.preprocessing import image
-from tensorflow.keras.applications.vgg16 import preprocess_input
+
+IMAGE_EXTENSIONS = ('.jpeg', '.jpg', '.png', '.bmp', '.gif', '.tif', '.tiff')
+
+# tensorflow is only needed by the keras based helpers and is imported inside them,
+# the serving path (decode_image, ImagePreprocessor) runs on cv2 and numpy alone
 
 
 def validate_image(stream):
@@ -30,6 +37,8 @@ def uploaded_image_to_array(image_file_storage):
     :param image_file_storage:
     :return:
     """
+    from tensorflow.keras.preprocessing import image
+
     img = Image.open(image_file_storage)
     return image.img_to_array(img)
 
@@ -52,6 +61,9 @@ def resize_image(
         output_shape: Tuple[int, int],
         use_smart_resize: bool = True
 ):
+    import tensorflow as tf
+    from tensorflow.keras.preprocessing import image
+
     op_ = {
         True: image.smart_resize,
         False: tf.image.resize
@@ -72,6 +84,251 @@ def make_image_into_batch(
     return np.expand_dims(img, axis=0)
 
 
+# per-channel means subtracted by the VGG16 ('caffe' mode) preprocess_input,
+# in the order of the channels it outputs
+VGG_CHANNEL_MEANS = np.array([103.939, 116.779, 123.68], dtype=np.float32)
+
+
+# scale factors libjpeg can decode at directly, with the matching cv2 flags for (color, grayscale) decoding
+REDUCED_DECODE_FLAGS = {
+    8: (cv2.IMREAD_REDUCED_COLOR_8, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+    4: (cv2.IMREAD_REDUCED_COLOR_4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+    2: (cv2.IMREAD_REDUCED_COLOR_2, cv2.IMREAD_REDUCED_GRAYSCALE_2),
+    1: (cv2.IMREAD_COLOR, cv2.IMREAD_GRAYSCALE)
+}
+
+
+def read_jpeg_header(
+        image_bytes: bytes
+) -> Union[None, Tuple[int, int, int]]:
+    """
+    Reads the (height, width, number of components) of a JPEG from its frame header without decoding it.
+    Returns None if the bytes are not a JPEG.
+    :param image_bytes:
+    :return:
+    """
+    if image_bytes[:2] != b"\xff\xd8":
+        return None
+
+    i, n = 2, len(image_bytes)
+    while i + 4 <= n:
+        if image_bytes[i] != 0xFF:
+            return None
+
+        marker = image_bytes[i + 1]
+        if marker == 0xFF:  # fill byte
+            i += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:  # markers without a payload
+            i += 2
+            continue
+
+        # start of frame markers, except DHT (C4), JPG (C8) and DAC (CC)
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            if i + 10 > n:
+                return None
+            height = int.from_bytes(image_bytes[i + 5:i + 7], "big")
+            width = int.from_bytes(image_bytes[i + 7:i + 9], "big")
+            return height, width, image_bytes[i + 9]
+
+        i += 2 + int.from_bytes(image_bytes[i + 2:i + 4], "big")
+
+    return None
+
+
+def get_reduced_decode_factor(
+        height: int,
+        width: int,
+        target_size: Tuple[int, int]
+) -> int:
+    """
+    Returns the largest factor (8, 4, 2 or 1) an image can be downscaled by while decoding,
+    such that its center crop is still at least as large as the target size
+    :param height:
+    :param width:
+    :param target_size:
+    :return:
+    """
+    target_height, target_width = target_size
+    _, _, crop_height, crop_width = get_center_crop_box(height, width, target_height, target_width)
+    for factor in (8, 4, 2):
+        if crop_height // factor >= target_height and crop_width // factor >= target_width:
+            return factor
+    return 1
+
+
+def decode_image(
+        image_bytes: bytes,
+        target_size: Optional[Tuple[int, int]] = None
+) -> np.ndarray:
+    """
+    Decodes an encoded image into a uint8 array. Color images are decoded as 3 channel (BGR) arrays,
+    grayscale JPEGs as 2D arrays, to be expanded to 3 channels by the preprocessing.
+    If a target size is given, large JPEGs are decoded at a reduced resolution (1/2, 1/4 or 1/8)
+    that is still at least as large as the target size.
+    :param image_bytes:
+    :param target_size: (height, width) the image will be resized to
+    :return: None if the bytes are not an image cv2 can decode
+    """
+    flag = cv2.IMREAD_COLOR
+    header = read_jpeg_header(image_bytes)
+    if header is not None:
+        height, width, components = header
+        factor = get_reduced_decode_factor(height, width, target_size) if target_size else 1
+        color_flag, grayscale_flag = REDUCED_DECODE_FLAGS[factor]
+        flag = grayscale_flag if components == 1 else color_flag
+
+    return cv2.imdecode(np.frombuffer(image_bytes, np.uint8), flag)
+
+
+def get_center_crop_box(
+        height: int,
+        width: int,
+        target_height: int,
+        target_width: int
+) -> Tuple[int, int, int, int]:
+    """
+    Returns the (top, left, height, width) of the largest centered crop with the target aspect ratio.
+    Mirrors the crop done by keras' smart_resize.
+    :param height:
+    :param width:
+    :param target_height:
+    :param target_width:
+    :return:
+    """
+    crop_height = min(height, int(np.float32(width * target_height) / target_width))
+    crop_width = min(width, int(np.float32(height * target_width) / target_height))
+    top = int(np.float32(height - crop_height) / 2)
+    left = int(np.float32(width - crop_width) / 2)
+    return top, left, crop_height, crop_width
+
+
+class ImagePreprocessor:
+    """
+    Prepares images for prediction without intermediate full-size arrays: every image is center-cropped (a view),
+    resized with cv2 and written, channel-flipped and mean-subtracted, into a preallocated float32 batch buffer.
+    Produces the same output as the smart_resize + VGG16 preprocess_input pipeline.
+
+    Instances reuse their buffers between calls and are not thread-safe, use one per thread.
+    """
+    def __init__(
+            self,
+            target_size: Tuple[int, int],
+            max_batch_size: int = 1
+    ):
+        """
+        :param target_size: (height, width) of the model input
+        :param max_batch_size: initial capacity of the batch buffer, it grows if a larger batch comes in
+        """
+        self.target_size = tuple(target_size)
+        self.buffer = np.empty((max_batch_size, *self.target_size, 3), dtype=np.float32)
+        self._resized = {}
+
+    def _get_resize_buffer(
+            self,
+            img: np.ndarray
+    ) -> np.ndarray:
+        # one scratch array per (channels, dtype), so cv2 never has to allocate the resized image
+        key = (img.shape[2:], img.dtype)
+        if key not in self._resized:
+            self._resized[key] = np.empty((*self.target_size, *img.shape[2:]), dtype=img.dtype)
+        return self._resized[key]
+
+    def _write(
+            self,
+            img: np.ndarray,
+            out: np.ndarray
+    ):
+        target_height, target_width = self.target_size
+        if img.ndim == 3 and img.shape[2] == 1:
+            img = img[..., 0]
+
+        top, left, crop_height, crop_width = get_center_crop_box(*img.shape[:2], target_height, target_width)
+        crop = img[top:top + crop_height, left:left + crop_width]
+        resized = cv2.resize(
+            crop, (target_width, target_height), dst=self._get_resize_buffer(img), interpolation=cv2.INTER_LINEAR
+        )
+
+        if resized.ndim == 2:
+            # grayscale images are broadcast to 3 channels while being written into the buffer
+            np.subtract(resized[..., np.newaxis], VGG_CHANNEL_MEANS, out=out, casting="unsafe")
+        else:
+            # decoded images are BGR(A), preprocess_input flips the channels of what it considers an RGB image
+            np.subtract(resized[..., 2::-1], VGG_CHANNEL_MEANS, out=out, casting="unsafe")
+
+    def prepare(
+            self,
+            images: Sequence[np.ndarray],
+            out: Optional[np.ndarray] = None
+    ) -> np.ndarray:
+        """
+        Prepares a batch of decoded images (as returned by cv2) for prediction
+        :param images: uint8 arrays of shape (height, width), (height, width, 3) or (height, width, 4)
+        :param out: array of shape (len(images), *target_size, 3) to write to. Defaults to the internal buffer,
+            in which case the returned array is overwritten by the next call.
+        :return: float32 array of shape (len(images), *target_size, 3)
+        """
+        n = len(images)
+        if out is None:
+            if n > len(self.buffer):
+                self.buffer = np.empty((n, *self.target_size, 3), dtype=np.float32)
+            out = self.buffer[:n]
+
+        for i, img in enumerate(images):
+            self._write(img, out[i])
+
+        return out
+
+    def prepare_bytes(
+            self,
+            images_bytes: Sequence[bytes],
+            out: Optional[np.ndarray] = None,
+            reduced_decode: bool = True
+    ) -> np.ndarray:
+        """
+        Decodes and prepares a batch of encoded images for prediction
+        :param images_bytes:
+        :param out: see prepare
+        :param reduced_decode: whether large JPEGs can be decoded at a reduced resolution, see decode_image
+        :return:
+        """
+        decode_size = self.target_size if reduced_decode else None
+        n = len(images_bytes)
+        if out is None:
+            if n > len(self.buffer):
+                self.buffer = np.empty((n, *self.target_size, 3), dtype=np.float32)
+            out = self.buffer[:n]
+
+        for i, image_bytes in enumerate(images_bytes):
+            img = decode_image(image_bytes, decode_size)
+            if img is None:
+                raise ValueError(f"Image {i} of the batch could not be decoded")
+            self._write(img, out[i])
+
+        return out
+
+
+_thread_local = threading.local()
+
+
+def get_image_preprocessor(
+        target_size: Tuple[int, int]
+) -> ImagePreprocessor:
+    """
+    Returns an ImagePreprocessor for the target size that belongs to the calling thread
+    :param target_size:
+    :return:
+    """
+    preprocessors = getattr(_thread_local, "preprocessors", None)
+    if preprocessors is None:
+        preprocessors = _thread_local.preprocessors = {}
+
+    target_size = tuple(target_size)
+    if target_size not in preprocessors:
+        preprocessors[target_size] = ImagePreprocessor(target_size)
+    return preprocessors[target_size]
+
+
 def prepare_image_for_prediction(
         img_array: np.ndarray,
         reshape_size: tuple
@@ -80,8 +337,41 @@ def prepare_image_for_prediction(
     Performs necessary steps to get image into appropriate format for model prediction
     :param img_array:
     :param reshape_size:
+    :return: a new float32 array of shape (1, *reshape_size, 3)
+    """
+    out = np.empty((1, *reshape_size, 3), dtype=np.float32)
+    return get_image_preprocessor(reshape_size).prepare([img_array], out=out)
+
+
+def prepare_image_bytes_for_prediction(
+        image_bytes: bytes,
+        reshape_size: tuple,
+        reduced_decode: bool = True
+) -> np.ndarray:
+    """
+    Decodes an image and gets it into the appropriate format for model prediction
+    :param image_bytes:
+    :param reshape_size:
+    :param reduced_decode: whether large JPEGs can be decoded at a reduced resolution, see decode_image
+    :return: a new float32 array of shape (1, *reshape_size, 3)
+    """
+    out = np.empty((1, *reshape_size, 3), dtype=np.float32)
+    return get_image_preprocessor(reshape_size).prepare_bytes([image_bytes], out=out, reduced_decode=reduced_decode)
+
+
+def prepare_image_for_prediction_keras(
+        img_array: np.ndarray,
+        reshape_size: tuple
+) -> np.ndarray:
+    """
+    Reference implementation of prepare_image_for_prediction built on keras' smart_resize and preprocess_input.
+    Kept for parity tests and benchmarks.
+    :param img_array:
+    :param reshape_size:
     :return:
     """
+    from tensorflow.keras.applications.vgg16 import preprocess_input
+
     img = resize_image(img_array, reshape_size)
     img = make_image_into_batch(img)
     img_copy = img.copy()
@@ -91,6 +381,75 @@ def prepare_image_for_prediction(
 
 
 def get_image_shape_from_flow(flow):
+    # tf.data datasets (see generator_utils.create_datasets) know the shape of their elements up front
+    if hasattr(flow, "element_spec"):
+        return tuple(flow.element_spec[0].shape[1:])
+
     img_batch, labels_batch = next(flow)
     img = img_batch[0]
     return img.shape
+
+
+class ArchiveLimitExceeded(ValueError):
+    """
+    Raised when an archive holds more images, or more uncompressed bytes of images, than allowed
+    """
+
+
+def extract_images_from_archive(
+        filename: str,
+        archive_bytes: bytes,
+        max_files: Optional[int] = None,
+        max_total_size: Optional[int] = None
+) -> Union[None, List[Tuple[str, bytes]]]:
+    """
+    Returns the (filename, bytes) pairs of the images in a zip or tar archive,
+    or None if the bytes are not an archive. Directories, hidden files and files without an image extension
+    are skipped. The limits are checked against the sizes recorded in the archive before a member is read,
+    so archives that would expand to too much data are rejected early.
+    :param filename:
+    :param archive_bytes:
+    :param max_files: maximum number of images
+    :param max_total_size: maximum uncompressed size of the images, in bytes
+    :return:
+    :raises ArchiveLimitExceeded: if one of the limits is exceeded
+    """
+    def _is_image(name: str) -> bool:
+        path = PurePosixPath(name)
+        hidden = any(part.startswith(".") or part == "__MACOSX" for part in path.parts)
+        return not hidden and path.suffix.lower() in IMAGE_EXTENSIONS
+
+    images = []
+    total_size = 0
+
+    def _check_limits(size: int):
+        nonlocal total_size
+        total_size += size
+        if max_files is not None and len(images) >= max_files:
+            raise ArchiveLimitExceeded(f"{filename} holds more than {max_files} images")
+        if max_total_size is not None and total_size > max_total_size:
+            raise ArchiveLimitExceeded(f"The images in {filename} are larger than {max_total_size} bytes")
+
+    stream = io.BytesIO(archive_bytes)
+    if zipfile.is_zipfile(stream):
+        with zipfile.ZipFile(stream) as archive:
+            for info in archive.infolist():
+                if info.is_dir() or not _is_image(info.filename):
+                    continue
+                # file_size is what the member expands to, reading never returns more than it
+                _check_limits(info.file_size)
+                images.append((PurePosixPath(info.filename).name, archive.read(info)))
+        return images
+
+    stream.seek(0)
+    if filename.endswith((".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tar.xz")):
+        with tarfile.open(fileobj=stream, mode="r:*") as archive:
+            # iterating reads the headers one at a time, unlike getmembers
+            for member in archive:
+                if not member.isfile() or not _is_image(member.name):
+                    continue
+                _check_limits(member.size)
+                images.append((PurePosixPath(member.name).name, archive.extractfile(member).read()))
+        return images
+
+    return None
@@ -1,4 +1,6 @@
 import os
+import inspect
+import contextlib
 from typing import *
 from datetime import datetime
 import logging
@@ -26,6 +28,7 @@ BASE_NAME_MODEL_MAP = {
     "vgg16": VGG16,
     "inception_v3": InceptionV3
 }
+MIXED_PRECISION_POLICIES = ("mixed_float16", "mixed_bfloat16")
 
 
 class ExtendedModel(Model):
@@ -38,7 +41,7 @@ class ExtendedModel(Model):
             **kwargs
     ):
         super(ExtendedModel, self).__init__(*args, **kwargs)
-        self.__valid_extensions = ["pb", "h5", "hdf5", "json"]
+        self.__valid_extensions = ["pb", "h5", "hdf5", "json", "tflite"]
 
     def plot(
             self,
@@ -112,6 +115,41 @@ class ExtendedModel(Model):
 
         return super(ExtendedModel, self).save(filepath, *args, **kwargs)
 
+    def export_tflite(
+            self,
+            filepath: Optional[str] = None,
+            quantization: str = "int8",
+            representative_flow=None,
+            num_calibration_images: int = 200,
+            int8_io: bool = False,
+            directory: Optional[str] = None
+    ) -> str:
+        """
+        Converts the model to TF Lite, see tflite_utils.convert_to_tflite.
+        scripts/export_tflite.py exports every variant and compares them against the float model.
+        :param filepath:
+        :param quantization: float32, dynamic_range, float16 or int8
+        :param representative_flow: flow the int8 ranges are calibrated on, usually the train flow
+            of generator_utils.create_flows
+        :param num_calibration_images: number of images drawn from representative_flow
+        :param int8_io: see tflite_utils.convert_to_tflite
+        :param directory:
+        :return: path of the .tflite file
+        """
+        from utils import tflite_utils
+
+        if filepath is None:
+            filepath = self._get_save_filepath(extension="tflite", annotation=quantization, directory=directory)
+
+        representative_images = None
+        if representative_flow is not None:
+            representative_images, _ = tflite_utils.sample_flow(representative_flow, num_calibration_images)
+
+        model_content = tflite_utils.convert_to_tflite(self, quantization, representative_images, int8_io)
+        with open(filepath, "wb") as f:
+            f.write(model_content)
+        return filepath
+
     def save_training_history(
             self,
             filepath: Optional[str] = None,
@@ -156,6 +194,113 @@ class ExtendedModel(Model):
         self.save_training_history(directory=directory)
 
 
+@contextlib.contextmanager
+def global_dtype_policy(
+        policy: Optional[str]
+):
+    """
+    Sets the global Keras dtype policy for the layers created in the block and restores the previous one afterwards
+    :param policy: name of a policy, e.g. mixed_bfloat16, None to leave the global policy as it is
+    :return:
+    """
+    if policy is None:
+        yield
+        return
+
+    if policy not in MIXED_PRECISION_POLICIES:
+        raise ValueError(f"{policy} is not a valid mixed precision policy. Must be one of {list(MIXED_PRECISION_POLICIES)}")
+
+    previous_policy = tf.keras.mixed_precision.global_policy()
+    tf.keras.mixed_precision.set_global_policy(policy)
+    try:
+        yield
+    finally:
+        tf.keras.mixed_precision.set_global_policy(previous_policy)
+
+
+def get_training_options(
+        model: Model
+) -> dict:
+    """
+    Returns the precision and compilation options a model was built and compiled with
+    :param model:
+    :return:
+    """
+    jit_compile = getattr(model, "jit_compile", getattr(model, "_jit_compile", None))
+    if jit_compile is None:
+        # before TF 2.5, XLA can only be turned on globally
+        jit_compile = bool(tf.config.optimizer.get_jit())
+
+    steps_per_execution = getattr(model, "steps_per_execution", getattr(model, "_steps_per_execution", None))
+    if isinstance(steps_per_execution, tf.Variable):
+        steps_per_execution = steps_per_execution.numpy()
+
+    return {
+        "dtype_policy": model.dtype_policy.name,
+        "jit_compile": jit_compile if isinstance(jit_compile, str) else bool(jit_compile),
+        "steps_per_execution": int(steps_per_execution or 1)
+    }
+
+
+def add_classification_head(
+        x: tf.Tensor,
+        dropout_rate: float = 0.3,
+        num_classes: int = 4,
+        dense_start_dimension: int = 512,
+        num_dense_classification_head: int = 0,
+        dense_classification_head_activation: str = "leaky_relu",
+        dim_shrink_factor: int = 1
+) -> tf.Tensor:
+    """
+    Adds the classification head used by get_pre_trained_model on top of the pooled features x,
+    see get_pre_trained_model for the parameters
+    :return: the softmax output
+    """
+    if dense_classification_head_activation is "gelu":
+        dense_classification_head_activation = gelu
+
+    if dense_classification_head_activation is "selu":
+        dense_classification_head_activation = selu
+
+    x = Dropout(dropout_rate)(x)
+
+    dim = dense_start_dimension
+    for i in range(num_dense_classification_head):
+        x = Dense(dim, activation=dense_classification_head_activation)(x)
+        if dense_classification_head_activation is "leaky_relu":
+            x = LeakyReLU()(x)
+        dim //= dim_shrink_factor
+
+    # a float16 softmax is not numerically stable
+    return Dense(num_classes, activation="softmax", dtype="float32")(x)
+
+
+def get_backbone(
+        base_model: str,
+        input_shape: Tuple,
+        pooling: str = "max",
+        weights: str = "imagenet"
+) -> Model:
+    """
+    Returns the pre-trained base of get_pre_trained_model, without a classification head
+    :param base_model: which base to use, can be densenet, resnet50, vgg16, vgg19, inception_v3
+    :param input_shape: shape of the input images (should be a Tuple with 3 elements)
+    :param pooling: what pooling to use, can be max or avg
+    :param weights: what pre-trained weights to use
+    :return:
+    """
+    if base_model not in BASE_NAME_MODEL_MAP:
+        raise ValueError(f"{base_model} is not a valid model name. Must be one of {list(BASE_NAME_MODEL_MAP.keys())}")
+
+    base_model_initializer = BASE_NAME_MODEL_MAP[base_model]
+    return base_model_initializer(
+        weights=weights,
+        include_top=False,
+        pooling=pooling,
+        input_shape=input_shape
+    )
+
+
 def get_pre_trained_model(
         base_model: str,
         input_shape: Tuple,
@@ -168,6 +313,7 @@ def get_pre_trained_model(
         num_dense_classification_head: int = 0,
         dense_classification_head_activation: str = "leaky_relu",
         dim_shrink_factor: int = 1,
+        mixed_precision: Optional[str] = None,
         **kwargs
 ) -> ExtendedModel:
     """
@@ -184,51 +330,78 @@ def get_pre_trained_model(
     :param num_dense_classification_head: how many dense layers in the classification head
     :param dense_classification_head_activation: activation in each of the dense layers in the classification head
     :param dim_shrink_factor: how much to shrink the dimension by in each successive layer
+    :param mixed_precision: mixed_bfloat16 or mixed_float16 to compute in 16 bit with float32 weights,
+        mixed_bfloat16 is the one that pays off on CPUs. The softmax output is always computed in float32.
     :return: and instance of ExtendedModel for further fine-tuning
     """
-    if base_model not in BASE_NAME_MODEL_MAP:
-        raise ValueError(f"{base_model} is not a valid model name. Must be one of {list(BASE_NAME_MODEL_MAP.keys())}")
-
     if model_name is None:
         model_name = base_model
 
-    if dense_classification_head_activation is "gelu":
-        dense_classification_head_activation = gelu
+    with global_dtype_policy(mixed_precision):
+        base_model = get_backbone(base_model, input_shape, pooling, weights)
+        output = add_classification_head(
+            base_model.output, dropout_rate, num_classes, dense_start_dimension, num_dense_classification_head,
+            dense_classification_head_activation, dim_shrink_factor
+        )
 
-    if dense_classification_head_activation is "selu":
-        dense_classification_head_activation = selu
+        model = ExtendedModel(
+            inputs=base_model.input,
+            outputs=output,
+            name=model_name
+        )
 
-    base_model_initializer = BASE_NAME_MODEL_MAP[base_model]
-    base_model = base_model_initializer(
-        weights=weights,
-        include_top=False,
-        pooling=pooling,
-        input_shape=input_shape
-    )
+    # Train top layer
+    for layer in base_model.layers[:-2]:
+        layer.trainable = False
 
-    x = base_model.output
-    x = Dropout(dropout_rate)(x)
+    return model
 
-    dim = dense_start_dimension
-    for i in range(num_dense_classification_head):
-        x = Dense(dim, activation=dense_classification_head_activation)(x)
-        if dense_classification_head_activation is "leaky_relu":
-            x = LeakyReLU()(x)
-        dim //= dim_shrink_factor
 
-    output = Dense(num_classes, activation="softmax")(x)
+def get_classification_head(
+        feature_shape: Tuple,
+        model_name: str = "classification-head",
+        mixed_precision: Optional[str] = None,
+        **kwargs
+) -> ExtendedModel:
+    """
+    Returns the classification head of get_pre_trained_model on its own, to train on pre-computed backbone features
+    (see feature_cache_utils). Its weights can then be copied onto a full model with load_head_weights.
+    :param feature_shape: shape of the pooled backbone features, e.g. (1024, ) for densenet
+    :param model_name:
+    :param mixed_precision: see get_pre_trained_model
+    :param kwargs: head parameters of get_pre_trained_model, e.g. dropout_rate, others are ignored
+    :return:
+    """
+    head_kwargs = {
+        k: kwargs[k] for k in (
+            "dropout_rate", "num_classes", "dense_start_dimension", "num_dense_classification_head",
+            "dense_classification_head_activation", "dim_shrink_factor"
+        ) if k in kwargs
+    }
 
-    model = ExtendedModel(
-        inputs=base_model.input,
-        outputs=output,
-        name=model_name
-    )
+    with global_dtype_policy(mixed_precision):
+        inputs = tf.keras.Input(shape=feature_shape)
+        return ExtendedModel(inputs=inputs, outputs=add_classification_head(inputs, **head_kwargs), name=model_name)
 
-    # Train top layer
-    for layer in base_model.layers[:-2]:
-        layer.trainable = False
 
-    return model
+def load_head_weights(
+        model: Model,
+        head: Model
+):
+    """
+    Copies the weights of a classification head trained on cached features onto the head of a full model
+    built by get_pre_trained_model with the same head parameters
+    :param model:
+    :param head:
+    :return:
+    """
+    head_layers = [layer for layer in head.layers if layer.weights]
+    model_layers = [layer for layer in model.layers[-(len(head.layers) - 1):] if layer.weights]
+    if [layer.__class__ for layer in head_layers] != [layer.__class__ for layer in model_layers]:
+        raise ValueError(f"The head of {model.name} does not match {head.name}")
+
+    for head_layer, model_layer in zip(head_layers, model_layers):
+        model_layer.set_weights(head_layer.get_weights())
 
 
 def get_pre_trained_and_compiled_model(
@@ -238,6 +411,9 @@ def get_pre_trained_and_compiled_model(
         loss: Union[Loss, str] = "categorical_crossentropy",
         optimizer: Union[str, Optimizer] = None,
         metrics: List[Union[str, Metric]] = None,
+        mixed_precision: Optional[str] = None,
+        jit_compile: bool = False,
+        steps_per_execution: int = 1,
         **kwargs
 ):
     """
@@ -250,10 +426,14 @@ def get_pre_trained_and_compiled_model(
     :param loss:
     :param optimizer:
     :param metrics:
+    :param mixed_precision: see get_pre_trained_model
+    :param jit_compile: compile the train and predict steps with XLA
+    :param steps_per_execution: number of batches run per call into the compiled step, cuts the per-batch
+        python overhead. Callbacks' on_batch methods only run every steps_per_execution batches.
     :param kwargs:
     :return:
     """
-    model = get_pre_trained_model(base_model, input_shape, pooling, **kwargs)
+    model = get_pre_trained_model(base_model, input_shape, pooling, mixed_precision=mixed_precision, **kwargs)
     if metrics is None:
         metrics = ['accuracy']
         logging.warning("No metrics were specified. Using accuracy as default")
@@ -261,6 +441,16 @@ def get_pre_trained_and_compiled_model(
     if optimizer is None:
         optimizer = optimizer_utils.get_adam_from_kwargs(**kwargs)
 
-    model.compile(optimizer=optimizer, loss=loss, metrics=metrics)
+    compile_kwargs = {}
+    if jit_compile and "jit_compile" in inspect.signature(model.compile).parameters:
+        compile_kwargs["jit_compile"] = True
+    elif jit_compile:
+        logging.warning("This version of TensorFlow can not compile a single model with XLA, turning XLA on globally")
+        tf.config.optimizer.set_jit(True)
+
+    # with a mixed_float16 policy the optimizer is wrapped in a LossScaleOptimizer by compile
+    model.compile(
+        optimizer=optimizer, loss=loss, metrics=metrics, steps_per_execution=steps_per_execution, **compile_kwargs
+    )
 
     return model
@@ -1,11 +1,19 @@
 from typing import *
 import os
-import tempfile
+import copy
+import itertools
+import threading
+import zlib
+from functools import lru_cache
 from pathlib import Path
 from datetime import datetime as dt
 
+import cv2
+import numpy as np
 from fpdf import FPDF
-from google.cloud import storage
+
+from utils import gcs_utils, storage_utils
+from utils.image_utils import read_jpeg_header, decode_image
 
 
 # GCS_PROJECT_BUCKET = os.environ.get("GCS_PROJECT_BUCKET")
@@ -13,6 +21,88 @@ from google.cloud import storage
 
 GCS_PROJECT_BUCKET = "fourth-brain-course-files"
 PDF_REPORTS_GCS_PATH = Path("capstone-project/pdf_reports")
+LOGO_GCS_PATH = "capstone-project/public/oct_eye_logo-128x128.png"
+LOGO_PATH = os.environ.get("LOGO_PATH")  # local copy of the logo, skips the download from GCS
+LOGO_NAME = "oct_eye_logo"
+DEFAULT_TITLE = "OCT Prediction Summary Report."
+THUMBNAIL_PIXELS = 96  # longest side of the thumbnails embedded in reports
+
+_template_lock = threading.Lock()
+
+
+def image_info_from_bytes(
+        image_bytes: bytes
+) -> dict:
+    """
+    Builds the image info fpdf embeds in a document from encoded image bytes, without going through a file.
+    JPEGs are embedded as they are, other formats are decoded and stored losslessly, with their alpha channel
+    as a soft mask.
+    :param image_bytes:
+    :return:
+    """
+    jpeg_header = read_jpeg_header(image_bytes)
+    if jpeg_header is not None:
+        h, w, components = jpeg_header
+        color_space = {1: "DeviceGray", 4: "DeviceCMYK"}.get(components, "DeviceRGB")
+        return {"w": w, "h": h, "cs": color_space, "bpc": 8, "f": "DCTDecode", "data": image_bytes}
+
+    img = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_UNCHANGED)
+    if img is None:
+        raise ValueError("Could not decode image")
+    if img.dtype != np.uint8:
+        img = (img / 256).astype(np.uint8)
+
+    h, w = img.shape[:2]
+    info = {"w": w, "h": h, "bpc": 8, "f": "FlateDecode"}
+    if img.ndim == 2:
+        info.update(cs="DeviceGray", data=zlib.compress(img.tobytes()))
+        return info
+
+    info.update(cs="DeviceRGB", data=zlib.compress(np.ascontiguousarray(img[..., 2::-1]).tobytes()))
+    if img.shape[2] == 4:
+        # fpdf writes soft masks with the PNG predictor, every row starts with its filter type (0, none)
+        alpha = np.zeros((h, w + 1), dtype=np.uint8)
+        alpha[:, 1:] = img[..., 3]
+        info["smask"] = zlib.compress(alpha.tobytes())
+    return info
+
+
+def make_thumbnail(
+        image_bytes: bytes,
+        size: int = THUMBNAIL_PIXELS,
+        quality: int = 80
+) -> bytes:
+    """
+    Downscales an image so that its longest side is at most size pixels and encodes it as a JPEG.
+    Keeps every thumbnail a report holds on to down to a few KB.
+    :param image_bytes:
+    :param size:
+    :param quality: JPEG quality
+    :return:
+    """
+    img = decode_image(image_bytes, target_size=(size, size))
+    if img is None:
+        raise ValueError("Could not decode image")
+
+    scale = size / max(img.shape[:2])
+    if scale < 1:
+        new_size = (max(1, round(img.shape[1] * scale)), max(1, round(img.shape[0] * scale)))
+        img = cv2.resize(img, new_size, interpolation=cv2.INTER_AREA)
+    return cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tobytes()
+
+
+@lru_cache(maxsize=None)
+def get_logo_info() -> dict:
+    """
+    Loads the logo once per process, from LOGO_PATH if set and from GCS otherwise
+    :return:
+    """
+    if LOGO_PATH:
+        logo_bytes = Path(LOGO_PATH).read_bytes()
+    else:
+        bucket = gcs_utils.get_storage_client().bucket(GCS_PROJECT_BUCKET)
+        logo_bytes = bucket.blob(LOGO_GCS_PATH).download_as_bytes()
+    return image_info_from_bytes(logo_bytes)
 
 
 class PDFReport(FPDF):
@@ -30,20 +120,35 @@ class PDFReport(FPDF):
             format: str = "A4"
     ):
         super(PDFReport, self).__init__(orientation=orientation, unit=unit, format=format)
-        self.gcs_client = storage.Client()
+        self.page_setup = (orientation, unit, format)
+
+    @property
+    def gcs_client(self):
+        # shared with the rest of the process and only created once a report is actually uploaded
+        return gcs_utils.get_storage_client()
+
+    def register_image(
+            self,
+            name: str,
+            info: dict
+    ):
+        """
+        Makes an image parsed ahead of time (see image_info_from_bytes) available to self.image under name
+        :param name:
+        :param info:
+        :return:
+        """
+        if name not in self.images:
+            # fpdf stores per-document object numbers in the info, so every document gets its own copy
+            self.images[name] = dict(info, i=len(self.images) + 1)
 
     def set_header(
             self,
             set_logo: bool = True
     ):
         if set_logo:
-            client = self.gcs_client
-            bucket = client.bucket(GCS_PROJECT_BUCKET)
-            blob = bucket.blob("capstone-project/public/oct_eye_logo-128x128.png")
-
-            _, logo_file = tempfile.mkstemp('.png')
-            blob.download_to_filename(logo_file)
-            self.add_image((6.0, 6.0), logo_file)
+            self.register_image(LOGO_NAME, get_logo_info())
+            self.add_image((6.0, 6.0), LOGO_NAME)
 
     def add_image(
             self,
@@ -93,22 +198,188 @@ class PDFReport(FPDF):
         self.set_font(text_font, text_formatting, font_size)
         self.multi_cell(0, 10, text)
 
-    def write_prediction_data(self, prediction_data: List[Dict]):
-        y = 50
-        for i, entry in enumerate(prediction_data):
-            y += self.spacing
-            for j, (key, value) in enumerate(entry.items()):
-                text = f"{key.capitalize()}: {value}."
-                self.add_text(text, coordinates=(10, y))
-                y += self.line_height
+    def write_prediction_data(self, prediction_data: Iterable[Dict]):
+        self.write_prediction_table(prediction_data)
+
+    def fit_text(
+            self,
+            text: str,
+            width: float
+    ) -> str:
+        """
+        Shortens text with an ellipsis until it fits in a cell of the given width with the current font.
+        Characters the core fonts can not encode are replaced.
+        :param text:
+        :param width:
+        :return:
+        """
+        text = text.encode("latin-1", "replace").decode("latin-1")
+        max_width = width - 2 * self.c_margin
+        if self.get_string_width(text) <= max_width:
+            return text
+
+        while text and self.get_string_width(text + "...") > max_width:
+            text = text[:-1]
+        return text + "..."
+
+    def write_table_header(
+            self,
+            headers: List[str],
+            widths: List[float]
+    ):
+        """
+        Writes the header row of the prediction table and sets the style of the rows below it.
+        Called once per page, rows only draw cells.
+        :param headers:
+        :param widths:
+        :return:
+        """
+        self.set_font("Arial", "B", 11)
+        self.set_text_color(255, 255, 255)
+        self.set_fill_color(20, 105, 255)
+        self.set_draw_color(200, 200, 200)
+        self.set_line_width(0.2)
+        for header, width in zip(headers, widths):
+            self.cell(width, self.line_height + 3, self.fit_text(header, width), border=1, align='C', fill=True)
+        self.ln()
+
+        self.set_font("Arial", "", 10)
+        self.set_text_color(0, 0, 0)
+
+    def write_prediction_table(
+            self,
+            prediction_data: Iterable[Dict],
+            top: float = 45.0,
+            thumbnail_loader: Optional[Callable[[Dict], Optional[bytes]]] = None,
+            hidden_keys: Collection[str] = ()
+    ):
+        """
+        Lays the predictions out as a table, one row per prediction, with the header repeated on every page.
+        Records are consumed one at a time, so prediction_data can be a generator of any length.
+        The columns are the keys of the first record.
+        :param prediction_data:
+        :param top: where the table starts on the current page
+        :param thumbnail_loader: returns the image bytes of a record, or None. Adds a column with thumbnails if set.
+        :param hidden_keys: keys of the records that do not get a column
+        :return:
+        """
+        records = iter(prediction_data)
+        first_record = next(records, None)
+        if first_record is None:
+            return
+
+        keys = [key for key in first_record.keys() if key not in hidden_keys]
+        headers = [str(key).capitalize() for key in keys]
+        table_width = self.w - self.l_margin - self.r_margin
+        row_height = self.line_height + 3
+        if thumbnail_loader is not None:
+            row_height = 4 * self.line_height
+            headers.insert(0, "Scan")
+            table_width -= row_height
+        widths = [table_width / len(keys)] * len(keys)
+        if thumbnail_loader is not None:
+            widths.insert(0, row_height)
+
+        self.set_xy(self.l_margin, top)
+        self.write_table_header(headers, widths)
+
+        for i, record in enumerate(itertools.chain([first_record], records)):
+            if self.get_y() + row_height > self.page_break_trigger:
+                self.add_page()
+                self.write_table_header(headers, widths)
+
+            if thumbnail_loader is not None:
+                self.write_thumbnail_cell(f"thumbnail_{i}", thumbnail_loader(record), row_height)
+
+            for key, width in zip(keys, widths[-len(keys):]):
+                self.cell(width, row_height, self.fit_text(str(record.get(key, "")), width), border=1)
+            self.ln()
+
+    def write_thumbnail_cell(
+            self,
+            name: str,
+            image_bytes: Optional[bytes],
+            size: float
+    ):
+        """
+        Draws a square cell with the thumbnail of an image centered in it, or an empty cell
+        :param name: name the image is registered under in the document
+        :param image_bytes:
+        :param size: width and height of the cell
+        :return:
+        """
+        x, y = self.get_x(), self.get_y()
+        self.cell(size, size, "", border=1)
+        if image_bytes is None:
+            return
+
+        try:
+            info = image_info_from_bytes(make_thumbnail(image_bytes))
+        except ValueError:
+            return
+        self.register_image(name, info)
+
+        scale = (size - 2) / max(info["w"], info["h"])
+        w, h = info["w"] * scale, info["h"] * scale
+        self.image(name, x + (size - w) / 2, y + (size - h) / 2, w=w, h=h)
+
+    def render_title_page(
+            self,
+            title: str = DEFAULT_TITLE
+    ):
+        """
+        Renders the static part of the report: the header with the logo, the title and the line under it
+        :param title:
+        :return:
+        """
+        self.add_page()
+        self.set_header()
+        self.set_title(title)
+        self.draw_line_under_title()
+
+    def start_from_template(
+            self,
+            title: str = DEFAULT_TITLE
+    ):
+        """
+        Starts the document from a copy of a title page rendered once per process, instead of rendering it again
+        :param title:
+        :return:
+        """
+        template = get_report_template(title, *self.page_setup)
+        self.__dict__.update(copy.deepcopy(template.__dict__))
 
+    def render(
+            self,
+            prediction_data: Iterable[dict],
+            title: str = DEFAULT_TITLE,
+            thumbnail_loader: Optional[Callable[[Dict], Optional[bytes]]] = None,
+            hidden_keys: Collection[str] = ()
+    ) -> bytes:
+        """
+        Renders the report in memory and returns the bytes of the pdf
+        :param prediction_data: records to list in the report, can be a generator
+        :param title:
+        :param thumbnail_loader: see write_prediction_table
+        :param hidden_keys: see write_prediction_table
+        :return:
+        """
+        if self.page == 0:
+            self.start_from_template(title)
+        self.write_prediction_table(prediction_data, thumbnail_loader=thumbnail_loader, hidden_keys=hidden_keys)
+
+        # fpdf 1.7 builds the document as a latin-1 string
+        return self.output(dest='S').encode('latin-1')
 
     def generate_report(
             self,
-            prediction_data: List[dict],
-            title: str = "OCT Prediction Summary Report.",
+            prediction_data: Iterable[dict],
+            title: str = DEFAULT_TITLE,
             upload_to_gcs: bool = True,
-            return_url: bool = True
+            return_url: bool = True,
+            storage_backend: Optional[storage_utils.StorageBackend] = None,
+            thumbnail_loader: Optional[Callable[[Dict], Optional[bytes]]] = None,
+            hidden_keys: Collection[str] = ()
     ) -> Union[None, str]:
         """
         Generates a pdf report with prediction data, stores in GCS
@@ -117,30 +388,49 @@ class PDFReport(FPDF):
         :param title:
         :param upload_to_gcs:
         :param return_url:
+        :param storage_backend: where the report is stored, defaults to the report bucket in GCS
+        :param thumbnail_loader: see write_prediction_table
+        :param hidden_keys: see write_prediction_table
         :return:
         """
-        self.add_page()
-        self.set_header()
-        self.set_title(title)
-        self.draw_line_under_title()
-        self.write_prediction_data(prediction_data)
-
-        _, tmp_pdf = tempfile.mkstemp(".pdf")
-        self.output(tmp_pdf)
+        pdf_bytes = self.render(prediction_data, title, thumbnail_loader, hidden_keys)
 
         if upload_to_gcs:
-            client = self.gcs_client
-            bucket = client.bucket(GCS_PROJECT_BUCKET)
+            storage_backend = storage_backend or storage_utils.GCSStorageBackend(GCS_PROJECT_BUCKET)
             date_key = dt.now().isoformat()
             report_name = f"oct_summary_report_{date_key}.pdf"
             pdf_report_gcs_path = str(PDF_REPORTS_GCS_PATH / report_name)
-            blob = bucket.blob(pdf_report_gcs_path)
-            blob.upload_from_filename(tmp_pdf)
+            url = storage_backend.upload_bytes(pdf_bytes, pdf_report_gcs_path, content_type="application/pdf")
 
             if return_url:
-                return f"https://storage.googleapis.com/{GCS_PROJECT_BUCKET}/{blob.name}"
+                return url
+
 
+@lru_cache(maxsize=16)
+def _get_report_template(
+        title: str,
+        orientation: str,
+        unit: str,
+        format: str
+) -> PDFReport:
+    template = PDFReport(orientation=orientation, unit=unit, format=format)
+    template.render_title_page(title)
+    return template
 
-r = PDFReport()
-b = r.generate_report([{"data": "Data"}])
 
+def get_report_template(
+        title: str = DEFAULT_TITLE,
+        orientation: str = "P",
+        unit: str = "mm",
+        format: str = "A4"
+) -> PDFReport:
+    """
+    Returns a report with the title page already rendered. Reports copy it rather than rendering their own.
+    :param title:
+    :param orientation:
+    :param unit:
+    :param format:
+    :return:
+    """
+    with _template_lock:
+        return _get_report_template(title, orientation, unit, format)
@@ -1,23 +1,61 @@
 """
-Functions that handle model predictions go here
+Functions that handle model predictions go here.
+The serving and AI Platform clients are imported on first use, importing this module does not load tensorflow.
 """
 
+import os
 from typing import *
 
 import numpy as np
 
-from utils.serving_utils import *
-from utils.ai_platform_utils import predict_json
-
 
 CLASS_LABELS = {"CNV": 0, "DME": 1, "DRUSEN": 2, "NORMAL": 3}
 CLASS_LABELS_INVERTED = {val: key for key, val in CLASS_LABELS.items()}
-TF_SERVING_MODEL_URI = os.environ['MODEL_URI']
+TF_SERVING_MODEL_URI = os.environ.get('MODEL_URI')
+
+
+def scores_to_predictions(
+        scores: np.ndarray
+) -> List[Tuple[str, float]]:
+    """
+    Converts a batch of raw scores into a list of (predicted class, confidence) pairs, one per image
+    :param scores: array of shape (batch_size, num_classes)
+    :return:
+    """
+    scores = np.asarray(scores).reshape(len(scores), -1)
+    most_likely_indices = np.argmax(scores, axis=1)
+    probabilities = np.round(np.max(scores, axis=1), 4) * 100
+
+    return [
+        (CLASS_LABELS_INVERTED.get(int(index)), float(probability))
+        for index, probability in zip(most_likely_indices, probabilities)
+    ]
+
+
+def predict_tf_serving_batch(
+        inputs: np.ndarray,
+        model_uri: Optional[str] = None,
+        model_name: str = "simclr-oct",
+        **kwargs
+) -> List[Tuple[str, float]]:
+    """
+    Sends a batch of images to the TF Serving service in a single prediction request
+    :param inputs:
+    :param model_uri: defaults to the MODEL_URI env variable
+    :param model_name:
+    :param kwargs: additional parameters will be passed down to the 'get_serving_prediction_scores' function
+    :return:
+    """
+    from utils.serving_utils import get_serving_prediction_scores
+
+    model_uri = model_uri or os.environ.get('MODEL_URI')
+    scores = get_serving_prediction_scores(inputs, model_uri, model_name, **kwargs)
+    return scores_to_predictions(scores)
 
 
 def predict_tf_serving(
         inputs: np.ndarray,
-        model_uri: str = TF_SERVING_MODEL_URI,
+        model_uri: Optional[str] = None,
         model_name: str = "simclr-oct",
         **kwargs
 ) -> Tuple[str, float]:
@@ -30,12 +68,37 @@ def predict_tf_serving(
     :return:
     """
 
-    scores = get_serving_prediction_scores(inputs, model_uri, model_name, **kwargs)
-    most_likely_index = int(np.argmax(scores, axis=0))
-    class_prediction = CLASS_LABELS_INVERTED.get(most_likely_index)
-    probability = np.round(np.max(scores), 4) * 100
+    return predict_tf_serving_batch(inputs, model_uri, model_name, **kwargs)[0]
 
-    return class_prediction, probability
+
+def predict_tf_lite_batch(
+        inputs: np.ndarray,
+) -> List[Tuple[str, float]]:
+    """
+    Makes predictions for a batch of images using the tensorflow lite model.
+    Blocks the calling thread, use predict_tf_lite_batch_async from async code.
+    :param inputs:
+    :return:
+    """
+    from utils.serving_utils import get_tflite_pool
+
+    scores = get_tflite_pool().predict(inputs)
+    return scores_to_predictions(scores)
+
+
+async def predict_tf_lite_batch_async(
+        inputs: np.ndarray,
+) -> List[Tuple[str, float]]:
+    """
+    Makes predictions for a batch of images using the pool of tensorflow lite interpreters,
+    without blocking the event loop
+    :param inputs:
+    :return:
+    """
+    from utils.serving_utils import get_tflite_pool
+
+    scores = await get_tflite_pool().predict_async(inputs)
+    return scores_to_predictions(scores)
 
 
 def predict_tf_lite(
@@ -46,13 +109,29 @@ def predict_tf_lite(
     :param inputs:
     :return:
     """
-    interpreter_quant.set_tensor(input_index, inputs)
-    interpreter_quant.invoke()
-    scores = interpreter_quant.get_tensor(output_index)
-    predicted_class = CLASS_LABELS_INVERTED.get(np.argmax(scores))
-    confidence = np.round(np.max(scores), 4) * 100
+    return predict_tf_lite_batch(inputs)[0]
+
+
+def predict_ai_platform_batch(
+        inputs: np.ndarray,
+        project: str = "fourth-brain",
+        region: str = "us-central1",
+        model: str = "samsung-oct-classifier",
+        version: str = "v1"
+) -> List[Tuple[str, float]]:
+    """
+    Sends a batch of images to the model hosted on GCP AI Platform
+    :param inputs:
+    :param project:
+    :param region:
+    :param model:
+    :param version:
+    :return:
+    """
+    from utils.ai_platform_utils import predict_json
 
-    return predicted_class, confidence
+    scores = predict_json(project, region, model, inputs.tolist(), version)
+    return scores_to_predictions(np.asarray(scores))
 
 
 def predict_ai_platform(
@@ -71,8 +150,5 @@ def predict_ai_platform(
     :param version:
     :return:
     """
-    scores = predict_json(project, region, model, inputs, version)
-    predicted_class = CLASS_LABELS_INVERTED.get(np.argmax(scores))
-    confidence = np.round(np.max(scores), 4) * 100
+    return predict_ai_platform_batch(inputs, project, region, model, version)[0]
 
-    return predicted_class, confidence
\ No newline at end of file
@@ -0,0 +1,271 @@
+"""
+Prediction backends with a uniform, async interface. The server registers them once at startup.
+serving_utils, and with it tensorflow, is only imported once a backend that needs it is created.
+"""
+import os
+import asyncio
+import logging
+from concurrent.futures import Executor
+from typing import *
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from utils.ai_platform_utils import AIPlatformClient
+    from utils.serving_utils import TFServingClient, TFLiteInterpreterPool
+
+try:
+    from typing import Protocol
+except ImportError:  # python < 3.8
+    from typing_extensions import Protocol
+
+logger = logging.getLogger("prediction_backends.py")
+
+
+class PredictionBackend(Protocol):
+    """
+    Interface every prediction backend implements
+    """
+    name: str
+
+    @property
+    def max_concurrent_batches(self) -> int:
+        """
+        How many batches the backend can run at the same time, e.g. its number of interpreters or connections
+        """
+        ...
+
+    async def predict_batch(self, inputs: np.ndarray) -> np.ndarray:
+        """
+        Returns the raw scores, of shape (batch_size, num_classes), for a batch of prepared images
+        """
+        ...
+
+    async def model_version(self) -> str:
+        """
+        Returns an identifier of the model being served, which changes whenever the model does
+        """
+        ...
+
+    async def warmup(self):
+        """
+        Creates connections, loads models and runs anything else that would otherwise slow down the first request
+        """
+        ...
+
+    async def close(self):
+        """
+        Releases the resources held by the backend
+        """
+        ...
+
+
+class TFServingBackend:
+    """
+    Sends predictions to TF Serving over gRPC, using the shared TFServingClient
+    """
+    name = "tf-serving"
+
+    def __init__(
+            self,
+            model_uri: str,
+            model_name: str = "simclr-oct",
+            signature_name: str = "serving_default",
+            input_shape: Tuple[int, int, int] = (80, 80, 3),
+            timeout: float = 5.0,
+            client: Optional["TFServingClient"] = None
+    ):
+        from utils import serving_utils
+
+        self.model_uri = model_uri
+        self.model_name = model_name
+        self.signature_name = signature_name
+        self.input_shape = input_shape
+        self.timeout = timeout
+        self.client = client or serving_utils.get_serving_client()
+
+    @property
+    def max_concurrent_batches(self) -> int:
+        return self.client.pool_size
+
+    async def predict_batch(
+            self,
+            inputs: np.ndarray
+    ) -> np.ndarray:
+        from utils.serving_utils import tensor_proto_to_ndarray
+
+        signature = await self.client.get_signature_async(
+            self.model_uri, self.model_name, self.signature_name, timeout=self.timeout
+        )
+        result = await self.client.predict_async(
+            inputs, self.model_uri, self.model_name, self.signature_name,
+            input_name=signature.input_name, output_name=signature.output_name, timeout=self.timeout
+        )
+        return tensor_proto_to_ndarray(result.outputs[signature.output_name])
+
+    async def model_version(self) -> str:
+        # the signature is cached and dropped when TF Serving starts serving a new version
+        signature = await self.client.get_signature_async(
+            self.model_uri, self.model_name, self.signature_name, timeout=self.timeout
+        )
+        return str(signature.version)
+
+    async def warmup(self):
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(
+            None, self.client.warmup, self.model_uri, self.model_name, self.signature_name, self.timeout
+        )
+        await self.predict_batch(np.zeros((1, *self.input_shape), dtype=np.float32))
+
+    async def close(self):
+        self.client.close()
+
+
+class FakeTFServingBackend(TFServingBackend):
+    """
+    A TFServingBackend talking to an in-process fake of TF Serving's gRPC API, see fake_serving.
+    Exercises the same client, connection and batching code as the real service, without any network.
+    """
+    def __init__(
+            self,
+            model_name: str = "simclr-oct",
+            input_shape: Tuple[int, int, int] = (80, 80, 3),
+            latency_ms: float = 0.0,
+            **kwargs
+    ):
+        from utils.fake_serving import FakeTFServingServer
+
+        self.server = FakeTFServingServer(
+            model_name=model_name, input_shape=input_shape, latency_ms=latency_ms
+        ).start()
+        super(FakeTFServingBackend, self).__init__(
+            self.server.address, model_name=model_name, input_shape=input_shape, **kwargs
+        )
+
+    async def close(self):
+        await super(FakeTFServingBackend, self).close()
+        self.server.stop()
+
+
+class TFLiteBackend:
+    """
+    Runs predictions in-process with the pool of TF Lite interpreters
+    """
+    name = "tf-lite"
+
+    def __init__(
+            self,
+            pool: Optional["TFLiteInterpreterPool"] = None
+    ):
+        self._pool = pool
+
+    @property
+    def pool(self) -> "TFLiteInterpreterPool":
+        if self._pool is None:
+            from utils import serving_utils
+            self._pool = serving_utils.get_tflite_pool()
+        return self._pool
+
+    @property
+    def max_concurrent_batches(self) -> int:
+        # does not create the pool, so that a missing model only fails the warmup
+        if self._pool is not None:
+            return self._pool.size
+        from utils import serving_utils
+        return serving_utils.get_tflite_pool_size()
+
+    async def predict_batch(
+            self,
+            inputs: np.ndarray
+    ) -> np.ndarray:
+        return await self.pool.predict_async(inputs)
+
+    async def model_version(self) -> str:
+        stat = os.stat(self.pool.model_path)
+        return f"{stat.st_size}-{stat.st_mtime_ns}"
+
+    async def warmup(self):
+        with self.pool.checkout() as interpreter:
+            input_shape = tuple(interpreter.get_input_details()[0]["shape"][1:])
+        await self.predict_batch(np.zeros((1, *input_shape), dtype=np.float32))
+
+    async def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+
+
+class AIPlatformBackend:
+    """
+    Sends predictions to the model hosted on GCP AI Platform.
+    Batches larger than the payload limit are split by the client and sent as parallel requests.
+    """
+    name = "ai-platform"
+
+    def __init__(
+            self,
+            project: str = "fourth-brain",
+            region: str = "us-central1",
+            model: str = "samsung-oct-classifier",
+            version: str = "v1",
+            executor: Optional[Executor] = None,
+            client: Optional["AIPlatformClient"] = None
+    ):
+        from utils.ai_platform_utils import get_ai_platform_client
+
+        self.project = project
+        self.region = region
+        self.model = model
+        self.version = version
+        self.executor = executor
+        self.client = client or get_ai_platform_client(project, region)
+
+    @property
+    def max_concurrent_batches(self) -> int:
+        return self.client.max_parallel_requests
+
+    async def predict_batch(
+            self,
+            inputs: np.ndarray
+    ) -> np.ndarray:
+        loop = asyncio.get_event_loop()
+        scores = await loop.run_in_executor(
+            self.executor, self.client.predict, self.model, inputs.tolist(), self.version
+        )
+        return np.asarray(scores)
+
+    async def model_version(self) -> str:
+        return self.version
+
+    async def warmup(self):
+        # loads the discovery document and builds the service before the first request needs it
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(self.executor, self.client.get_service)
+
+    async def close(self):
+        pass
+
+
+def create_backends(
+        image_size: int = 80
+) -> Dict[str, PredictionBackend]:
+    """
+    Creates the backends the server exposes, configured from env variables.
+    If FAKE_TF_SERVING is set to true, tf-serving predictions go to an in-process fake of TF Serving.
+    :param image_size: size of the (square) model inputs
+    :return:
+    """
+    input_shape = (image_size, image_size, 3)
+    model_name = os.environ.get("TF_SERVING_MODEL_NAME", "simclr-oct")
+
+    if os.environ.get("FAKE_TF_SERVING", "false").lower() == "true":
+        tf_serving = FakeTFServingBackend(
+            model_name=model_name,
+            input_shape=input_shape,
+            latency_ms=float(os.environ.get("FAKE_TF_SERVING_LATENCY_MS", 0))
+        )
+    else:
+        tf_serving = TFServingBackend(os.environ.get("MODEL_URI"), model_name=model_name, input_shape=input_shape)
+
+    backends = [tf_serving, TFLiteBackend(), AIPlatformBackend()]
+    return {backend.name: backend for backend in backends}
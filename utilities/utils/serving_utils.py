@@ -5,14 +5,20 @@ Functions that interface with the TF Serving service go here
 
 import grpc
 import os
+import asyncio
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import *
 import simplejson as json
 
 import numpy as np
-import tensorflow as tf
 
 from tensorflow_serving.apis import predict_pb2, get_model_metadata_pb2, prediction_service_pb2_grpc
 from tensorflow_serving.apis.model_pb2 import ModelSpec
-from tensorflow import make_tensor_proto
+from tensorflow_serving.apis.get_model_metadata_pb2 import SignatureDefMap
+from tensorflow.core.framework import tensor_pb2, types_pb2
 from google.protobuf.json_format import MessageToJson
 
 
@@ -20,12 +26,649 @@ MESSAGE_OPTIONS = [('grpc.max_message_length', 200 * 1024 * 1024),
                    ('grpc.max_receive_message_length', 200 * 1024 * 1024)]
 
 
+# tensorflow dtypes and the numpy dtypes and TensorProto fields their values are stored in
+DTYPE_MAP = {
+    types_pb2.DT_FLOAT: (np.float32, "float_val"),
+    types_pb2.DT_DOUBLE: (np.float64, "double_val"),
+    types_pb2.DT_HALF: (np.float16, "half_val"),
+    types_pb2.DT_INT32: (np.int32, "int_val"),
+    types_pb2.DT_INT64: (np.int64, "int64_val"),
+    types_pb2.DT_UINT8: (np.uint8, "int_val"),
+    types_pb2.DT_INT8: (np.int8, "int_val"),
+    types_pb2.DT_BOOL: (np.bool_, "bool_val"),
+}
+
+
+def ndarray_to_tensor_proto(
+        array: np.ndarray,
+        dtype: int = types_pb2.DT_FLOAT
+) -> tensor_pb2.TensorProto:
+    """
+    Packs an array into a TensorProto using the tensor_content encoding, a single bytes copy of the array,
+    instead of one repeated field entry per element
+    :param array:
+    :param dtype: tensorflow dtype of the tensor
+    :return:
+    """
+    np_dtype, _ = DTYPE_MAP[dtype]
+    tensor = tensor_pb2.TensorProto(dtype=dtype)
+    for size in array.shape:
+        tensor.tensor_shape.dim.add(size=size)
+    tensor.tensor_content = np.ascontiguousarray(array, dtype=np_dtype).tobytes()
+    return tensor
+
+
+def tensor_proto_to_ndarray(
+        tensor: tensor_pb2.TensorProto
+) -> np.ndarray:
+    """
+    Reads a TensorProto into an array with the shape given by its tensor_shape.
+    Packed tensor_content is read without copying, the repeated value fields are read in a single pass.
+    :param tensor:
+    :return:
+    """
+    np_dtype, field = DTYPE_MAP[tensor.dtype]
+    shape = tuple(int(d.size) for d in tensor.tensor_shape.dim)
+
+    if tensor.tensor_content:
+        return np.frombuffer(tensor.tensor_content, dtype=np_dtype).reshape(shape)
+
+    values = getattr(tensor, field)
+    if tensor.dtype == types_pb2.DT_HALF:
+        # half values are stored as their bit patterns in an int32 field
+        array = np.fromiter(values, dtype=np.uint16, count=len(values)).view(np.float16)
+    else:
+        array = np.fromiter(values, dtype=np_dtype, count=len(values))
+
+    size = int(np.prod(shape))
+    if len(array) == 1 and size > 1:
+        # tensors with every element equal may be sent as a single value
+        return np.full(shape, array[0], dtype=np_dtype)
+    return array.reshape(shape)
+
+
 TF_LITE_MODEL_FILE = "models/vgg-simclr.tflite"
 
-interpreter_quant = tf.lite.Interpreter(model_path=str(TF_LITE_MODEL_FILE))
-interpreter_quant.allocate_tensors()
-input_index = interpreter_quant.get_input_details()[0]["index"]
-output_index = interpreter_quant.get_output_details()[0]["index"]
+
+def split_into_buckets(
+        n: int,
+        num_chunks: int
+) -> List[int]:
+    """
+    Splits n items into chunks whose sizes are powers of two, about num_chunks of them,
+    so that only a handful of distinct batch sizes ever reach the interpreters (see TFLiteInterpreterPool).
+    Nothing is padded: full chunks of the largest power of two not above n / num_chunks, then the remainder
+    in decreasing powers of two.
+    :param n:
+    :param num_chunks:
+    :return: chunk sizes, summing to n
+    """
+    if n == 0:
+        return []
+
+    target = -(-n // max(num_chunks, 1))
+    bucket = 1 << (target.bit_length() - 1)
+    sizes = [bucket] * (n // bucket)
+    remainder = n % bucket
+    while remainder:
+        size = 1 << (remainder.bit_length() - 1)
+        sizes.append(size)
+        remainder -= size
+    return sizes
+
+
+def get_tflite_interpreter_class():
+    """
+    Returns the TF Lite Interpreter class. The standalone tflite_runtime package is preferred when installed,
+    it loads in a fraction of the time it takes to initialize all of tensorflow.
+    :return:
+    """
+    try:
+        from tflite_runtime.interpreter import Interpreter
+    except ImportError:
+        import tensorflow as tf
+        Interpreter = tf.lite.Interpreter
+    return Interpreter
+
+
+class TFLiteInterpreterPool:
+    """
+    A pool of TF Lite interpreters for the same model.
+    Each interpreter is checked out by a single thread at a time, so concurrent predictions never share tensors,
+    and inference runs in a dedicated thread pool instead of on the event loop.
+    Resizing an interpreter reallocates its tensors, so batches are split into power of two sizes and every slot
+    of the pool keeps one interpreter per size it has seen. There are only a handful of sizes, and the interpreters
+    of a slot share the memory-mapped model, only their activation buffers are separate.
+    """
+    def __init__(
+            self,
+            model_path: str = TF_LITE_MODEL_FILE,
+            size: Optional[int] = None,
+            num_threads: int = 1
+    ):
+        """
+        :param model_path: path to the .tflite model file
+        :param size: number of slots in the pool, i.e. how many predictions run at the same time.
+            Defaults to the number of cores.
+        :param num_threads: number of threads each interpreter uses for its kernels
+        """
+        self.model_path = str(model_path)
+        self.size = size or os.cpu_count() or 1
+        self.num_threads = num_threads
+
+        # every slot maps batch sizes to an interpreter whose tensors are allocated for that size
+        self._slots: List[Dict[int, Any]] = []
+        for _ in range(self.size):
+            interpreter = self._create_interpreter()
+            self._slots.append({int(interpreter.get_input_details()[0]["shape"][0]): interpreter})
+        self._available = threading.Condition()
+        self.resizes = 0
+
+        self.executor = ThreadPoolExecutor(max_workers=self.size, thread_name_prefix="tflite")
+        self.closed = False
+
+    @contextmanager
+    def checkout(
+            self,
+            timeout: Optional[float] = None,
+            batch_size: Optional[int] = None
+    ):
+        """
+        Context manager that hands out an interpreter and returns it to the pool once done
+        :param timeout: how long to wait for a free interpreter, waits forever by default
+        :param batch_size: hands out an interpreter allocated for this batch size, creating it if needed
+        :return:
+        :raises TimeoutError: if no interpreter was free within timeout
+        """
+        with self._available:
+            if not self._available.wait_for(lambda: self._slots, timeout):
+                raise TimeoutError(f"No TF Lite interpreter was free within {timeout} s")
+            index = next((i for i, slot in enumerate(self._slots) if batch_size in slot), -1)
+            slot = self._slots.pop(index)
+        try:
+            if batch_size is None:
+                interpreter = next(iter(slot.values()))
+            else:
+                interpreter = slot.get(batch_size)
+                if interpreter is None:
+                    interpreter = slot[batch_size] = self._create_interpreter(batch_size)
+            yield interpreter
+        finally:
+            with self._available:
+                self._slots.append(slot)
+                self._available.notify()
+
+    def _create_interpreter(
+            self,
+            batch_size: Optional[int] = None
+    ):
+        interpreter = get_tflite_interpreter_class()(model_path=self.model_path, num_threads=self.num_threads)
+        if batch_size is not None:
+            input_details = interpreter.get_input_details()[0]
+            interpreter.resize_tensor_input(input_details["index"], (batch_size, *input_details["shape"][1:]))
+            self.resizes += 1
+        interpreter.allocate_tensors()
+        return interpreter
+
+    def predict(
+            self,
+            inputs: np.ndarray
+    ) -> np.ndarray:
+        """
+        Runs a (blocking) prediction on a batch of inputs, on the interpreter of a free slot allocated for its size
+        :param inputs:
+        :return:
+        """
+        with self.checkout(batch_size=len(inputs)) as interpreter:
+            input_details = interpreter.get_input_details()[0]
+            output_details = interpreter.get_output_details()[0]
+
+            if tuple(input_details["shape"]) != inputs.shape:
+                interpreter.resize_tensor_input(input_details["index"], inputs.shape)
+                interpreter.allocate_tensors()
+                self.resizes += 1
+
+            interpreter.set_tensor(input_details["index"], inputs.astype(input_details["dtype"], copy=False))
+            interpreter.invoke()
+
+            # get_tensor returns a copy, so the interpreter can be handed out again straight away
+            return interpreter.get_tensor(output_details["index"])
+
+    async def predict_async(
+            self,
+            inputs: np.ndarray
+    ) -> np.ndarray:
+        """
+        Runs a prediction in the pool's thread pool. Batches are split across the interpreters
+        so that a single large batch uses all of the cores, in chunks of power of two sizes (see split_into_buckets).
+        :param inputs:
+        :return:
+        """
+        if len(inputs) == 0:
+            with self.checkout() as interpreter:
+                output_details = interpreter.get_output_details()[0]
+            return np.empty((0, *output_details["shape"][1:]), dtype=output_details["dtype"])
+
+        loop = asyncio.get_event_loop()
+        offsets = np.cumsum([0] + split_into_buckets(len(inputs), self.size))
+        scores = await asyncio.gather(*[
+            loop.run_in_executor(self.executor, self.predict, inputs[start:end])
+            for start, end in zip(offsets[:-1], offsets[1:])
+        ])
+        return np.concatenate(scores, axis=0)
+
+    def close(self):
+        self.closed = True
+        self.executor.shutdown(wait=False)
+
+
+_tflite_pool: Optional[TFLiteInterpreterPool] = None
+
+
+def get_tflite_pool_size() -> int:
+    """
+    Returns the number of interpreters of the process-wide pool, TF_LITE_POOL_SIZE or the number of cores
+    :return:
+    """
+    return int(os.environ.get("TF_LITE_POOL_SIZE", 0)) or os.cpu_count() or 1
+
+
+def get_tflite_pool() -> TFLiteInterpreterPool:
+    """
+    Returns the process-wide pool of TF Lite interpreters, creating it on first use
+    :return:
+    """
+    global _tflite_pool
+    if _tflite_pool is None or _tflite_pool.closed:
+        _tflite_pool = TFLiteInterpreterPool(
+            model_path=os.environ.get("TF_LITE_MODEL_FILE", TF_LITE_MODEL_FILE),
+            size=get_tflite_pool_size(),
+            num_threads=int(os.environ.get("TF_LITE_NUM_THREADS", 1))
+        )
+    return _tflite_pool
+
+
+class TensorSignature(NamedTuple):
+    """
+    Describes a single input or output tensor of a model signature
+    """
+    name: str
+    dtype: int
+    shape: Tuple[int, ...]
+
+
+class ModelSignature(NamedTuple):
+    """
+    Input and output tensors of a signature of a model loaded into TF Serving
+    """
+    version: Optional[int]
+    inputs: Dict[str, TensorSignature]
+    outputs: Dict[str, TensorSignature]
+
+    @property
+    def input_name(self) -> str:
+        return list(self.inputs.keys())[0]
+
+    @property
+    def output_name(self) -> str:
+        return list(self.outputs.keys())[0]
+
+
+class TFServingClient:
+    """
+    Long-lived client for the TF Serving service.
+    Keeps a pool of gRPC channels (and their stubs) for every model uri, so that requests are sent over
+    warm connections, and caches the signature metadata of every model,
+    so that a prediction costs a single Predict RPC.
+    """
+    def __init__(
+            self,
+            pool_size: int = 4,
+            channel_options: List[Tuple[str, Any]] = None
+    ):
+        """
+        :param pool_size: number of channels to open for every model uri
+        :param channel_options: options passed on to each of the gRPC channels
+        """
+        self.pool_size = pool_size
+        self.channel_options = channel_options if channel_options is not None else MESSAGE_OPTIONS
+
+        self._channels: Dict[str, List[grpc.Channel]] = {}
+        self._stubs: Dict[str, Iterator[prediction_service_pb2_grpc.PredictionServiceStub]] = {}
+        self._signatures: Dict[Tuple[str, str, str, Optional[int]], ModelSignature] = {}
+        self._signature_locks: Dict[Tuple[str, str, str, Optional[int]], threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def get_stub(
+            self,
+            model_uri: str
+    ) -> prediction_service_pb2_grpc.PredictionServiceStub:
+        """
+        Returns a stub from the pool of the specified model uri, opening the channels on first use.
+        Stubs are handed out round-robin.
+        :param model_uri:
+        :return:
+        """
+        with self._lock:
+            if model_uri not in self._stubs:
+                channels = [
+                    grpc.insecure_channel(model_uri, options=self.channel_options) for _ in range(self.pool_size)
+                ]
+                stubs = [prediction_service_pb2_grpc.PredictionServiceStub(channel) for channel in channels]
+                self._channels[model_uri] = channels
+                self._stubs[model_uri] = itertools.cycle(stubs)
+            return next(self._stubs[model_uri])
+
+    def get_model_metadata(
+            self,
+            model_uri: str,
+            model_name: str,
+            signature_name: str = "serving_default",
+            version: Optional[int] = None,
+            timeout: float = 2.0
+    ) -> get_model_metadata_pb2.GetModelMetadataResponse:
+        """
+        Sends a GetModelMetadata request to TF Serving. The response is not cached, see get_signature.
+        :param model_uri:
+        :param model_name:
+        :param signature_name:
+        :param version:
+        :param timeout:
+        :return:
+        """
+        model_spec = ModelSpec(name=model_name, signature_name=signature_name)
+        if version is not None:
+            model_spec.version.value = version
+
+        request = get_model_metadata_pb2.GetModelMetadataRequest(model_spec=model_spec)
+        request.metadata_field.append("signature_def")
+
+        return self.get_stub(model_uri).GetModelMetadata(request, timeout)
+
+    def get_signature(
+            self,
+            model_uri: str,
+            model_name: str,
+            signature_name: str = "serving_default",
+            version: Optional[int] = None,
+            timeout: float = 2.0
+    ) -> ModelSignature:
+        """
+        Returns the (cached) input and output names, shapes and dtypes of a model signature.
+        When version is None the latest version loaded into TF Serving is used.
+        Concurrent misses for the same signature share a single GetModelMetadata RPC.
+        :param model_uri:
+        :param model_name:
+        :param signature_name:
+        :param version:
+        :param timeout:
+        :return:
+        """
+        key = (model_uri, model_name, signature_name, version)
+        with self._lock:
+            signature = self._signatures.get(key)
+            if signature is not None:
+                return signature
+            signature_lock = self._signature_locks.setdefault(key, threading.Lock())
+
+        with signature_lock:
+            # another thread may have fetched the signature while this one was waiting for the lock
+            with self._lock:
+                signature = self._signatures.get(key)
+            if signature is not None:
+                return signature
+            return self._fetch_signature(key, timeout)
+
+    async def get_signature_async(
+            self,
+            model_uri: str,
+            model_name: str,
+            signature_name: str = "serving_default",
+            version: Optional[int] = None,
+            timeout: float = 2.0
+    ) -> ModelSignature:
+        """
+        Same as get_signature, but a miss is fetched on a worker thread, so the event loop is never blocked
+        on the GetModelMetadata RPC
+        :param model_uri:
+        :param model_name:
+        :param signature_name:
+        :param version:
+        :param timeout:
+        :return:
+        """
+        with self._lock:
+            signature = self._signatures.get((model_uri, model_name, signature_name, version))
+        if signature is not None:
+            return signature
+
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            None, self.get_signature, model_uri, model_name, signature_name, version, timeout
+        )
+
+    def _fetch_signature(
+            self,
+            key: Tuple[str, str, str, Optional[int]],
+            timeout: float
+    ) -> ModelSignature:
+        model_uri, model_name, signature_name, version = key
+        result = self.get_model_metadata(model_uri, model_name, signature_name, version, timeout)
+        signature_def_map = SignatureDefMap()
+        result.metadata["signature_def"].Unpack(signature_def_map)
+        signature_def = signature_def_map.signature_def[signature_name]
+
+        def _describe(tensors) -> Dict[str, TensorSignature]:
+            return {
+                name: TensorSignature(
+                    name=name,
+                    dtype=tensor.dtype,
+                    shape=tuple(int(d.size) for d in tensor.tensor_shape.dim[1:])
+                )
+                for name, tensor in tensors.items()
+            }
+
+        loaded_version = result.model_spec.version.value if result.model_spec.HasField("version") else None
+        signature = ModelSignature(
+            version=loaded_version,
+            inputs=_describe(signature_def.inputs),
+            outputs=_describe(signature_def.outputs)
+        )
+        with self._lock:
+            self._signatures[key] = signature
+        return signature
+
+    def invalidate(
+            self,
+            model_name: Optional[str] = None
+    ):
+        """
+        Drops cached signatures, either for a single model or for all models
+        :param model_name:
+        :return:
+        """
+        with self._lock:
+            for key in list(self._signatures.keys()):
+                if model_name is None or key[1] == model_name:
+                    self._signatures.pop(key, None)
+
+    def _build_predict_request(
+            self,
+            inputs: np.ndarray,
+            model_uri: str,
+            model_name: str,
+            signature_name: str,
+            version: Optional[int],
+            input_name: Optional[str],
+            output_name: Optional[str],
+            timeout: float,
+            signature: Optional[ModelSignature] = None
+    ) -> predict_pb2.PredictRequest:
+        model_spec = ModelSpec(name=model_name, signature_name=signature_name)
+        if version is not None:
+            model_spec.version.value = version
+        request = predict_pb2.PredictRequest(model_spec=model_spec)
+
+        if signature is None:
+            signature = self.get_signature(model_uri, model_name, signature_name, version, timeout)
+        if input_name is None:
+            input_name = signature.input_name
+
+        input_dtype = signature.inputs[input_name].dtype if input_name in signature.inputs else types_pb2.DT_FLOAT
+        request.inputs[input_name].CopyFrom(ndarray_to_tensor_proto(inputs, input_dtype))
+        if output_name is not None:
+            request.output_filter.append(output_name)
+
+        return request
+
+    def _check_served_version(
+            self,
+            key: Tuple[str, str, str, Optional[int]],
+            result: predict_pb2.PredictResponse
+    ):
+        # drop the cached signature if the response comes from a model version other than the one it was fetched for
+        if not result.model_spec.HasField("version"):
+            return
+
+        served_version = result.model_spec.version.value
+        with self._lock:
+            signature = self._signatures.get(key)
+            if signature is None or signature.version == served_version:
+                return
+            if signature.version is None:
+                self._signatures[key] = signature._replace(version=served_version)
+                return
+        self.invalidate(key[1])
+
+    def predict(
+            self,
+            inputs: np.ndarray,
+            model_uri: str,
+            model_name: str,
+            signature_name: str = "serving_default",
+            version: Optional[int] = None,
+            input_name: str = None,
+            output_name: str = None,
+            timeout: float = 5.0
+    ) -> predict_pb2.PredictResponse:
+        """
+        Sends a single Predict request to TF Serving.
+        If the response comes from a model version other than the one whose signature is cached,
+        the cached signature is dropped so that it gets re-fetched on the next call.
+        :param inputs:
+        :param model_uri:
+        :param model_name:
+        :param signature_name:
+        :param version:
+        :param input_name:
+        :param output_name:
+        :param timeout:
+        :return:
+        """
+        request = self._build_predict_request(
+            inputs, model_uri, model_name, signature_name, version, input_name, output_name, timeout
+        )
+        result = self.get_stub(model_uri).Predict(request, timeout)
+        self._check_served_version((model_uri, model_name, signature_name, version), result)
+
+        return result
+
+    async def predict_async(
+            self,
+            inputs: np.ndarray,
+            model_uri: str,
+            model_name: str,
+            signature_name: str = "serving_default",
+            version: Optional[int] = None,
+            input_name: str = None,
+            output_name: str = None,
+            timeout: float = 5.0
+    ) -> predict_pb2.PredictResponse:
+        """
+        Same as predict, but awaits the signature and the response of the RPC instead of blocking the calling thread
+        :param inputs:
+        :param model_uri:
+        :param model_name:
+        :param signature_name:
+        :param version:
+        :param input_name:
+        :param output_name:
+        :param timeout:
+        :return:
+        """
+        signature = await self.get_signature_async(model_uri, model_name, signature_name, version, timeout)
+        request = self._build_predict_request(
+            inputs, model_uri, model_name, signature_name, version, input_name, output_name, timeout, signature
+        )
+
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        call = self.get_stub(model_uri).Predict.future(request, timeout)
+
+        def _transfer(call_future):
+            if future.cancelled():
+                return
+            exception = call_future.exception()
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(call_future.result())
+
+        # grpc runs the callback on one of its own threads
+        call.add_done_callback(lambda call_future: loop.call_soon_threadsafe(_transfer, call_future))
+        future.add_done_callback(lambda f: call.cancel() if f.cancelled() else None)
+
+        result = await future
+        self._check_served_version((model_uri, model_name, signature_name, version), result)
+
+        return result
+
+    def warmup(
+            self,
+            model_uri: str,
+            model_name: str,
+            signature_name: str = "serving_default",
+            timeout: float = 5.0
+    ) -> ModelSignature:
+        """
+        Opens the channels for the model uri and fetches the model signature ahead of the first prediction
+        :param model_uri:
+        :param model_name:
+        :param signature_name:
+        :param timeout:
+        :return:
+        """
+        self.get_stub(model_uri)
+        for channel in self._channels[model_uri]:
+            grpc.channel_ready_future(channel).result(timeout=timeout)
+        return self.get_signature(model_uri, model_name, signature_name, timeout=timeout)
+
+    def close(self):
+        """
+        Closes all open channels and clears the cache
+        :return:
+        """
+        with self._lock:
+            for channels in self._channels.values():
+                for channel in channels:
+                    channel.close()
+            self._channels.clear()
+            self._stubs.clear()
+            self._signatures.clear()
+
+
+_serving_client: Optional[TFServingClient] = None
+
+
+def get_serving_client() -> TFServingClient:
+    """
+    Returns the process-wide TFServingClient, creating it on first use
+    :return:
+    """
+    global _serving_client
+    if _serving_client is None:
+        _serving_client = TFServingClient(pool_size=int(os.environ.get("TF_SERVING_CHANNEL_POOL_SIZE", 4)))
+    return _serving_client
 
 
 def get_model_metadata(
@@ -42,13 +685,7 @@ def get_model_metadata(
     :param timeout:
     :return:
     """
-    channel = grpc.insecure_channel(model_uri)
-    stub = prediction_service_pb2_grpc.PredictionServiceStub(channel)
-    model_spec = ModelSpec(name=model_name, signature_name=signature_name)
-    request = get_model_metadata_pb2.GetModelMetadataRequest(model_spec=model_spec)
-    request.metadata_field.append("signature_def")
-
-    result = stub.GetModelMetadata(request, timeout)
+    result = get_serving_client().get_model_metadata(model_uri, model_name, signature_name, timeout=timeout)
     metadata = json.loads(MessageToJson(result))
 
     return metadata
@@ -67,11 +704,7 @@ def get_input_name(
     :return:
     """
 
-    model_metadata = get_model_metadata(model_uri, model_name, timeout=timeout)
-    signature_def = model_metadata['metadata']['signature_def']['signatureDef']
-    inputs = signature_def['serving_default']['inputs']
-
-    return list(inputs.keys())[0]
+    return get_serving_client().get_signature(model_uri, model_name, timeout=timeout).input_name
 
 
 def get_input_shape(
@@ -91,15 +724,11 @@ def get_input_shape(
     :return:
     """
 
-    model_metadata = get_model_metadata(model_uri, model_name, signature_name, timeout)
+    signature = get_serving_client().get_signature(model_uri, model_name, signature_name, timeout=timeout)
     if input_name is None:
-        input_name = get_input_name(model_uri, model_name, timeout)
-
-    signature_def = model_metadata['metadata']['signature_def']['signatureDef']
-    inputs = signature_def['serving_default']['inputs']
-    input_dims = inputs[input_name]['tensorShape']['dim'][1:]
+        input_name = signature.input_name
 
-    return tuple([int(d['size']) for d in input_dims])
+    return signature.inputs[input_name].shape
 
 
 def get_output_name(
@@ -115,11 +744,7 @@ def get_output_name(
     :return:
     """
 
-    model_metadata = get_model_metadata(model_uri, model_name, timeout=timeout)
-    signature_def = model_metadata['metadata']['signature_def']['signatureDef']
-    outputs = signature_def['serving_default']['outputs']
-
-    return list(outputs.keys())[0]
+    return get_serving_client().get_signature(model_uri, model_name, timeout=timeout).output_name
 
 
 def get_output_shape(
@@ -139,16 +764,11 @@ def get_output_shape(
     :return:
     """
 
-    model_metadata = get_model_metadata(model_uri, model_name, signature_name, timeout)
+    signature = get_serving_client().get_signature(model_uri, model_name, signature_name, timeout=timeout)
     if output_name is None:
-        output_name = get_input_name(model_uri, model_name, timeout)
-
-    signature_def = model_metadata['metadata']['signature_def']['signatureDef']
-    inputs = signature_def['serving_default']['outputs']
-    input_dims = inputs[output_name]['tensorShape']['dim'][1:]
-
-    return tuple([int(d['size']) for d in input_dims])
+        output_name = signature.output_name
 
+    return signature.outputs[output_name].shape
 
 
 def get_serving_prediction_scores(
@@ -161,7 +781,7 @@ def get_serving_prediction_scores(
         timeout: float = 5.0
 ):
     """
-    Returns the raw scores outputted by the specified model in TF Serving.
+    Returns the raw scores outputted by the specified model in TF Serving, with the shape of the output tensor
     :param inputs:
     :param model_uri:
     :param model_name:
@@ -172,25 +792,17 @@ def get_serving_prediction_scores(
     :return:
     """
 
-    channel = grpc.insecure_channel(model_uri, options=MESSAGE_OPTIONS)
-    stub = prediction_service_pb2_grpc.PredictionServiceStub(channel)
-    model_spec = ModelSpec(name=model_name, signature_name=signature_name)
-    request = predict_pb2.PredictRequest(model_spec=model_spec)
+    client = get_serving_client()
+    signature = client.get_signature(model_uri, model_name, signature_name, timeout=timeout)
 
     if input_name is None:
-        input_name = get_input_name(model_uri, model_name, timeout)
+        input_name = signature.input_name
 
     if output_name is None:
-        output_name = get_output_name(model_uri, model_name, timeout)
-
-    request.inputs[input_name].CopyFrom(make_tensor_proto(inputs.astype(np.float32), shape=inputs.shape))
-    result = stub.Predict(request, timeout)
-    channel.close()
-
-    output_shape = get_output_shape(model_uri, model_name, output_name, timeout=timeout)
-    scores = np.zeros(shape=output_shape)
+        output_name = signature.output_name
 
-    for i, score in enumerate(result.outputs[output_name].float_val):
-        scores[i] = score
+    result = client.predict(
+        inputs, model_uri, model_name, signature_name, input_name=input_name, output_name=output_name, timeout=timeout
+    )
 
-    return scores
+    return tensor_proto_to_ndarray(result.outputs[output_name])
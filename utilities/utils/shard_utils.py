@@ -0,0 +1,255 @@
+"""
+Sharded, pre-decoded and pre-resized image datasets stored as .npy files.
+Written once by scripts/preprocess_data_for_tf_generator.py, read by the training pipeline
+(generator_utils.create_datasets_from_shards) and by offline evaluation (ShardedArrayDataset).
+
+Layout of a shards directory:
+    manifest.json
+    <subset>/images-00000.npy  uint8 array of shape (n, height, width, channels)
+    <subset>/labels-00000.npy  int16 array of shape (n,)
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import *
+
+import cv2
+import numpy as np
+import simplejson as json
+
+from utils.image_utils import decode_image
+
+MANIFEST_FILENAME = "manifest.json"
+MANIFEST_VERSION = 1
+INTERPOLATION_METHODS = {
+    "nearest": cv2.INTER_NEAREST,
+    "linear": cv2.INTER_LINEAR,
+    "area": cv2.INTER_AREA
+}
+
+
+def load_image_for_shard(
+        path: str,
+        target_size: Tuple[int, int],
+        channels: int,
+        interpolation: str
+) -> np.ndarray:
+    """
+    Decodes an image and resizes it to target_size, as a (height, width, channels) uint8 array
+    :param path:
+    :param target_size: (height, width)
+    :param channels: 1 or 3
+    :param interpolation: one of INTERPOLATION_METHODS
+    :return:
+    """
+    with open(path, "rb") as f:
+        img = decode_image(f.read(), target_size=target_size)
+    if img is None:
+        raise ValueError(f"Could not decode {path}")
+
+    if img.ndim == 3 and channels == 1:
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    elif img.ndim == 2 and channels == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_GRAY2RGB)
+    elif img.ndim == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+    img = cv2.resize(img, (target_size[1], target_size[0]), interpolation=INTERPOLATION_METHODS[interpolation])
+    return img.reshape(target_size[0], target_size[1], channels)
+
+
+def write_shard(
+        paths: List[str],
+        labels: List[int],
+        images_path: str,
+        labels_path: str,
+        target_size: Tuple[int, int],
+        channels: int,
+        interpolation: str
+) -> int:
+    """
+    Writes one shard. Images are decoded straight into a memory-mapped .npy file, so a shard never has to fit
+    in memory, and the files are only moved into place once they are complete.
+    :return: number of images in the shard
+    """
+    tmp_images_path = images_path + ".tmp"
+    images = np.lib.format.open_memmap(
+        tmp_images_path, mode="w+", dtype=np.uint8, shape=(len(paths), target_size[0], target_size[1], channels)
+    )
+    for i, path in enumerate(paths):
+        images[i] = load_image_for_shard(path, target_size, channels, interpolation)
+    images.flush()
+    del images
+
+    np.save(labels_path, np.asarray(labels, dtype=np.int16))
+    os.replace(tmp_images_path, images_path)
+    return len(paths)
+
+
+def write_shards(
+        output_directory: Union[Path, str],
+        subset_files: Dict[str, List[Tuple[str, int]]],
+        class_names: List[str],
+        target_size: Tuple[int, int] = (256, 256),
+        channels: int = 1,
+        interpolation: str = "nearest",
+        shard_size: int = 1024,
+        workers: Optional[int] = None,
+        seed: int = 0,
+        progress: Optional[Callable[[int, int], None]] = None
+) -> dict:
+    """
+    Writes the images of every subset into shards of at most shard_size images, one shard per process at a time,
+    and a manifest listing the shards and the source file of every image.
+    Train images are shuffled before sharding, so that every shard holds a mix of classes.
+    :param output_directory:
+    :param subset_files: subset name -> list of (image path, class index)
+    :param class_names: class name of every class index
+    :param target_size: (height, width) the images are resized to
+    :param channels: 1 stores the (grayscale) scans as they are, readers expand them to 3 channels
+    :param interpolation: one of INTERPOLATION_METHODS, nearest matches flow_from_directory
+    :param shard_size: maximum number of images per shard
+    :param workers: number of processes, defaults to the number of cores
+    :param seed: seed of the shuffle of the train images
+    :param progress: called with (shards done, total shards) after every shard
+    :return: the manifest
+    """
+    output_directory = Path(output_directory)
+    rng = np.random.RandomState(seed)
+
+    jobs = []
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "target_size": list(target_size),
+        "channels": channels,
+        "interpolation": interpolation,
+        "class_names": list(class_names),
+        "subsets": {}
+    }
+    for subset, files in subset_files.items():
+        files = sorted(files)
+        if subset == "train":
+            files = [files[i] for i in rng.permutation(len(files))]
+
+        (output_directory / subset).mkdir(parents=True, exist_ok=True)
+        shards = []
+        for shard_index, start in enumerate(range(0, len(files), shard_size)):
+            shard_files = files[start:start + shard_size]
+            shard = {
+                "images": f"{subset}/images-{shard_index:05d}.npy",
+                "labels": f"{subset}/labels-{shard_index:05d}.npy",
+                "num_examples": len(shard_files),
+                "files": [str(path) for path, _ in shard_files]
+            }
+            shards.append(shard)
+            jobs.append((
+                [str(path) for path, _ in shard_files], [label for _, label in shard_files],
+                str(output_directory / shard["images"]), str(output_directory / shard["labels"]),
+                tuple(target_size), channels, interpolation
+            ))
+        manifest["subsets"][subset] = {"num_examples": len(files), "shards": shards}
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(write_shard, *job) for job in jobs]
+        for done, future in enumerate(futures, 1):
+            future.result()
+            if progress is not None:
+                progress(done, len(futures))
+
+    # the manifest goes last, a directory with a manifest always has all of its shards
+    tmp_manifest_path = output_directory / (MANIFEST_FILENAME + ".tmp")
+    with open(tmp_manifest_path, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_manifest_path, output_directory / MANIFEST_FILENAME)
+    return manifest
+
+
+def load_manifest(
+        shards_directory: Union[Path, str]
+) -> dict:
+    """
+    Reads the manifest of a shards directory
+    :param shards_directory:
+    :return:
+    """
+    with open(Path(shards_directory) / MANIFEST_FILENAME) as f:
+        manifest = json.load(f)
+
+    if manifest.get("version") != MANIFEST_VERSION:
+        raise ValueError(f"Unsupported shards manifest version {manifest.get('version')}")
+    return manifest
+
+
+class ShardedArrayDataset:
+    """
+    Random access to the images of one subset of a shards directory, through memory maps.
+    Meant for offline evaluation, training reads shards through generator_utils.create_datasets_from_shards.
+    """
+    def __init__(
+            self,
+            shards_directory: Union[Path, str],
+            subset: str
+    ):
+        """
+        :param shards_directory:
+        :param subset: e.g. train, val or test
+        """
+        self.shards_directory = Path(shards_directory)
+        self.manifest = load_manifest(shards_directory)
+        if subset not in self.manifest["subsets"]:
+            raise ValueError(f"{subset} is not in {shards_directory}")
+
+        self.subset = subset
+        self.shards = self.manifest["subsets"][subset]["shards"]
+        self.class_names = self.manifest["class_names"]
+        self.images = [np.load(self.shards_directory / shard["images"], mmap_mode="r") for shard in self.shards]
+        self.labels = np.concatenate(
+            [np.load(self.shards_directory / shard["labels"]) for shard in self.shards]
+        ) if self.shards else np.zeros(0, dtype=np.int16)
+        self.files = [path for shard in self.shards for path in shard["files"]]
+        self.offsets = np.cumsum([0] + [shard["num_examples"] for shard in self.shards])
+
+    def __len__(self) -> int:
+        return int(self.offsets[-1])
+
+    def get_images(
+            self,
+            start: int,
+            stop: int
+    ) -> np.ndarray:
+        """
+        Returns the images start to stop (exclusive) as a uint8 array, reading across shard boundaries
+        :param start:
+        :param stop:
+        :return:
+        """
+        parts = []
+        first_shard = int(np.searchsorted(self.offsets, start, side="right")) - 1
+        for shard_index in range(first_shard, len(self.shards)):
+            offset = self.offsets[shard_index]
+            if offset >= stop:
+                break
+            parts.append(self.images[shard_index][max(start - offset, 0):stop - offset])
+        return np.concatenate(parts) if len(parts) > 1 else np.asarray(parts[0])
+
+    def iter_batches(
+            self,
+            batch_size: int = 32,
+            rgb: bool = True,
+            scale: bool = True
+    ) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Yields (images, labels) batches in the order of the shards
+        :param batch_size:
+        :param rgb: expand grayscale images to 3 channels
+        :param scale: return float32 images scaled to [0, 1], as the training pipeline does
+        :return:
+        """
+        for start in range(0, len(self), batch_size):
+            stop = min(start + batch_size, len(self))
+            images = self.get_images(start, stop)
+            if rgb and images.shape[-1] == 1:
+                images = np.repeat(images, 3, axis=-1)
+            if scale:
+                images = images.astype(np.float32) / 255.
+            yield images, self.labels[start:stop]
@@ -0,0 +1,384 @@
+"""
+Object storage backends and background uploads go here
+"""
+import os
+import asyncio
+import logging
+import tempfile
+import threading
+import time
+from pathlib import Path, PureWindowsPath
+from urllib.parse import quote, unquote, urlsplit
+from urllib.request import url2pathname
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import *
+
+logger = logging.getLogger("storage_utils.py")
+
+
+def safe_filename(
+        filename: Optional[str],
+        default: str = "upload"
+) -> str:
+    """
+    Reduces a client supplied file name to its last component, so that it can not point outside the directory
+    it is stored in. Both / and \\ are treated as separators.
+    :param filename:
+    :param default: returned when nothing usable is left, e.g. for '..'
+    :return:
+    """
+    name = PureWindowsPath(filename or "").name
+    return name if name not in ("", ".", "..") else default
+
+
+class StorageBackend:
+    """
+    Base class for the object stores uploaded images and reports are persisted to
+    """
+    def upload_bytes(
+            self,
+            data: bytes,
+            path: str,
+            content_type: Optional[str] = None
+    ) -> str:
+        """
+        Stores data under path and returns its url
+        :param data:
+        :param path:
+        :param content_type:
+        :return:
+        """
+        raise NotImplementedError
+
+    def download_bytes(
+            self,
+            path: str
+    ) -> Optional[bytes]:
+        """
+        Returns the data stored under path
+        :param path:
+        :return: None if there is no object under path
+        """
+        raise NotImplementedError
+
+    def url_for(
+            self,
+            path: str
+    ) -> str:
+        """
+        Returns the url an object stored under path is (or will be) available at
+        :param path:
+        :return:
+        """
+        raise NotImplementedError
+
+    def path_for(
+            self,
+            url: str
+    ) -> Optional[str]:
+        """
+        Maps a url returned by url_for back to the path of the object
+        :param url:
+        :return: None if the url does not point to an object of this backend
+        """
+        raise NotImplementedError
+
+
+class GCSStorageBackend(StorageBackend):
+    """
+    Stores objects in a Google Cloud Storage bucket
+    """
+    def __init__(
+            self,
+            bucket_name: str,
+            public_urls: bool = False
+    ):
+        """
+        :param bucket_name:
+        :param public_urls: return https://storage.googleapis.com/<bucket>/<path> urls, which only work if the bucket
+            is publicly readable. Otherwise the media link of the objects is returned, as for blob.media_link,
+            which is downloaded with the credentials of the client.
+        """
+        self.bucket_name = bucket_name
+        self.public_urls = public_urls
+
+    def upload_bytes(
+            self,
+            data: bytes,
+            path: str,
+            content_type: Optional[str] = None
+    ) -> str:
+        from utils import gcs_utils
+
+        bucket = gcs_utils.get_storage_client().bucket(self.bucket_name)
+        blob = bucket.blob(path)
+        blob.upload_from_string(data, content_type=content_type)
+        return self.url_for(path)
+
+    def download_bytes(
+            self,
+            path: str
+    ) -> Optional[bytes]:
+        from google.cloud.exceptions import NotFound
+        from utils import gcs_utils
+
+        blob = gcs_utils.get_storage_client().bucket(self.bucket_name).blob(path)
+        try:
+            return blob.download_as_bytes()
+        except NotFound:
+            return None
+
+    def url_for(
+            self,
+            path: str
+    ) -> str:
+        if self.public_urls:
+            return f"https://storage.googleapis.com/{self.bucket_name}/{quote(path)}"
+        # the url is known before the upload, so unlike blob.media_link it does not pin the generation
+        object_name = quote(path, safe="")
+        return f"https://storage.googleapis.com/download/storage/v1/b/{self.bucket_name}/o/{object_name}?alt=media"
+
+    def path_for(
+            self,
+            url: str
+    ) -> Optional[str]:
+        # both kinds of urls are mapped, whichever kind the backend returns now
+        parts = urlsplit(url)
+        if parts.scheme != "https" or parts.netloc != "storage.googleapis.com":
+            return None
+        for prefix in (f"/download/storage/v1/b/{self.bucket_name}/o/", f"/{self.bucket_name}/"):
+            if parts.path.startswith(prefix) and len(parts.path) > len(prefix):
+                return unquote(parts.path[len(prefix):])
+        return None
+
+
+class LocalStorageBackend(StorageBackend):
+    """
+    Stores objects on the local filesystem. A stand-in for cloud storage for local runs and benchmarks.
+    """
+    def __init__(
+            self,
+            root_directory: Union[str, Path],
+            base_url: Optional[str] = None
+    ):
+        """
+        :param root_directory: directory objects are written to
+        :param base_url: url the root directory is served under, file:// urls are returned if not set
+        """
+        self.root_directory = Path(root_directory).resolve()
+        self.base_url = base_url.rstrip("/") if base_url else None
+
+    def _full_path(
+            self,
+            path: str
+    ) -> Path:
+        full_path = (self.root_directory / path).resolve()
+        if full_path != self.root_directory and self.root_directory not in full_path.parents:
+            raise ValueError(f"{path} is outside of the storage root {self.root_directory}")
+        return full_path
+
+    def upload_bytes(
+            self,
+            data: bytes,
+            path: str,
+            content_type: Optional[str] = None
+    ) -> str:
+        full_path = self._full_path(path)
+        full_path.parent.mkdir(parents=True, exist_ok=True)
+
+        # write to a temporary file first so readers never see a partially written object
+        fd, tmp_path = tempfile.mkstemp(dir=full_path.parent)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, full_path)
+
+        return self.url_for(path)
+
+    def download_bytes(
+            self,
+            path: str
+    ) -> Optional[bytes]:
+        full_path = self._full_path(path)
+        if not full_path.is_file():
+            return None
+        return full_path.read_bytes()
+
+    def url_for(
+            self,
+            path: str
+    ) -> str:
+        full_path = self._full_path(path)
+        if self.base_url:
+            relative_path = full_path.relative_to(self.root_directory).as_posix()
+            return f"{self.base_url}/{relative_path if relative_path != '.' else ''}"
+        return full_path.as_uri()
+
+    def path_for(
+            self,
+            url: str
+    ) -> Optional[str]:
+        if self.base_url and url.startswith(self.base_url + "/"):
+            path = unquote(urlsplit(url[len(self.base_url) + 1:]).path)
+        elif url.startswith("file:"):
+            path = url2pathname(urlsplit(url).path)
+        else:
+            return None
+
+        try:
+            relative_path = self._full_path(path).relative_to(self.root_directory).as_posix()
+        except ValueError:
+            return None
+        return relative_path if relative_path != "." else None
+
+
+def get_storage_backend(
+        kind: Optional[str] = None
+) -> StorageBackend:
+    """
+    Returns the storage backend selected by the STORAGE_BACKEND env variable (gcs or local).
+    GCS_PUBLIC_URLS=true makes the gcs backend return public urls, see GCSStorageBackend.
+    :param kind: overrides STORAGE_BACKEND
+    :return:
+    """
+    kind = kind or os.environ.get("STORAGE_BACKEND", "gcs")
+
+    if kind == "gcs":
+        return GCSStorageBackend(
+            os.environ.get("GCS_PROJECT_BUCKET"), public_urls=os.environ.get("GCS_PUBLIC_URLS", "false") == "true"
+        )
+
+    if kind == "local":
+        return LocalStorageBackend(
+            os.environ.get("LOCAL_STORAGE_ROOT", "local_storage"),
+            base_url=os.environ.get("LOCAL_STORAGE_BASE_URL")
+        )
+
+    raise ValueError(f"{kind} is not a valid storage backend. Must be one of ['gcs', 'local']")
+
+
+class BackgroundUploader:
+    """
+    Persists objects to a storage backend from a bounded pool of worker threads,
+    so that uploads are kept off the latency-critical path of a request.
+    """
+    def __init__(
+            self,
+            backend: StorageBackend,
+            max_workers: int = 4,
+            max_pending: int = 64,
+            on_upload: Optional[Callable[[float, bool], None]] = None
+    ):
+        """
+        :param backend: where objects are uploaded to
+        :param max_workers: number of upload threads
+        :param max_pending: maximum number of queued and running uploads, submit waits once it is reached
+        :param on_upload: called from the upload threads with the duration of every upload and whether it succeeded
+        """
+        self.backend = backend
+        self.max_pending = max_pending
+        self.on_upload = on_upload
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="uploader")
+
+        self.failed_uploads = 0
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def _upload(
+            self,
+            data: bytes,
+            path: str,
+            content_type: Optional[str]
+    ) -> bool:
+        start = time.perf_counter()
+        succeeded = True
+        try:
+            self.backend.upload_bytes(data, path, content_type)
+        except Exception as e:
+            succeeded = False
+            with self._lock:
+                self.failed_uploads += 1
+            logger.error(f"Failed to upload {path}: {e}")
+        if self.on_upload is not None:
+            self.on_upload(time.perf_counter() - start, succeeded)
+        return succeeded
+
+    async def _schedule(
+            self,
+            data: bytes,
+            path: str,
+            content_type: Optional[str]
+    ) -> Future:
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_pending)
+
+        await self._slots.acquire()
+        future = self.executor.submit(self._upload, data, path, content_type)
+        with self._lock:
+            self._pending.add(future)
+
+        loop = asyncio.get_event_loop()
+
+        def _on_done(f):
+            with self._lock:
+                self._pending.discard(f)
+            try:
+                loop.call_soon_threadsafe(self._slots.release)
+            except RuntimeError:
+                # the loop has already been closed, e.g. when draining uploads on shutdown
+                pass
+
+        future.add_done_callback(_on_done)
+        return future
+
+    async def submit(
+            self,
+            data: bytes,
+            path: str,
+            content_type: Optional[str] = None
+    ) -> str:
+        """
+        Schedules an upload and returns the url the object will be available at once the upload is done.
+        Only waits if max_pending uploads are already in flight.
+        :param data:
+        :param path:
+        :param content_type:
+        :return:
+        """
+        # raises before anything is scheduled if the backend rejects the path
+        url = self.backend.url_for(path)
+        await self._schedule(data, path, content_type)
+        return url
+
+    async def upload(
+            self,
+            data: bytes,
+            path: str,
+            content_type: Optional[str] = None
+    ) -> Optional[str]:
+        """
+        Uploads on the upload threads like submit, but only returns the url once the object is available there.
+        Start it with asyncio.ensure_future to overlap the upload with other work.
+        :param data:
+        :param path:
+        :param content_type:
+        :return: None if the upload failed
+        """
+        url = self.backend.url_for(path)
+        succeeded = await asyncio.wrap_future(await self._schedule(data, path, content_type))
+        return url if succeeded else None
+
+    @property
+    def pending_uploads(self) -> int:
+        return len(self._pending)
+
+    def close(
+            self,
+            wait: bool = True
+    ):
+        """
+        Stops accepting uploads, by default waiting for the pending ones to finish
+        :param wait:
+        :return:
+        """
+        self.executor.shutdown(wait=wait)
@@ -0,0 +1,230 @@
+"""
+Incremental copies of an image dataset. A manifest in the destination directory records the source, size,
+modification time, content hash and label of every file, so that re-running a sync only copies (or links)
+new and changed files, and removes the ones that are gone from the source.
+"""
+import hashlib
+import os
+import shutil
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import *
+
+import simplejson as json
+
+MANIFEST_FILENAME = "manifest.json"
+MANIFEST_VERSION = 1
+SYNC_MODES = ("copy", "hardlink", "symlink")
+HASH_CHUNK_SIZE = 1 << 20
+
+
+def file_digest(
+        path: Union[Path, str]
+) -> str:
+    """
+    Returns the hex digest of the content of a file
+    :param path:
+    :return:
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def copy_with_digest(
+        source: Union[Path, str],
+        destination: Union[Path, str]
+) -> str:
+    """
+    Copies a file and returns the hex digest of its content, reading the source only once
+    :param source:
+    :param destination:
+    :return:
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        for chunk in iter(lambda: src.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+            dst.write(chunk)
+    shutil.copymode(source, destination)
+    return digest.hexdigest()
+
+
+def place_file(
+        source: Union[Path, str],
+        destination: Path,
+        mode: str = "copy"
+) -> str:
+    """
+    Copies, hardlinks or symlinks source to destination, replacing destination only once the new file is complete
+    :param source:
+    :param destination:
+    :param mode: one of SYNC_MODES
+    :return: hex digest of the content of the file
+    """
+    tmp_destination = destination.with_name(destination.name + ".tmp")
+    if os.path.lexists(tmp_destination):
+        os.remove(tmp_destination)
+
+    if mode == "copy":
+        digest = copy_with_digest(source, tmp_destination)
+    elif mode == "hardlink":
+        digest = file_digest(source)
+        os.link(source, tmp_destination)
+    elif mode == "symlink":
+        digest = file_digest(source)
+        os.symlink(os.path.abspath(source), tmp_destination)
+    else:
+        raise ValueError(f"{mode} is not a valid sync mode. Must be one of {list(SYNC_MODES)}")
+
+    os.replace(tmp_destination, destination)
+    return digest
+
+
+def scan_files(
+        path_to_data_directory: Path,
+        subset_classes: Dict[str, List[str]],
+        class_map: Dict[str, int],
+        file_extension: str
+) -> Dict[str, dict]:
+    """
+    Lists the files of every class of every subset, with the metadata needed to tell whether they changed
+    :param path_to_data_directory: directory with one sub-directory per subset, with one sub-directory per class
+    :param subset_classes: subset name -> class names
+    :param class_map: class name -> class index, the name of the class directories in the destination
+    :param file_extension:
+    :return: path relative to the destination directory -> {source, size, mtime_ns, label}
+    """
+    files = {}
+    for subset, class_names in subset_classes.items():
+        for class_name in class_names:
+            label = class_map[class_name]
+            with os.scandir(path_to_data_directory / subset / class_name) as entries:
+                for entry in entries:
+                    if not entry.name.endswith(file_extension) or not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                    files[f"{subset}/{label}/{entry.name}"] = {
+                        "source": entry.path, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "label": label
+                    }
+    return files
+
+
+def load_manifest(
+        destination_directory: Union[Path, str]
+) -> dict:
+    """
+    Reads the manifest of a destination directory, an empty manifest if there is none or it is outdated
+    :param destination_directory:
+    :return:
+    """
+    try:
+        with open(Path(destination_directory) / MANIFEST_FILENAME) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {"version": MANIFEST_VERSION, "mode": None, "files": {}}
+
+    if manifest.get("version") != MANIFEST_VERSION:
+        return {"version": MANIFEST_VERSION, "mode": None, "files": {}}
+    return manifest
+
+
+def save_manifest(
+        destination_directory: Union[Path, str],
+        manifest: dict
+):
+    path = Path(destination_directory) / MANIFEST_FILENAME
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, path)
+
+
+def sync_files(
+        files: Dict[str, dict],
+        destination_directory: Union[Path, str],
+        mode: str = "copy",
+        verify: bool = False,
+        workers: Optional[int] = None,
+        progress: Optional[Callable[[int, int], None]] = None,
+        progress_every: int = 1000,
+        checkpoint_seconds: float = 30.0
+) -> Counter:
+    """
+    Brings destination_directory up to date with files, as listed by scan_files.
+    Files whose size and modification time match the manifest are skipped without being read,
+    files whose metadata changed but whose content did not are only updated in the manifest.
+    The manifest is saved every checkpoint_seconds, an interrupted sync resumes where it stopped.
+    :param files: path relative to destination_directory -> {source, size, mtime_ns, label}
+    :param destination_directory:
+    :param mode: one of SYNC_MODES. Hardlinks need the destination on the same filesystem as the source.
+        Changing the mode re-creates every file.
+    :param verify: also hash the files whose size and modification time did not change
+    :param workers: number of threads copying files
+    :param progress: called with (files done, files to sync) every progress_every files
+    :param progress_every:
+    :param checkpoint_seconds:
+    :return: number of files per outcome: added, updated, unchanged and removed
+    """
+    if mode not in SYNC_MODES:
+        raise ValueError(f"{mode} is not a valid sync mode. Must be one of {list(SYNC_MODES)}")
+
+    destination_directory = Path(destination_directory)
+    destination_directory.mkdir(parents=True, exist_ok=True)
+    manifest = load_manifest(destination_directory)
+    entries = manifest["files"] if manifest["mode"] == mode else {}
+    manifest = {"version": MANIFEST_VERSION, "mode": mode, "files": entries}
+    stats = Counter()
+
+    for relative_path in [path for path in entries if path not in files]:
+        destination = destination_directory / relative_path
+        if os.path.lexists(destination):
+            os.remove(destination)
+        del entries[relative_path]
+        stats["removed"] += 1
+
+    def is_unchanged(relative_path: str, file: dict) -> bool:
+        entry = entries.get(relative_path)
+        return (
+            entry is not None
+            and all(entry[key] == file[key] for key in ("source", "size", "mtime_ns", "label"))
+            and os.path.lexists(destination_directory / relative_path)
+        )
+
+    def sync_file(relative_path: str, file: dict) -> Tuple[str, dict, str]:
+        entry = entries.get(relative_path)
+        destination = destination_directory / relative_path
+        if entry is not None and entry["source"] == file["source"] and os.path.lexists(destination):
+            digest = file_digest(file["source"])
+            if digest == entry["hash"]:
+                return relative_path, {**file, "hash": digest}, "unchanged"
+
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        digest = place_file(file["source"], destination, mode)
+        return relative_path, {**file, "hash": digest}, "added" if entry is None else "updated"
+
+    to_sync = [(path, file) for path, file in files.items() if verify or not is_unchanged(path, file)]
+    stats["unchanged"] += len(files) - len(to_sync)
+
+    last_checkpoint = time.monotonic()
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(sync_file, path, file) for path, file in to_sync]
+            for done, future in enumerate(as_completed(futures), 1):
+                relative_path, entry, outcome = future.result()
+                entries[relative_path] = entry
+                stats[outcome] += 1
+
+                if progress is not None and (done % progress_every == 0 or done == len(futures)):
+                    progress(done, len(futures))
+                if time.monotonic() - last_checkpoint > checkpoint_seconds:
+                    save_manifest(destination_directory, manifest)
+                    last_checkpoint = time.monotonic()
+    finally:
+        # whatever was synced before a failure does not have to be synced again
+        save_manifest(destination_directory, manifest)
+    return stats
@@ -0,0 +1,251 @@
+"""
+Conversion of trained Keras models to TF Lite, with post-training quantization, and the comparison of the
+quantized variants against the float model to pick the one to serve (see serving_utils.TFLiteInterpreterPool).
+"""
+import os
+import time
+from typing import *
+
+import numpy as np
+import simplejson as json
+import tensorflow as tf
+from tensorflow.keras.models import Model
+
+# float32 is the unquantized model the other variants are compared against
+QUANTIZATION_MODES = ("float32", "dynamic_range", "float16", "int8")
+REPORT_FILENAME = "tflite-report.json"
+
+
+def sample_flow(
+        flow,
+        num_samples: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the first num_samples images of a flow (see generator_utils.create_flows) and their class indices
+    :param flow:
+    :param num_samples:
+    :return: float32 images of shape (n, height, width, channels) and int labels of shape (n, )
+    """
+    images, labels = [], []
+    collected = 0
+    for i in range(len(flow)):
+        batch_images, batch_labels = flow[i]
+        images.append(batch_images)
+        labels.append(batch_labels.argmax(axis=-1) if batch_labels.ndim == 2 else batch_labels)
+        collected += len(batch_images)
+        if collected >= num_samples:
+            break
+
+    return np.concatenate(images)[:num_samples].astype(np.float32), np.concatenate(labels)[:num_samples].astype(int)
+
+
+def get_representative_dataset(
+        images: np.ndarray
+) -> Callable[[], Iterator[List[np.ndarray]]]:
+    """
+    Returns the representative dataset the converter calibrates the int8 ranges of activations on
+    :param images: calibration images, prepared like the training images
+    :return:
+    """
+    def representative_dataset():
+        for image in images:
+            yield [image[np.newaxis].astype(np.float32)]
+
+    return representative_dataset
+
+
+def convert_to_tflite(
+        model: Model,
+        mode: str = "int8",
+        representative_images: Optional[np.ndarray] = None,
+        int8_io: bool = False
+) -> bytes:
+    """
+    Converts a Keras model to a TF Lite flatbuffer
+    :param model:
+    :param mode: one of QUANTIZATION_MODES.
+        dynamic_range stores weights in int8 and quantizes activations on the fly,
+        float16 stores weights in float16,
+        int8 quantizes weights and activations, calibrated on representative_images
+    :param representative_images: required for int8, a few hundred training images are usually enough
+    :param int8_io: with int8, also quantize the input and output. The model then has to be fed int8 inputs,
+        by default it takes and returns float32 like the other variants, so the server can use it as is.
+    :return:
+    """
+    if mode not in QUANTIZATION_MODES:
+        raise ValueError(f"{mode} is not a valid quantization mode. Must be one of {list(QUANTIZATION_MODES)}")
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    if mode != "float32":
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+
+    if mode == "float16":
+        converter.target_spec.supported_types = [tf.float16]
+
+    if mode == "int8":
+        if representative_images is None:
+            raise ValueError("int8 quantization needs representative images to calibrate on")
+        converter.representative_dataset = get_representative_dataset(representative_images)
+        # fail rather than silently fall back to float kernels for ops without an int8 implementation
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        if int8_io:
+            converter.inference_input_type = tf.int8
+            converter.inference_output_type = tf.int8
+
+    return converter.convert()
+
+
+def _quantize(
+        values: np.ndarray,
+        details: dict
+) -> np.ndarray:
+    scale, zero_point = details["quantization"]
+    if details["dtype"] == np.float32 or not scale:
+        return values.astype(details["dtype"])
+    info = np.iinfo(details["dtype"])
+    return np.clip(np.rint(values / scale + zero_point), info.min, info.max).astype(details["dtype"])
+
+
+def _dequantize(
+        values: np.ndarray,
+        details: dict
+) -> np.ndarray:
+    scale, zero_point = details["quantization"]
+    if details["dtype"] == np.float32 or not scale:
+        return values.astype(np.float32)
+    return (values.astype(np.float32) - zero_point) * scale
+
+
+def evaluate_tflite(
+        model_content: bytes,
+        images: np.ndarray,
+        labels: np.ndarray,
+        num_threads: int = 1,
+        latency_samples: int = 100
+) -> Dict[str, Any]:
+    """
+    Measures the accuracy of a TF Lite model and its latency for single images, the way the server runs it
+    :param model_content: the flatbuffer returned by convert_to_tflite
+    :param images: evaluation images, prepared like the training images
+    :param labels: their class indices
+    :param num_threads: threads per interpreter, see serving_utils.TFLiteInterpreterPool
+    :param latency_samples: number of single image predictions timed
+    :return: accuracy, the predicted classes and percentiles of the latency in milliseconds
+    """
+    from utils.serving_utils import get_tflite_interpreter_class
+
+    interpreter = get_tflite_interpreter_class()(model_content=model_content, num_threads=num_threads)
+    interpreter.allocate_tensors()
+    input_details = interpreter.get_input_details()[0]
+    output_details = interpreter.get_output_details()[0]
+
+    def predict(image: np.ndarray) -> np.ndarray:
+        interpreter.set_tensor(input_details["index"], _quantize(image[np.newaxis], input_details))
+        interpreter.invoke()
+        return _dequantize(interpreter.get_tensor(output_details["index"]), output_details)[0]
+
+    predict(images[0])  # warm up
+    predictions, latencies = [], []
+    for i, image in enumerate(images):
+        start = time.perf_counter()
+        predictions.append(predict(image).argmax())
+        if i < latency_samples:
+            latencies.append(time.perf_counter() - start)
+
+    predictions = np.asarray(predictions)
+    latencies = np.asarray(latencies) * 1000.
+    return {
+        "accuracy": float((predictions == labels).mean()),
+        "predictions": predictions,
+        "latency_ms": {
+            "mean": round(float(latencies.mean()), 4),
+            "p50": round(float(np.percentile(latencies, 50)), 4),
+            "p95": round(float(np.percentile(latencies, 95)), 4)
+        }
+    }
+
+
+def select_variant(
+        variants: Dict[str, Dict[str, Any]],
+        accuracy_budget: float
+) -> str:
+    """
+    Returns the fastest variant whose accuracy is at most accuracy_budget below the float32 one
+    :param variants: entries of the report written by export_tflite_models
+    :param accuracy_budget: allowed drop in accuracy, e.g. 0.01 for one point
+    :return:
+    """
+    within_budget = [mode for mode, variant in variants.items() if variant["accuracy_drop"] <= accuracy_budget]
+    return min(within_budget, key=lambda mode: variants[mode]["latency_ms"]["p50"])
+
+
+def export_tflite_models(
+        model: Model,
+        directory: str,
+        representative_images: np.ndarray,
+        evaluation_images: np.ndarray,
+        evaluation_labels: np.ndarray,
+        modes: Sequence[str] = QUANTIZATION_MODES,
+        accuracy_budget: float = 0.01,
+        num_threads: int = 1,
+        int8_io: bool = False
+) -> Dict[str, Any]:
+    """
+    Converts a model to every quantization mode, evaluates the variants against the float32 model and
+    writes them to directory with a report (REPORT_FILENAME) naming the fastest one within the accuracy budget
+    :param model:
+    :param directory:
+    :param representative_images: calibration images for int8, see sample_flow
+    :param evaluation_images: held-out images, prepared like the training images
+    :param evaluation_labels: their class indices
+    :param modes: the variants to export, float32 is always exported as the reference
+    :param accuracy_budget: allowed drop in accuracy compared to float32
+    :param num_threads: threads per interpreter when measuring latency
+    :param int8_io: see convert_to_tflite
+    :return: the report
+    """
+    os.makedirs(directory, exist_ok=True)
+    modes = ["float32"] + [mode for mode in modes if mode != "float32"]
+
+    variants = {}
+    reference = None
+    for mode in modes:
+        print(f"Converting {model.name} to TF Lite ({mode}).")
+        model_content = convert_to_tflite(model, mode, representative_images, int8_io)
+        filepath = os.path.join(directory, f"{model.name}-{mode}.tflite")
+        with open(filepath, "wb") as f:
+            f.write(model_content)
+
+        evaluation = evaluate_tflite(model_content, evaluation_images, evaluation_labels, num_threads)
+        predictions = evaluation.pop("predictions")
+        if reference is None:
+            reference = {"predictions": predictions, **evaluation}
+
+        variants[mode] = {
+            "filepath": filepath,
+            "size_bytes": len(model_content),
+            **evaluation,
+            "accuracy_drop": round(reference["accuracy"] - evaluation["accuracy"], 6),
+            # how often the variant predicts the same class as the float model, on top of the accuracy
+            "agreement": float((predictions == reference["predictions"]).mean()),
+            "speedup": round(reference["latency_ms"]["p50"] / evaluation["latency_ms"]["p50"], 3)
+        }
+        print(
+            f"{mode:<14} accuracy {evaluation['accuracy']:.4f}  "
+            f"p50 latency {evaluation['latency_ms']['p50']:.3f} ms  size {len(model_content) / 2 ** 20:.2f} MiB"
+        )
+
+    report = {
+        "model": model.name,
+        "input_shape": list(model.input_shape[1:]),
+        "num_calibration_images": len(representative_images),
+        "num_evaluation_images": len(evaluation_images),
+        "num_threads": num_threads,
+        "accuracy_budget": accuracy_budget,
+        "variants": variants,
+        "selected": select_variant(variants, accuracy_budget)
+    }
+    with open(os.path.join(directory, REPORT_FILENAME), "w") as f:
+        json.dump(report, f, indent=2)
+
+    return report
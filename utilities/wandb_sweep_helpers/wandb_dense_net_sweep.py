@@ -1,12 +1,14 @@
 
 
+from typing import *
+
 import tensorflow as tf
-from tensorflow.keras.layers import Dense, Dropout
 from tensorflow.keras.preprocessing.image import ImageDataGenerator
-from tensorflow.keras.applications.densenet import DenseNet121
 import wandb
 
-from utils.model_utils import ModelWrapper
+from utils.generator_utils import create_datasets
+from utils.model_utils import ExtendedModel, get_classification_head, get_pre_trained_model
+from utils.feature_cache_utils import create_feature_datasets
 
 
 def get_model(
@@ -14,40 +16,26 @@ def get_model(
         input_shape: tuple = (256, 256, 3),
         model_name: str = "dense-net-121",
         n_classes: int = 4
-):
+) -> ExtendedModel:
     """
     returns an instance of a pre-trained DenseNet121 for fine-tuning on a classification task
     :param config:
     :param model_name:
     :return:
     """
-    base_model = DenseNet121(
-        weights=config.weights,
-        include_top=False,
+    return get_pre_trained_model(
+        "densenet",
+        input_shape,
         pooling=config.pooling,
-        input_shape=input_shape
-    )
-
-    x = base_model.output
-    x = Dropout(config.dropout_rate)(x)
-
-    dim = config.dense_start_dimension
-    for i in range(config.n_dense_cls_head):
-        x = Dense(dim, activation=config.dense_cls_activation)(x)
-        dim = dim // config.reduction_factor
-
-    output = Dense(n_classes, activation="softmax")(x)
-
-    model = ModelWrapper(
-        inputs=base_model.input,
-        outputs=output,
-        name=model_name
+        model_name=model_name,
+        weights=config.weights,
+        dropout_rate=config.dropout_rate,
+        num_classes=n_classes,
+        dense_start_dimension=config.dense_start_dimension,
+        num_dense_classification_head=config.n_dense_cls_head,
+        dense_classification_head_activation=config.dense_cls_activation,
+        dim_shrink_factor=config.reduction_factor
     )
-    # Train top layer
-    for layer in base_model.layers[:-2]:
-        layer.trainable = False
-
-    return model
 
 
 def get_optimizer(
@@ -87,4 +75,80 @@ def get_generator_instances(
     else:
         train_generator = ImageDataGenerator(**generator_kwargs)
 
-    return train_generator, generator
\ No newline at end of file
+    return train_generator, generator
+
+
+def get_datasets(
+        config: wandb.config,
+        path_to_data: str,
+        add_data_augmentation: bool = False,
+        cache: Union[bool, str] = False
+):
+    """
+    tf.data counterpart of get_generator_instances + create_flows, with the same augmentation options
+    :param config:
+    :param path_to_data:
+    :param add_data_augmentation:
+    :param cache: True to cache decoded images in memory, a directory to cache them on disk.
+        Later runs of a sweep on the same machine reuse a completed on-disk cache.
+    :return:
+    """
+    dataset_kwargs = dict(batch_size=getattr(config, "batch_size", 32))
+
+    if add_data_augmentation:
+        dataset_kwargs.update(
+            horizontal_flip=config.horizontal_flip,
+            vertical_flip=config.vertical_flip,
+            rotation_range=config.rotation_range,
+            channel_shift_range=config.channel_shift_range,
+            fill_mode=config.fill_mode
+        )
+
+    return create_datasets(path_to_data, cache=cache, **dataset_kwargs)
+
+
+def get_head_model(
+        config: wandb.config,
+        feature_shape: tuple = (1024, ),
+        model_name: str = "dense-net-121-head",
+        n_classes: int = 4
+):
+    """
+    returns the classification head of get_model on its own, to be trained on the datasets of get_feature_datasets.
+    Much faster per trial than get_model, as long as the sweep does not search over augmentation.
+    :param config:
+    :param feature_shape: shape of the pooled DenseNet121 features
+    :param model_name:
+    :param n_classes:
+    :return:
+    """
+    return get_classification_head(
+        feature_shape,
+        model_name=model_name,
+        dropout_rate=config.dropout_rate,
+        num_classes=n_classes,
+        dense_start_dimension=config.dense_start_dimension,
+        num_dense_classification_head=config.n_dense_cls_head,
+        dense_classification_head_activation=config.dense_cls_activation,
+        dim_shrink_factor=config.reduction_factor
+    )
+
+
+def get_feature_datasets(
+        config: wandb.config,
+        path_to_data: str,
+        cache_directory: str,
+        input_shape: tuple = (256, 256, 3)
+):
+    """
+    Cached DenseNet121 features of the images, computed by the first trial of a sweep and reused by the others
+    :param config:
+    :param path_to_data:
+    :param cache_directory:
+    :param input_shape:
+    :return:
+    """
+    return create_feature_datasets(
+        path_to_data, cache_directory, "densenet", input_shape=input_shape, pooling=config.pooling,
+        weights=config.weights, batch_size=getattr(config, "batch_size", 32)
+    )